@@ -0,0 +1,89 @@
+"""
+こうかとん ファイターの画像パックを作る
+
+タイトル・ステージ背景と、内部の解像度ごとに拡大縮小・左右反転・回転したファイターと飛び道具の画像を、
+そのまま Surface にできる画素の並び（BGRA）で1つのファイルにまとめる。ゲームは起動時にこれを
+メモリにマップし、JPEG / PNG を展開せずに画像を用意する。
+
+画像を差し替えたら作り直す。作り直すまでは、変わった画像だけ元のファイルから読み込む
+（更新時刻と大きさ、時刻だけ違うときは中身のハッシュで見分ける）。
+
+使い方:
+    python bake_assets.py                 # assets.pack を作る
+    python bake_assets.py --bench         # 元のファイルとパックで起動時の読み込みの速さを比べる
+    python bake_assets.py --out other.pack
+"""
+import argparse
+import os
+import sys
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pygame as pg
+
+import kakutou_koukaton as game
+
+
+def load_startup_assets(pack: str | None) -> float:
+    """
+    起動から 1v1 の対戦までに読み込む画像（タイトル・ステージ・ファイター・飛び道具）を、
+    空のキャッシュから読み込んで時間（ms）を返す。
+
+    Args:
+        pack: 使う画像パック（None なら元のファイルから）
+    """
+    game.ASSETS = game.AssetRegistry()
+    game.Projectile._frames.clear()
+    start = time.perf_counter()
+    if pack is not None:
+        game.ASSETS.open_pack(pack)
+    game.ASSETS.image(game.TITLE_IMAGE, (game.WIDTH, game.HEIGHT), alpha=False)
+    for _, filename in game.stage_files:
+        game.load_stage_image(filename).convert()
+    for char_name in game.FIGHTER_CHARS:
+        game.load_fighter_sprites(char_name)
+    for kind in game.Projectile.DATA:
+        for facing in (1, -1):
+            game.Projectile.rotation_frames(kind, facing, game.RENDER_SCALE)
+    return (time.perf_counter() - start) * 1000
+
+
+def bench(pack: str, repeat: int = 5) -> None:
+    """元のファイルとパックで読み込みの時間を比べる（いちばん速い回）"""
+    source_ms = min(load_startup_assets(None) for _ in range(repeat))
+    source_stats = game.ASSETS.stats()
+    pack_ms = min(load_startup_assets(pack) for _ in range(repeat))
+    pack_stats = game.ASSETS.stats()
+    print(f"元のファイル: {source_ms:7.1f} ms  (ファイル {source_stats['loads']} 回)")
+    print(f"画像パック  : {pack_ms:7.1f} ms  (パック {pack_stats['unpacked']} 枚, "
+          f"ファイル {pack_stats['loads']} 回)  {source_ms / pack_ms:.1f} 倍")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="こうかとん ファイター 画像パックの作成")
+    parser.add_argument("--out", default=game.resource_path(game.ASSET_PACK or "assets.pack"),
+                        help="書き出すファイル")
+    parser.add_argument("--bench", action="store_true", help="作った後に読み込みの速さを比べる")
+    args = parser.parse_args()
+
+    pg.display.init()
+    pg.display.set_mode((1, 1))  # convert() に画面が要る
+
+    start = time.perf_counter()
+    try:
+        count, size = game.write_asset_pack(args.out, game.asset_manifest())
+    except OSError as e:
+        print(f"[asset pack error] {args.out} : {e}")
+        sys.exit(1)
+    print(f"{args.out}: 画像 {count} 枚, {size / 1024 / 1024:.1f} MB "
+          f"({time.perf_counter() - start:.1f} 秒)")
+
+    if args.bench:
+        bench(args.out)
+    pg.quit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,425 @@
+"""
+こうかとん ファイターのベンチマーク
+
+画面を出さない SDL のダミードライバで、決まった入力を対戦に流して処理時間を測る。
+シミュレーションだけ（sim）と、描画まで含めたもの（render）を別々に計り、
+FPS と段階ごとの時間（マイクロ秒）を JSON に書き出す。保存しておいた
+基準の JSON と比べて、遅くなっていたら終了コード 1 で終わる。
+
+使い方:
+    python bench.py --out bench_baseline.json              # 基準を作る
+    python bench.py --baseline bench_baseline.json         # 基準と比べる（10% 以上遅いと失敗）
+    python bench.py --scenario storm --mode sim --threshold 0.2
+    python bench.py --contacts                             # 精密な当たり判定の重さを矩形だけの判定と比べる（5% まで）
+    python bench.py --scenario ffa ffa_barrage --mode render --min-fps 60
+                                                           # 8人の乱戦で 60 fps を保てるか確かめる
+
+シナリオ:
+    idle    何も押さない
+    spam    パンチ・キックを押し続ける
+    storm   手裏剣と螺旋丸を撃ち続けて螺旋剛手裏剣に融合させる
+    barrage 弾幕モードで手裏剣をばらまき続ける（numpy があるときだけ）
+    ffa     8人の乱戦（FFA8）で全員が手裏剣・螺旋丸・パンチを出し続ける
+    ffa_barrage  8人の乱戦を弾幕モードで（numpy があるときだけ）
+    menu    ポーズ画面と設定画面を行き来する（描画を計るので render だけ）
+
+--contacts は、シナリオを矩形の判定で一度流して毎フレームの当たり判定の直前の状態を
+とっておき、同じ状態に戻しては Battle.find_contacts() と Battle.collide() だけを
+矩形（precise=False）と精密（precise=True）で計る。対戦の流れが判定で変わらないので、
+同じ仕事の重さを比べられる。
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pygame as pg
+
+import kakutou_koukaton as game
+
+
+WARMUP_FRAMES = 60
+DEFAULT_FRAMES = 600
+DEFAULT_THRESHOLD = 0.10
+# 精密な当たり判定が矩形だけの判定より遅くなってよい割合
+PRECISE_LIMIT = 0.05
+
+
+# =====================
+# 入力の台本
+# =====================
+def idle_inputs(frame: int) -> tuple[int, int]:
+    return 0, 0
+
+
+def spam_inputs(frame: int) -> tuple[int, int]:
+    """近づきながらパンチとキックを交互に出す"""
+    press = game.IN_PUNCH if frame % 2 == 0 else game.IN_KICK
+    return game.IN_RIGHT | press, game.IN_LEFT | press
+
+
+def storm_inputs(frame: int) -> tuple[int, int]:
+    """螺旋丸を撃った直後に手裏剣を重ねて、融合させ続ける"""
+    press = (game.IN_BOMB, game.IN_BEAM, 0)[frame % 3]
+    return press, press
+
+
+def barrage_inputs(frame: int) -> tuple[int, int]:
+    """弾幕モードで手裏剣をまとめてばらまく"""
+    press = game.IN_BEAM if frame % 10 == 0 else 0
+    return press, press
+
+
+def ffa_inputs(frame: int) -> tuple[int, ...]:
+    """8人がずらしながら手裏剣・螺旋丸・パンチを出し続け、画面を飛び道具で埋める"""
+    return tuple((game.IN_BEAM, game.IN_BOMB, game.IN_PUNCH, 0)[(frame + i) % 4] for i in range(8))
+
+
+def ffa_barrage_inputs(frame: int) -> tuple[int, ...]:
+    """8人が順番に手裏剣をまとめてばらまく"""
+    return tuple(game.IN_BEAM if (frame + i * 5) % 40 == 0 else 0 for i in range(8))
+
+
+# 名前: (入力の台本, 弾幕モード, 対戦形式)
+BATTLE_SCENARIOS = {
+    "idle": (idle_inputs, False, "1v1"),
+    "spam": (spam_inputs, False, "1v1"),
+    "storm": (storm_inputs, False, "1v1"),
+    "barrage": (barrage_inputs, True, "1v1"),
+    "ffa": (ffa_inputs, False, "FFA8"),
+    "ffa_barrage": (ffa_barrage_inputs, True, "FFA8"),
+}
+SCENARIOS = tuple(BATTLE_SCENARIOS) + ("menu",)
+
+# メニューで順に押すキー（Settings を開き、音量を変えて戻る）
+MENU_KEYS = (pg.K_DOWN, pg.K_RETURN, pg.K_RIGHT, pg.K_LEFT, pg.K_ESCAPE, pg.K_UP)
+MENU_KEY_INTERVAL = 5
+
+
+def sustain(battle) -> None:
+    """試合が終わらないように体力・エネルギー・時間を戻す"""
+    for f in battle.fighters:
+        f.hp = 100
+        f.energy = 100
+    battle.time_left = game.MATCH_TIME
+
+
+# =====================
+# 計測
+# =====================
+def run_battle(name: str, frames: int, render: bool, precise: bool) -> dict:
+    """対戦のシナリオを流して計る"""
+    script, barrage, mode = BATTLE_SCENARIOS[name]
+    battle = game.create_battle(barrage, precise, mode)
+    battle.reset()
+    game.preload_battle_assets(battle)
+    hud = game.HUD()
+    renderer = game.BattleRenderer()
+    renderer.set_stage(game.STAGES[0].bg)
+    profiler = game.PROFILER
+    fused = set()
+
+    for frame in range(WARMUP_FRAMES + frames):
+        if frame == WARMUP_FRAMES:
+            profiler.enabled = True
+            start = time.perf_counter()
+        sustain(battle)
+        if profiler.enabled:
+            profiler.begin_frame()
+        battle.step(script(frame))
+        if render:
+            rects = renderer.draw(game.screen, battle, hud, game.P1_KEYS_TEXT, game.P2_KEYS_TEXT)
+            if profiler.enabled:
+                profiler.lap(game.P_OTHER)
+            game.present(rects)
+            if profiler.enabled:
+                profiler.lap(game.P_DISPLAY)
+        if profiler.enabled:
+            profiler.end_frame()
+            fused.update(id(p) for p in battle.projectiles if p.kind == "rasensyuriken")
+    elapsed = time.perf_counter() - start
+    result = summarize(profiler, frames, elapsed)
+    result["fusions"] = len(fused)
+    result["projectiles"] = len(battle.projectiles) + (battle.field.count if battle.field else 0)
+    return result
+
+
+def run_menu(frames: int) -> dict:
+    """ポーズ画面と設定画面を行き来して、描画まで計る"""
+    hud = game.HUD()
+    pause_menu = game.PauseMenu(hud)
+    settings_menu = game.SettingsMenu(hud)
+    battle = game.create_battle()
+    battle.reset()
+    renderer = game.BattleRenderer()
+    renderer.set_stage(game.STAGES[0].bg)
+    renderer.draw(game.screen, battle, hud, game.P1_KEYS_TEXT, game.P2_KEYS_TEXT)
+    background = game.screen.copy()
+    pause_menu.set_background(background)
+    settings_menu.set_background(background)
+    profiler = game.PROFILER
+
+    state = game.PAUSED
+    key_index = 0
+    for frame in range(WARMUP_FRAMES + frames):
+        if frame == WARMUP_FRAMES:
+            profiler.enabled = True
+            start = time.perf_counter()
+        if profiler.enabled:
+            profiler.begin_frame()
+        if frame % MENU_KEY_INTERVAL == 0:
+            event = pg.event.Event(pg.KEYDOWN, key=MENU_KEYS[key_index % len(MENU_KEYS)])
+            key_index += 1
+            if state == game.PAUSED:
+                if pause_menu.handle_event(event) == "Settings":
+                    state = game.SETTINGS
+            elif settings_menu.handle_event(event) == "Back":
+                state = game.PAUSED
+        if profiler.enabled:
+            profiler.lap(game.P_EVENT)
+        (pause_menu if state == game.PAUSED else settings_menu).draw(game.screen)
+        if profiler.enabled:
+            profiler.lap(game.P_DRAW)
+        game.present()
+        if profiler.enabled:
+            profiler.lap(game.P_DISPLAY)
+            profiler.end_frame()
+    return summarize(profiler, frames, time.perf_counter() - start)
+
+
+def freeze_states(name: str, frames: int) -> list[tuple]:
+    """シナリオを矩形の判定で流し、毎フレームの当たり判定の直前の状態を集める"""
+    script, barrage, mode = BATTLE_SCENARIOS[name]
+    battle = game.create_battle(barrage, False, mode)
+    battle.reset()
+    states = []
+    collide = battle.collide
+
+    def capture() -> None:
+        states.append(battle.save_state())
+        collide()
+
+    battle.collide = capture
+    for frame in range(WARMUP_FRAMES + frames):
+        sustain(battle)
+        battle.step(script(frame))
+    return states[WARMUP_FRAMES:]
+
+
+def contact_battle(name: str, precise: bool):
+    """run_contacts() で使う、シナリオと同じ形式の Battle（マスクも先に作っておく）"""
+    _, barrage, mode = BATTLE_SCENARIOS[name]
+    battle = game.create_battle(barrage, precise, mode)
+    battle.reset()
+    game.preload_battle_assets(battle)
+    return battle
+
+
+def run_contacts(battles: list, states: list[tuple]) -> list[dict]:
+    """
+    freeze_states() の状態ごとに、find_contacts() と collide() だけの時間を計る。
+    時間のゆらぎが片方にだけ乗らないように、1つの状態を battles で交互に計る。
+
+    Args:
+        battles: contact_battle() で作った Battle のリスト
+        states: freeze_states() の結果
+    Returns:
+        battles と同じ並びの、1 フレームの平均時間（us）と接触の数
+    """
+    find_time = [0.0] * len(battles)
+    collide_time = [0.0] * len(battles)
+    contacts = [0] * len(battles)
+    gc.disable()
+    try:
+        for state in states:
+            for i, battle in enumerate(battles):
+                battle.load_state(state)
+                start = time.perf_counter()
+                contacts[i] += len(battle.find_contacts())
+                find_time[i] += time.perf_counter() - start
+                battle.load_state(state)
+                start = time.perf_counter()
+                battle.collide()
+                collide_time[i] += time.perf_counter() - start
+    finally:
+        gc.enable()
+    n = len(states)
+    return [{"find_contacts_us": find_time[i] / n * 1e6, "collide_us": collide_time[i] / n * 1e6,
+             "contacts": contacts[i] / n} for i in range(len(battles))]
+
+
+def compare_contacts(scenarios: list[str], frames: int, repeat: int) -> list[str]:
+    """
+    矩形と精密の当たり判定を同じ状態で計り、collide() 全体が PRECISE_LIMIT より
+    遅くなったシナリオを返す。repeat 回流し、それぞれいちばん速い回で比べる。
+    """
+    over = []
+    print(f"当たり判定だけの時間（1 フレームの平均 us、精密の collide が {PRECISE_LIMIT:.0%} 以上遅いと失敗）")
+    print(f"{'scenario':<14}{'contacts':>9}{'rect':>10}{'precise':>10}{'ratio':>9}"
+          f"{'collide rect':>14}{'precise':>10}{'ratio':>9}")
+    for name in scenarios:
+        states = freeze_states(name, frames)
+        battles = [contact_battle(name, False), contact_battle(name, True)]
+        rect, precise = run_contacts(battles, states)
+        for _ in range(repeat - 1):
+            for best, result in zip((rect, precise), run_contacts(battles, states)):
+                for key in ("find_contacts_us", "collide_us"):
+                    best[key] = min(best[key], result[key])
+        find_ratio = precise["find_contacts_us"] / rect["find_contacts_us"]
+        collide_ratio = precise["collide_us"] / rect["collide_us"]
+        mark = ""
+        if collide_ratio > 1 + PRECISE_LIMIT:
+            over.append(name)
+            mark = "  <-- 遅い"
+        print(f"{name:<14}{precise['contacts']:9.2f}{rect['find_contacts_us']:10.1f}"
+              f"{precise['find_contacts_us']:10.1f}{find_ratio:9.3f}"
+              f"{rect['collide_us']:14.1f}{precise['collide_us']:10.1f}{collide_ratio:9.3f}{mark}")
+    return over
+
+
+def summarize(profiler, frames: int, elapsed: float) -> dict:
+    """プロファイラの記録を結果の辞書にする"""
+    profiler.enabled = False
+    stats = {name: (lo, avg, p99) for name, lo, avg, p99 in profiler.stats()}
+    return {
+        "fps": frames / elapsed,
+        "frame_us": stats["frame"][1],
+        "frame_p99_us": stats["frame"][2],
+        "phases_us": {name: round(stats[name][1], 2) for name in game.PROFILE_PHASES},
+    }
+
+
+def run(name: str, mode: str, frames: int, repeat: int, precise: bool = False) -> dict:
+    """
+    シナリオを repeat 回流し、いちばん速かった回の結果を返す。
+
+    Args:
+        name: シナリオ名
+        mode: "sim"（シミュレーションだけ）か "render"（描画も含める）
+        frames: 計るフレーム数
+        repeat: 繰り返す回数
+        precise: 精密な当たり判定（マスク）を使うかどうか
+    """
+    best = None
+    for _ in range(repeat):
+        game.PROFILER = game.FrameProfiler(frames)
+        if name == "menu":
+            result = run_menu(frames)
+        else:
+            result = run_battle(name, frames, mode == "render", precise)
+        if best is None or result["frame_us"] < best["frame_us"]:
+            best = result
+    return best
+
+
+# =====================
+# 基準との比較
+# =====================
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """
+    基準より threshold の割合以上遅くなった項目を返す（1 フレームの平均時間で比べる）。
+    """
+    regressions = []
+    print(f"\n基準との比較（{threshold:.0%} 以上遅くなったら失敗）")
+    for key, cur in results["results"].items():
+        base = baseline.get("results", {}).get(key)
+        if base is None:
+            print(f"  {key:<16} 基準なし")
+            continue
+        change = cur["frame_us"] / base["frame_us"] - 1
+        mark = ""
+        if change > threshold:
+            regressions.append(key)
+            mark = "  <-- 遅くなった"
+        print(f"  {key:<16} {base['frame_us']:9.1f} -> {cur['frame_us']:9.1f} us ({change:+.1%}){mark}")
+        # どの段階が遅くなったか
+        if mark:
+            for phase, us in cur["phases_us"].items():
+                before = base["phases_us"].get(phase, 0.0)
+                if us - before > 1.0:
+                    print(f"      {phase:<12} {before:9.1f} -> {us:9.1f} us")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="こうかとん ファイター ベンチマーク")
+    parser.add_argument("--scenario", nargs="+", choices=SCENARIOS, help="流すシナリオ（省略するとすべて）")
+    parser.add_argument("--mode", choices=("sim", "render", "both"), default="both")
+    parser.add_argument("--frames", type=int, default=DEFAULT_FRAMES, help="計るフレーム数")
+    parser.add_argument("--repeat", type=int, default=3, help="繰り返す回数（いちばん速い回を使う）")
+    parser.add_argument("--precise", action="store_true", help="精密な当たり判定（マスク）で対戦する")
+    parser.add_argument("--contacts", action="store_true",
+                        help="同じ状態で当たり判定だけを計り、精密と矩形を比べる")
+    parser.add_argument("--out", help="結果を書き出す JSON")
+    parser.add_argument("--baseline", help="比べる基準の JSON")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="遅くなったとみなす割合（0.1 なら 10%%）")
+    parser.add_argument("--min-fps", type=float, help="これより遅い項目があれば失敗にする")
+    parser.add_argument("--scale", type=float, choices=game.RENDER_SCALES, default=game.RENDER_SCALE,
+                        help="内部の解像度の倍率")
+    args = parser.parse_args()
+
+    game.init_display()
+    game.set_render_scale(args.scale)
+    scenarios = args.scenario or SCENARIOS
+    if game.np is None:
+        scenarios = [s for s in scenarios if not BATTLE_SCENARIOS.get(s, (None, False))[1]]
+    modes = ("sim", "render") if args.mode == "both" else (args.mode,)
+
+    if args.contacts:
+        over = compare_contacts([s for s in scenarios if s in BATTLE_SCENARIOS], args.frames, args.repeat)
+        pg.quit()
+        if over:
+            sys.exit(1)
+        return
+
+    results = {
+        "meta": {
+            "python": platform.python_version(),
+            "pygame": pg.version.ver,
+            "numpy": game.np.__version__ if game.np is not None else None,
+            "platform": platform.platform(),
+            "video_driver": os.environ["SDL_VIDEODRIVER"],
+            "frames": args.frames,
+            "precise": args.precise,
+            "render_scale": args.scale,
+        },
+        "results": {},
+    }
+    print(f"{'scenario':<16}{'fps':>10}{'frame us':>10}{'p99 us':>10}")
+    for name in scenarios:
+        for mode in modes:
+            if name == "menu" and mode == "sim":
+                continue  # 描画しないとキーを1つ処理するだけで、何も計れない
+            result = run(name, mode, args.frames, args.repeat, args.precise)
+            key = f"{name}/{mode}"
+            results["results"][key] = result
+            print(f"{key:<16}{result['fps']:10.0f}{result['frame_us']:10.1f}{result['frame_p99_us']:10.1f}")
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as fp:
+            json.dump(results, fp, indent=2, ensure_ascii=False)
+
+    if args.min_fps is not None:
+        slow = [key for key, result in results["results"].items() if result["fps"] < args.min_fps]
+        for key in slow:
+            print(f"  {key:<16} {results['results'][key]['fps']:.0f} fps < {args.min_fps:.0f} fps  <-- 遅い")
+        if slow:
+            sys.exit(1)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as fp:
+            baseline = json.load(fp)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+    pg.quit()
+
+
+if __name__ == "__main__":
+    main()
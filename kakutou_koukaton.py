@@ -1,7 +1,34 @@
-import pygame as pg
+import time
+
+# 起動時間の計測を始めた時刻（pygame の import も含める）
+STARTUP_STARTED = time.perf_counter()
+
 import sys
 import os
+import math
+import multiprocessing
 import platform
+import array
+import bisect
+import hashlib
+import json
+import mmap
+import queue
+import random
+import struct
+import threading
+import zlib
+import concurrent.futures
+from collections import OrderedDict
+
+import pygame as pg
+
+PYGAME_IMPORTED = time.perf_counter()
+
+try:
+    import numpy as np
+except ImportError:  # numpy は弾幕モードでだけ使う
+    np = None
 
 # =====================
 # 初期設定
@@ -14,6 +41,7 @@ SELECT = 1
 BATTLE = 2
 PAUSED = 3
 SETTINGS = 4
+RESULT = 5
 
 # OS判定して適切なフォントパスを設定
 if platform.system() == "Windows":
@@ -26,21 +54,71 @@ else:  # Linux等
 # BGMファイル
 MENU_BGM = "sound/bgm/menu-bgm.mp3"
 BATTLE_BGM = "sound/bgm/vhs-tape.mp3"
+# 曲を切り替えるときのクロスフェードの長さ(ms)
+BGM_CROSSFADE_MS = 800
 
-# マッチ時間(秒)
-MATCH_TIME = 90
+# シミュレーションの更新回数(回/秒)。描画の速さとは独立して一定間隔で進める
+TICK_RATE = 60
+TICK_MS = 1000 / TICK_RATE
+# 処理落ちしたとき1回の描画で追いつく最大の更新回数（超えた分は切り捨てる）
+MAX_TICKS_PER_FRAME = 8
+# 描画の上限フレームレート
+RENDER_FPS = 60
 
-# カレントディレクトリをスクリプトの場所に
-try:
-    os.chdir(os.path.dirname(os.path.abspath(__file__)))
-except Exception:
-    pass
+# マッチ時間(シミュレーションの更新回数。90秒)
+MATCH_TIME = 90 * TICK_RATE
+
+# 指定すると、当たり判定を画像の形（マスク）で精密に行う。矩形が重なったときだけマスクを比べる
+PRECISE_HITS = bool(os.environ.get("KOUKATON_PRECISE_HITS"))
+
+# 内部で描く解像度（WIDTH×HEIGHT に対する倍率）。小さくすると荒くなるかわりに描画が軽くなる。
+# 描いた画面は1フレームに1回だけウィンドウの大きさに拡大する（設定画面でも切り替えられる）
+RENDER_SCALES = (0.5, 0.75, 1.0)
+
+
+def parse_render_scale(text: str) -> float:
+    """倍率の文字列を RENDER_SCALES のいちばん近い値にする（数でない・0 以下なら 1.0）"""
+    try:
+        scale = float(text)
+    except ValueError:
+        return 1.0
+    if not math.isfinite(scale) or scale <= 0:
+        return 1.0
+    return min(RENDER_SCALES, key=lambda s: abs(s - scale))
+
+
+RENDER_SCALE = parse_render_scale(os.environ.get("KOUKATON_RENDER_SCALE", "1"))
+# 指定すると全画面で起動する（F11 でも切り替えられる）
+FULLSCREEN = bool(os.environ.get("KOUKATON_FULLSCREEN"))
+FULLSCREEN_KEY = pg.K_F11
+
+# 画像・音声はスクリプトの場所から探す（カレントディレクトリは変えない）
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 前もって拡大縮小・反転・回転しておいた画像のパック（bake_assets.py で作る）。
+# ないとき・空にしたときは元の画像ファイルから読み込む
+ASSET_PACK = os.environ.get("KOUKATON_ASSET_PACK", "assets.pack")
+
+# 指定すると、起動から最初の画面までの時間を段階ごとに表示する
+TRACE_STARTUP = bool(os.environ.get("KOUKATON_TRACE_STARTUP"))
+
+# 画面・フォント・背景画像は init_display() で作成する
+# （import しただけではウィンドウを開かず、画像も読み込まない）
+# screen は内部の解像度で描く先、window はウィンドウ。等倍でウィンドウも同じ大きさなら同じもの
+screen = None
+window = None
+clock = None
+FONT_BIG = None
+FONT_MED = None
+FONT_SMALL = None
+TITLE_BG = None
+TITLE_IMAGE = "ダウンロード (1).jpg"
+
+
+def resource_path(path: str) -> str:
+    """スクリプトの場所からの相対パスを絶対パスにする（絶対パスはそのまま）"""
+    return os.path.join(BASE_DIR, path)
 
-pg.init()
-pg.mixer.init()
-screen = pg.display.set_mode((WIDTH, HEIGHT))
-pg.display.set_caption("こうかとん ファイター")
-clock = pg.time.Clock()
 
 def load_font(size):
     """フォントを安全にロードする関数"""
@@ -53,41 +131,399 @@ def load_font(size):
         return pg.font.Font(None, size)
 
 
-# フォントの作成
-FONT_BIG = load_font(80)
-FONT_MED = load_font(36)
-FONT_SMALL = load_font(13)
+class TextCache:
+    """
+    font.render() の結果を (フォント, 文字列, 色) ごとに使い回す。
+    文字の描画は重いので、同じ文字列を毎フレーム描き直さないようにする。
+    """
 
-# フォントの作成
-FONT_BIG = load_font(80)
-FONT_MED = load_font(36)
-FONT_SMALL = load_font(13)
-# pg.init()
-# screen = pg.display.set_mode((WIDTH, HEIGHT))
-# pg.display.set_caption("Mini Street Fighter MAX")
-# clock = pg.time.Clock()
+    MAX_ENTRIES = 512
+
+    def __init__(self) -> None:
+        self._cache: dict[tuple, pg.Surface] = {}
+
+    def render(self, font: pg.font.Font, text: str, color: tuple) -> pg.Surface:
+        """文字列を描画した画像を返す（アンチエイリアスあり）"""
+        key = (font, text, color)
+        surf = self._cache.get(key)
+        if surf is None:
+            if len(self._cache) >= self.MAX_ENTRIES:
+                self._cache.clear()
+            surf = font.render(text, True, color)
+            self._cache[key] = surf
+        return surf
 
-def safe_load_and_play_bgm(path, volume=0.5, loops=-1):
-    """BGMを安全にロードして再生する"""
-    try:
-        pg.mixer.music.load(path)
-        pg.mixer.music.set_volume(volume)
-        pg.mixer.music.play(loops)
-    except Exception as e:
-        print(f"[BGM load error] {path} : {e}")
+
+TEXT = TextCache()
 
 
 # =====================
-# 画像読み込み
+# BGM
 # =====================
-try:
-    TITLE_BG = pg.transform.scale(
-        pg.image.load("ダウンロード (1).jpg").convert(),
-        (WIDTH, HEIGHT)
-    )
-except:
-    TITLE_BG = pg.Surface((WIDTH, HEIGHT))
-    TITLE_BG.fill((20, 20, 50))
+class AudioManager:
+    """
+    BGM を別スレッドで読み込み、フレームを止めずに切り替える。
+    前の曲を fadeout しながら次の曲を fade_ms で鳴らす（クロスフェード）ので、
+    pg.mixer.music ではなく、曲を Sound にデコードして予約した2つのチャンネルで鳴らす。
+    """
+
+    CHANNELS = 2
+
+    def __init__(self, crossfade_ms: int = BGM_CROSSFADE_MS) -> None:
+        self.crossfade_ms = crossfade_ms
+        self.volume = 0.5
+        self.sounds: dict[str, pg.mixer.Sound | None] = {}  # 読み込んだ曲（失敗したら None）
+        self.load_ms: dict[str, float] = {}  # 読み込みにかかった時間
+        self.requests: queue.Queue[str] = queue.Queue()
+        self.queued: set[str] = set()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.wanted = None  # 鳴らしたい曲
+        self.playing = None  # 鳴らしている曲
+        self.channel_index = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.thread is not None
+
+    def start(self) -> None:
+        """読み込み用のスレッドを動かす（音声が使えないときは何もしない）"""
+        if self.thread is not None or not pg.mixer.get_init():
+            return
+        pg.mixer.set_reserved(self.CHANNELS)
+        self.thread = threading.Thread(target=self._worker, name="bgm-loader", daemon=True)
+        self.thread.start()
+
+    def preload(self, path: str) -> None:
+        """曲を先に読み込んでおく"""
+        if self.enabled and path not in self.queued:
+            self.queued.add(path)
+            self.requests.put(path)
+
+    def play(self, path: str, volume: float | None = None) -> None:
+        """
+        曲を切り替える。読み込みが終わっていなければ、終わったときに切り替える
+        （それまでは前の曲が鳴り続ける）。
+        """
+        if volume is not None:
+            self.set_volume(volume)
+        self.wanted = path
+        self.preload(path)
+        self.update()
+
+    def update(self) -> None:
+        """毎フレーム呼ぶ。切り替えたい曲の読み込みが終わっていたらクロスフェードする"""
+        if self.wanted == self.playing or not self.enabled:
+            return
+        with self.lock:
+            if self.wanted not in self.sounds:
+                return
+            sound = self.sounds[self.wanted]
+
+        if self.playing is not None:
+            self.channel().fadeout(self.crossfade_ms)
+        self.channel_index = (self.channel_index + 1) % self.CHANNELS
+        if sound is not None:
+            channel = self.channel()
+            channel.set_volume(self.volume)
+            channel.play(sound, loops=-1, fade_ms=self.crossfade_ms)
+        self.playing = self.wanted
+
+    def channel(self) -> pg.mixer.Channel:
+        """今の曲を鳴らすチャンネル"""
+        return pg.mixer.Channel(self.channel_index)
+
+    def set_volume(self, volume: float) -> None:
+        """音量を変える"""
+        self.volume = volume
+        if self.enabled:
+            self.channel().set_volume(volume)
+
+    def _worker(self) -> None:
+        while True:
+            path = self.requests.get()
+            start = time.perf_counter()
+            try:
+                sound = pg.mixer.Sound(resource_path(path))
+            except Exception as e:
+                print(f"[BGM load error] {path} : {e}")
+                sound = None
+            ms = (time.perf_counter() - start) * 1000
+            with self.lock:
+                self.sounds[path] = sound
+                self.load_ms[path] = ms
+            if sound is not None:
+                print(f"[BGM] {path} : {ms:.0f} ms で読み込み")
+
+
+AUDIO = AudioManager()
+
+
+# =====================
+# 画像管理
+# =====================
+# 画像パックのファイル形式（数値はリトルエンディアン）
+#   ヘッダ  PACK_HEADER（マジック・版・索引の長さ）
+#   索引    JSON（UTF-8）
+#           sources: {元の画像のパス: [更新時刻 ns, 大きさ, sha1]}
+#           entries: [[パス, [幅, 高さ], 左右反転, 回転角度, 画素の位置, 幅, 高さ], ...]
+#                    （先頭の4つが AssetRegistry のキー）
+#   画素    画像ごとに BGRA（1行 幅×4 バイト、隙間なし）。位置は画素の先頭からで、
+#           PACK_ALIGN バイトにそろえる。convert_alpha() した Surface と同じ並びなので、
+#           メモリにマップしたままコピーせずに Surface にできる
+PACK_MAGIC = b"KKAP"
+PACK_VERSION = 1
+PACK_HEADER = struct.Struct("<4sBI")
+PACK_ALIGN = 64
+
+
+def pack_align(n: int) -> int:
+    """n を PACK_ALIGN の倍数に切り上げる"""
+    return (n + PACK_ALIGN - 1) // PACK_ALIGN * PACK_ALIGN
+
+
+def file_digest(path: str) -> str:
+    """ファイルの中身の sha1"""
+    with open(resource_path(path), "rb") as fp:
+        return hashlib.sha1(fp.read()).hexdigest()
+
+
+def source_signature(path: str) -> tuple[int, int, str]:
+    """元の画像ファイルの (更新時刻 ns, 大きさ, sha1)"""
+    st = os.stat(resource_path(path))
+    return st.st_mtime_ns, st.st_size, file_digest(path)
+
+
+def source_unchanged(path: str, signature: tuple[int, int, str]) -> bool:
+    """
+    元の画像ファイルがパックを作ったときのままか。
+    更新時刻と大きさが同じなら中身は読まない。時刻だけ違うとき（git で取り直したときなど）は
+    中身の sha1 で比べる。
+    """
+    mtime_ns, size, digest = signature
+    try:
+        st = os.stat(resource_path(path))
+    except OSError:
+        return False
+    if st.st_size != size:
+        return False
+    return st.st_mtime_ns == mtime_ns or file_digest(path) == digest
+
+
+class AssetPack:
+    """
+    bake_assets.py で作った画像パック。ファイルをメモリにマップし、画素をコピーせずに Surface にする。
+    作ったときから変わった元の画像（stale）はパックから出さず、元のファイルから読み込ませる。
+    """
+
+    def __init__(self, path: str, data: mmap.mmap, index_size: int) -> None:
+        self.path = path
+        self.data = data
+        self.view = memoryview(data)
+        index = json.loads(data[PACK_HEADER.size:PACK_HEADER.size + index_size])
+        self.sources: dict[str, tuple[int, int, str]] = {
+            str(source): (int(mtime_ns), int(size), str(digest))
+            for source, (mtime_ns, size, digest) in index["sources"].items()}
+        self.base = pack_align(PACK_HEADER.size + index_size)
+        self.entries: dict[tuple, tuple[int, int, int]] = {}
+        for source, (w, h), flip, angle, offset, width, height in index["entries"]:
+            offset, width, height = int(offset), int(width), int(height)
+            if offset < 0 or width < 0 or height < 0 or self.base + offset + width * height * 4 > len(data):
+                raise ValueError(f"{source} の画素がファイルの外を指しています")
+            self.entries[(str(source), (int(w), int(h)), bool(flip), int(angle))] = (offset, width, height)
+        self.stale = {source for source, sig in self.sources.items() if not source_unchanged(source, sig)}
+
+    @classmethod
+    def load(cls, path: str) -> "AssetPack":
+        """パックを開く（ファイルがないときは OSError、壊れているときは ValueError）"""
+        with open(path, "rb") as fp:
+            # ACCESS_COPY なら Surface に描き込まれてもファイルは変わらない
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_COPY)
+        if len(data) < PACK_HEADER.size:
+            raise ValueError("画像パックではありません")
+        magic, version, index_size = PACK_HEADER.unpack_from(data)
+        if magic != PACK_MAGIC or version != PACK_VERSION:
+            raise ValueError("画像パックではありません（bake_assets.py で作り直してください）")
+        try:
+            return cls(path, data, index_size)
+        except (KeyError, TypeError, AttributeError) as e:
+            raise ValueError(f"画像パックが壊れています: {e}") from e
+
+    def surface(self, key: tuple) -> pg.Surface | None:
+        """
+        パックの画像を BGRA の Surface にする（マップした画素をそのまま使う）。
+
+        Args:
+            key: (パス, 大きさ, 左右反転, 回転角度)
+
+        Returns:
+            パックにないとき・元の画像が変わっているときは None
+        """
+        entry = self.entries.get(key)
+        if entry is None or key[0] in self.stale:
+            return None
+        offset, width, height = entry
+        start = self.base + offset
+        return pg.image.frombuffer(self.view[start:start + width * height * 4], (width, height), "BGRA")
+
+
+class AssetRegistry:
+    """
+    画像を一度だけ読み込み、(パス, サイズ, 左右反転, 回転角度) ごとに共有する。
+    画像パックを開いていれば、パックにある画像はファイルを読まずにそこから出す。
+    hits / misses / loads を見れば、対戦中にファイルを読んでいないか確認できる。
+    """
+
+    def __init__(self) -> None:
+        self._cache: dict[tuple, pg.Surface] = {}
+        self._masks: dict[tuple, pg.mask.Mask] = {}
+        self.pack: AssetPack | None = None
+        self.native = False  # パックの BGRA が convert_alpha() と同じ並びか
+        self.hits = 0  # キャッシュから返した回数
+        self.misses = 0  # 新しく作った回数
+        self.loads = 0  # ファイルから読み込んだ回数
+        self.unpacked = 0  # 画像パックから出した回数
+
+    def open_pack(self, path: str) -> None:
+        """
+        画像パックを開く（画面を作ってから呼ぶ）。ないときは何もしない。
+
+        Args:
+            path: パックのファイル
+        """
+        self.pack = None
+        try:
+            self.pack = AssetPack.load(path)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"[asset pack error] {path} : {e}")
+            return
+        if self.pack.stale:
+            print(f"[asset pack] 変わった画像は元のファイルから読み込みます（bake_assets.py で作り直せます）: "
+                  f"{', '.join(sorted(self.pack.stale))}")
+        probe = pg.image.frombuffer(bytes(4), (1, 1), "BGRA")
+        self.native = probe.get_masks() == probe.convert_alpha().get_masks()
+
+    def image(self, path: str, size: tuple[int, int], flip: bool = False,
+              fallback: tuple = (255, 0, 255, 255), alpha: bool = True, angle: int = 0) -> pg.Surface:
+        """
+        画像を取得する。
+
+        Args:
+            path: 画像ファイルのパス
+            size: 拡大縮小後のサイズ
+            flip: 左右反転するかどうか
+            fallback: 読み込めなかったときに塗りつぶす色
+            alpha: 透過ありで変換するかどうか（背景は False）
+            angle: 左右反転した後に回転する角度（pg.transform.rotate() と同じ向き）
+        """
+        key = (path, size, flip, angle)
+        img = self._cache.get(key)
+        if img is not None:
+            self.hits += 1
+            return img
+
+        self.misses += 1
+        packed = self.pack.surface(key) if self.pack is not None else None
+        if packed is not None:
+            self.unpacked += 1
+            if not alpha:
+                img = packed.convert()
+            else:
+                img = packed if self.native else packed.convert_alpha()
+        elif angle:
+            img = pg.transform.rotate(self.image(path, size, flip, fallback, alpha), angle)
+        elif flip:
+            img = pg.transform.flip(self.image(path, size, False, fallback, alpha), True, False)
+        else:
+            self.loads += 1
+            try:
+                loaded = pg.image.load(resource_path(path))
+                loaded = loaded.convert_alpha() if alpha else loaded.convert()
+                img = pg.transform.scale(loaded, size)
+            except:
+                img = pg.Surface(size, pg.SRCALPHA) if alpha else pg.Surface(size)
+                img.fill(fallback)
+        self._cache[key] = img
+        return img
+
+    def mask(self, path: str, size: tuple[int, int], flip: bool = False,
+             fallback: tuple = (255, 0, 255, 255)) -> pg.mask.Mask:
+        """画像の不透明な部分のマスク（画像と同じキーで一度だけ作る）"""
+        key = (path, size, flip, 0)
+        mask = self._masks.get(key)
+        if mask is None:
+            mask = pg.mask.from_surface(self.image(path, size, flip, fallback))
+            self._masks[key] = mask
+        return mask
+
+    def stats(self) -> dict[str, int]:
+        """読み込み状況"""
+        return {"hits": self.hits, "misses": self.misses, "loads": self.loads,
+                "unpacked": self.unpacked, "cached": len(self._cache), "masks": len(self._masks)}
+
+    def clear(self) -> None:
+        """キャッシュを捨てる（カウンタはそのまま）"""
+        self._cache.clear()
+        self._masks.clear()
+
+
+def write_asset_pack(path: str, manifest) -> tuple[int, int]:
+    """
+    manifest の画像を元のファイルから作り、1つのパックに書き出す（画面を作ってから呼ぶ）。
+    読み込めない画像は入れない（ゲームでは元のファイルと同じく代わりの色になる）。
+
+    Args:
+        path: 書き出すファイル
+        manifest: (AssetRegistry のキー, 透過の有無) の並び
+
+    Returns:
+        (入れた画像の数, ファイルの大きさ)
+    """
+    registry = AssetRegistry()  # パックを使わずに元のファイルから作る
+    sources: dict[str, tuple[int, int, str] | None] = {}
+    entries = {}
+    blobs = []
+    offset = 0
+    for key, alpha in manifest:
+        source = key[0]
+        if source not in sources:
+            try:
+                pg.image.load(resource_path(source))
+                sources[source] = source_signature(source)
+            except (OSError, pg.error) as e:
+                print(f"[asset pack] {source} : {e}")
+                sources[source] = None
+        if sources[source] is None or key in entries:
+            continue
+        file, size, flip, angle = key
+        surf = registry.image(file, size, flip, alpha=alpha, angle=angle)
+        blob = pg.image.tobytes(surf, "BGRA")
+        entries[key] = (offset, *surf.get_size())
+        blobs.append(blob)
+        offset += pack_align(len(blob))
+
+    index = json.dumps({
+        "sources": {k: v for k, v in sources.items() if v is not None},
+        "entries": [[*key, *entry] for key, entry in entries.items()],
+    }, ensure_ascii=False, separators=(",", ":")).encode()
+    header = PACK_HEADER.pack(PACK_MAGIC, PACK_VERSION, len(index))
+    # 遊んでいるゲームがマップしたままでも壊さないように、別名で書いてから置き換える
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as fp:
+        fp.write(header + index)
+        fp.write(bytes(pack_align(len(header) + len(index)) - len(header) - len(index)))
+        for blob in blobs:
+            fp.write(blob)
+            fp.write(bytes(pack_align(len(blob)) - len(blob)))
+        total = fp.tell()
+    os.replace(tmp, path)
+    return len(entries), total
+
+
+ASSETS = AssetRegistry()
+
 
 # =====================
 # ステージ定義
@@ -99,16 +535,645 @@ stage_files = [
     ("繁華街(夜)", "3Dオリジナル背景作品 格闘ゲーム用背景.jpg")
 ]
 
-for name, filename in stage_files:
+# 読み込んだステージ背景を置いておく上限（バイト）。超えたら古いものから捨てる
+STAGE_CACHE_BYTES = 16 * 1024 * 1024
+# 背景1枚の大きさの目安（32bit）
+STAGE_IMAGE_BYTES = WIDTH * HEIGHT * 4
+STAGE_FALLBACK = (50, 50, 80)
+
+
+class Stage:
+    """ステージ。背景画像は STAGE_LOADER が必要になったときに読み込む"""
+
+    def __init__(self, name: str, filename: str) -> None:
+        self.name = name
+        self.filename = filename
+
+    @property
+    def bg(self) -> pg.Surface:
+        """背景画像（まだ読み込んでいなければ、ここで読み込むまで待つ）"""
+        return STAGE_LOADER.get(self)
+
+    def peek(self) -> pg.Surface | None:
+        """背景画像（読み込み済みのときだけ。待たない）"""
+        return STAGE_LOADER.peek(self)
+
+
+def load_stage_image(filename: str) -> pg.Surface:
+    """
+    背景画像を読み込んで画面の大きさにする（画像パックにあればそこから）。
+    読み込み用のスレッドから呼ぶので convert() はしない（StageLoader が後でする）。
+    """
+    if ASSETS.pack is not None:
+        img = ASSETS.pack.surface((filename, (WIDTH, HEIGHT), False, 0))
+        if img is not None:
+            return img
     try:
-        bg = pg.transform.scale(
-            pg.image.load(filename).convert(),
-            (WIDTH, HEIGHT)
-        )
-    except:
-        bg = pg.Surface((WIDTH, HEIGHT))
-        bg.fill((50, 50, 80))
-    STAGES.append({"name": name, "bg": bg})
+        return pg.transform.scale(pg.image.load(resource_path(filename)), (WIDTH, HEIGHT))
+    except Exception as e:
+        print(f"[stage load error] {filename} : {e}")
+        img = pg.Surface((WIDTH, HEIGHT))
+        img.fill(STAGE_FALLBACK)
+        return img
+
+
+def stage_priority(selected: int) -> list[Stage]:
+    """選択画面でカーソルに近い順にステージを並べる（一覧は上下でつながっている）"""
+    rows = len(STAGES) + 1  # 最後の行は「ゲーム終了」
+    order = sorted(range(len(STAGES)),
+                   key=lambda i: min((i - selected) % rows, (selected - i) % rows))
+    return [STAGES[i] for i in order]
+
+
+class StageLoader:
+    """
+    ステージ背景を読み込み、合計 cap バイトまで置いておく。
+    prefetch() で渡した順に、別スレッドで先読みする（入りきる枚数まで）。
+    入りきらなくなったら、しばらく使っていないものから捨てる。
+    """
+
+    def __init__(self, cap: int = STAGE_CACHE_BYTES) -> None:
+        self.cap = cap
+        self.cache: OrderedDict[Stage, pg.Surface] = OrderedDict()  # 使った順（古い順）
+        self.raw: dict[Stage, pg.Surface] = {}  # スレッドが読んだ、まだ convert() していないもの
+        self.wanted: list[Stage] = []
+        self.pinned = None  # 捨てないステージ（選択中のもの）
+        self.loading = None  # スレッドが読み込み中のステージ
+        self.cond = threading.Condition()
+        self.thread = None
+        # 統計
+        self.loads = 0  # 読み込んだ回数
+        self.sync_loads = 0  # 先読みが間に合わず、その場で読み込んだ回数
+        self.evictions = 0
+
+    def start(self) -> None:
+        """先読みのスレッドを動かす"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._worker, name="stage-loader", daemon=True)
+            self.thread.start()
+
+    def prefetch(self, stages: list[Stage], pinned: Stage | None = None) -> None:
+        """stages の順に先読みする（前の指定は取り消す）"""
+        budget = max(1, self.cap // STAGE_IMAGE_BYTES)
+        stages = stages[:budget]
+        with self.cond:
+            if stages == self.wanted and pinned is self.pinned:
+                return
+            self.wanted = stages
+            self.pinned = pinned
+            self.cond.notify_all()
+
+    def peek(self, stage: Stage) -> pg.Surface | None:
+        """読み込み済みなら背景を返す（待たない）"""
+        with self.cond:
+            return self._take(stage)
+
+    def get(self, stage: Stage) -> pg.Surface:
+        """背景を返す。まだなら読み込む（スレッドが読み込み中ならそれを待つ）"""
+        with self.cond:
+            while self.loading is stage:
+                self.cond.wait()
+            surf = self._take(stage)
+            if surf is not None:
+                return surf
+            self.sync_loads += 1
+        raw = load_stage_image(stage.filename)
+        with self.cond:
+            self.loads += 1
+            if stage not in self.cache:
+                self.raw[stage] = raw
+            return self._take(stage)
+
+    def memory(self) -> int:
+        """置いている背景の合計バイト数"""
+        return sum(s.get_pitch() * s.get_height()
+                   for table in (self.cache, self.raw) for s in table.values())
+
+    def stats(self) -> dict[str, int]:
+        """読み込み状況"""
+        return {"loads": self.loads, "sync_loads": self.sync_loads,
+                "evictions": self.evictions, "cached": len(self.cache) + len(self.raw),
+                "bytes": self.memory()}
+
+    def _take(self, stage: Stage) -> pg.Surface | None:
+        """（cond を持った状態で呼ぶ）置いてある背景を取り出して、最近使ったことにする"""
+        surf = self.cache.get(stage)
+        if surf is not None:
+            self.cache.move_to_end(stage)
+            return surf
+        raw = self.raw.pop(stage, None)
+        if raw is None:
+            return None
+        surf = self.cache[stage] = raw.convert()
+        self._evict(stage)
+        return surf
+
+    def _evict(self, keep: Stage) -> None:
+        """（cond を持った状態で呼ぶ）上限を超えていたら、古いものから捨てる"""
+        while self.memory() > self.cap:
+            victim = next((s for s in self.cache if s is not keep and s is not self.pinned), None)
+            if victim is None:
+                victim = next((s for s in self.raw if s is not keep and s is not self.pinned), None)
+                if victim is None:
+                    return
+                del self.raw[victim]
+            else:
+                del self.cache[victim]
+            self.evictions += 1
+
+    def _worker(self) -> None:
+        while True:
+            with self.cond:
+                while True:
+                    stage = next((s for s in self.wanted
+                                  if s not in self.cache and s not in self.raw), None)
+                    if stage is not None:
+                        break
+                    self.cond.wait()
+                self.loading = stage
+            raw = load_stage_image(stage.filename)
+            with self.cond:
+                self.loading = None
+                self.loads += 1
+                if stage not in self.cache:
+                    self.raw[stage] = raw
+                    self._evict(stage)
+                self.cond.notify_all()
+
+
+STAGE_LOADER = StageLoader()
+
+
+# =====================
+# 起動時間の計測
+# =====================
+class StartupTrace:
+    """起動から最初の画面を出すまでの時間を段階ごとに記録する"""
+
+    def __init__(self, start: float = STARTUP_STARTED) -> None:
+        self.start = start
+        # pygame の import は、このモジュールの import と分けて表示する
+        self.steps: list[tuple[str, float]] = [("pygame load", (PYGAME_IMPORTED - start) * 1000)]
+        self.last = PYGAME_IMPORTED
+
+    def step(self, name: str) -> None:
+        """前の step() から今までを name の時間にする"""
+        now = time.perf_counter()
+        self.steps.append((name, (now - self.last) * 1000))
+        self.last = now
+
+    def report(self) -> None:
+        for name, ms in self.steps:
+            print(f"[startup] {name:<12}{ms:8.1f} ms")
+        print(f"[startup] {'total':<12}{(self.last - self.start) * 1000:8.1f} ms")
+
+
+# =====================
+# 画面の初期化
+# =====================
+def init_audio() -> bool:
+    """音声を初期化し、BGM を先読みし始める（使えない環境では BGM なしで続ける）"""
+    try:
+        pg.mixer.init()
+    except pg.error as e:
+        print(f"[audio init error] {e}")
+        return False
+    AUDIO.start()
+    AUDIO.preload(MENU_BGM)
+    AUDIO.preload(BATTLE_BGM)
+    return True
+
+
+def init_display(trace: StartupTrace | None = None) -> None:
+    """
+    pygame を初期化し、ウィンドウ・フォント・タイトル画像・音声を用意する。
+    import しただけでは何もしないので、画面を使う前に1回呼ぶ。
+
+    Args:
+        trace: 渡すと段階ごとの時間を記録する
+    """
+    global clock, FONT_BIG, FONT_MED, FONT_SMALL, TITLE_BG
+
+    # 使うモジュールだけ初期化する（pg.init() は使わないものまで初期化して遅い）
+    pg.display.init()
+    pg.font.init()
+    if trace:
+        trace.step("pygame")
+
+    set_display_mode(FULLSCREEN)
+    pg.display.set_caption("こうかとん ファイター")
+    clock = pg.time.Clock()
+    if trace:
+        trace.step("display")
+
+    # フォントの作成
+    FONT_BIG = load_font(80)
+    FONT_MED = load_font(36)
+    FONT_SMALL = load_font(13)
+    if trace:
+        trace.step("fonts")
+
+    # 画像パックがあれば開き、最初の画面に使うタイトル画像だけ読み込む。
+    # ステージ背景は別スレッドで先読みし、ファイターや飛び道具は対戦の前に読み込む
+    if ASSET_PACK:
+        ASSETS.open_pack(resource_path(ASSET_PACK))
+    TITLE_BG = ASSETS.image(TITLE_IMAGE, (WIDTH, HEIGHT), fallback=(20, 20, 50), alpha=False)
+    STAGES.clear()
+    STAGES.extend(Stage(name, filename) for name, filename in stage_files)
+    STAGE_LOADER.prefetch(stage_priority(0))
+    STAGE_LOADER.start()
+    if trace:
+        trace.step("images")
+
+    init_audio()
+    if trace:
+        trace.step("audio")
+
+
+# =====================
+# 描画の解像度
+# =====================
+# 対戦やメニューの座標はすべて WIDTH×HEIGHT（論理座標）で扱い、描くときだけ RENDER_SCALE 倍にする。
+# ステージ・ファイター・飛び道具の画像は最初から内部の解像度の大きさで作り、
+# メニュー・HUD・文字は論理座標で作った画像を作り直すときに1回だけ縮める。
+_present_rect = pg.Rect(0, 0, WIDTH, HEIGHT)  # ウィンドウの中で画面を出す場所
+_present_all = False  # 次の present() でウィンドウ全体を出すか（黒い帯を描き直したとき）
+
+
+def scale_size(size: tuple[int, int], scale: float) -> tuple[int, int]:
+    """大きさを scale 倍にする（1ピクセルより小さくはしない）"""
+    if scale == 1.0:
+        return tuple(size)
+    return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+
+def render_size(size: tuple[int, int]) -> tuple[int, int]:
+    """論理座標での大きさを内部の解像度での大きさにする"""
+    return scale_size(size, RENDER_SCALE)
+
+
+def render_pos(pos) -> tuple[int, int]:
+    """論理座標の点を内部の解像度での点にする"""
+    if RENDER_SCALE == 1.0:
+        return pos[0], pos[1]
+    return math.floor(pos[0] * RENDER_SCALE), math.floor(pos[1] * RENDER_SCALE)
+
+
+def render_rect(rect) -> pg.Rect:
+    """論理座標の矩形を、それを覆う内部の解像度での矩形にする"""
+    rect = pg.Rect(rect)
+    if RENDER_SCALE == 1.0:
+        return rect
+    left, top = render_pos(rect.topleft)
+    right = math.ceil(rect.right * RENDER_SCALE)
+    bottom = math.ceil(rect.bottom * RENDER_SCALE)
+    return pg.Rect(left, top, right - left, bottom - top)
+
+
+def to_render(surf: pg.Surface) -> pg.Surface:
+    """論理座標の大きさで作った画像（メニュー・HUD・文字）を内部の解像度にする"""
+    if RENDER_SCALE == 1.0:
+        return surf
+    return pg.transform.smoothscale(surf, render_size(surf.get_size()))
+
+
+def set_display_mode(fullscreen: bool, size: tuple[int, int] = (WIDTH, HEIGHT)) -> None:
+    """ウィンドウを作り直す（全画面ならデスクトップの大きさ、そうでなければ大きさを変えられる）"""
+    global window, FULLSCREEN
+    FULLSCREEN = fullscreen
+    if fullscreen:
+        window = pg.display.set_mode((0, 0), pg.FULLSCREEN)
+    else:
+        window = pg.display.set_mode(size, pg.RESIZABLE)
+    update_screen()
+
+
+def update_screen() -> None:
+    """
+    ウィンドウの大きさと RENDER_SCALE から描く先の screen を決める。
+    等倍でウィンドウも同じ大きさならウィンドウに直接描き（変わった場所だけ更新できる）、
+    そうでなければ内部の解像度の Surface に描いて present() で拡大する。
+    screen の中身は描き直しになる。
+    """
+    global screen, _present_rect, _present_all
+    window_size = window.get_size()
+    # 縦横比を保ってウィンドウに収まる大きさ（余りは黒い帯）
+    fit = min(window_size[0] / WIDTH, window_size[1] / HEIGHT)
+    _present_rect = pg.Rect((0, 0), (max(1, round(WIDTH * fit)), max(1, round(HEIGHT * fit))))
+    _present_rect.center = (window_size[0] // 2, window_size[1] // 2)
+    if RENDER_SCALE == 1.0 and window_size == (WIDTH, HEIGHT):
+        screen = window
+        return
+    size = render_size((WIDTH, HEIGHT))
+    if screen is None or screen is window or screen.get_size() != size:
+        screen = pg.Surface(size).convert()
+    window.fill((0, 0, 0))
+    _present_all = True  # 次の present() で黒い帯も出す
+
+
+def set_render_scale(scale: float) -> None:
+    """内部の解像度を変える（作っておいたメニュー画面は作り直す）"""
+    global RENDER_SCALE
+    RENDER_SCALE = scale
+    _menu_screens.clear()
+    update_screen()
+
+
+def present(rects=None) -> None:
+    """
+    描いた screen をウィンドウに出す（1フレームに1回呼ぶ）。
+
+    Args:
+        rects: 変わった矩形のリスト（None なら画面全体）。screen がウィンドウそのものの
+            ときだけ使い、拡大するときは画面全体を1回で拡大して出す
+    """
+    global _present_all
+    if screen is window:
+        if rects is None:
+            pg.display.update()
+        else:
+            pg.display.update(rects)
+        return
+    if _present_rect.size == screen.get_size():
+        window.blit(screen, _present_rect)
+    else:
+        pg.transform.scale(screen, _present_rect.size, window.subsurface(_present_rect))
+    if _present_all:
+        pg.display.update()
+        _present_all = False
+    else:
+        pg.display.update(_present_rect)
+
+
+def handle_display_event(event) -> bool:
+    """
+    ウィンドウの大きさが変わったとき・FULLSCREEN_KEY で全画面を切り替えたときに、描く先を決め直す。
+    画面を出すループはどれもイベントごとにこれを呼ぶ。
+
+    Returns:
+        描く先が変わったか（True なら画面全体を描き直す）
+    """
+    if event.type == pg.VIDEORESIZE:
+        update_screen()
+        return True
+    if event.type == pg.KEYDOWN and event.key == FULLSCREEN_KEY:
+        set_display_mode(not FULLSCREEN)
+        return True
+    return False
+
+
+def window_to_logical(pos: tuple[int, int]) -> tuple[int, int]:
+    """ウィンドウ上の点（マウスの位置）を論理座標にする"""
+    if screen is window:
+        return pos
+    rect = _present_rect
+    return ((pos[0] - rect.x) * WIDTH // rect.width,
+            (pos[1] - rect.y) * HEIGHT // rect.height)
+
+
+# =====================
+# 入力
+# =====================
+# 1フレーム分の入力をビットで表す。
+# 移動系は押しっぱなし、攻撃系はそのフレームで押された瞬間だけ立つ。
+IN_LEFT = 1 << 0
+IN_RIGHT = 1 << 1
+IN_JUMP = 1 << 2
+IN_DOWN = 1 << 3
+IN_PUNCH = 1 << 4
+IN_KICK = 1 << 5
+IN_BEAM = 1 << 6
+IN_BOMB = 1 << 7
+IN_THROW = 1 << 8
+
+INPUT_BITS = {
+    "left": IN_LEFT,
+    "right": IN_RIGHT,
+    "jump": IN_JUMP,
+    "down": IN_DOWN,
+    "punch": IN_PUNCH,
+    "kick": IN_KICK,
+    "beam": IN_BEAM,
+    "bomb": IN_BOMB,
+    "throw": IN_THROW,
+}
+HOLD_ACTIONS = ("left", "right", "jump", "down")
+PRESS_ACTIONS = ("punch", "kick", "beam", "bomb", "throw")
+HOLD_MASK = IN_LEFT | IN_RIGHT | IN_JUMP | IN_DOWN
+
+# 操作キー設定
+P1_KEYS = {
+    "left": pg.K_a,
+    "right": pg.K_d,
+    "jump": pg.K_w,
+    "down": pg.K_s,
+    "punch": pg.K_c,
+    "kick": pg.K_v,
+    "beam": pg.K_g,
+    "bomb": pg.K_h,
+    "throw": pg.K_t,
+}
+P2_KEYS = {
+    "left": pg.K_LEFT,
+    "right": pg.K_RIGHT,
+    "jump": pg.K_UP,
+    "down": pg.K_DOWN,
+    "punch": pg.K_PERIOD,
+    "kick": pg.K_SLASH,
+    "beam": pg.K_COLON,
+    "bomb": pg.K_SEMICOLON,
+    "throw": pg.K_RIGHTBRACKET,
+}
+P1_KEYS_TEXT = "P1: A/D=移動 W=ジャンプ S=しゃがみ C=パンチ V=キック G=手裏剣 H=螺旋丸 T=投げ"
+P2_KEYS_TEXT = "P2: ←/→=移動 ↑=ジャンプ ↓=しゃがみ .=パンチ /=キック :=手裏剣 ;=螺旋丸 ]=投げ"
+
+
+def read_input(keys: dict[str, int], key_lst, pressed_keys) -> int:
+    """
+    キーボードの状態を入力ビットに変換する。
+
+    Args:
+        keys: Fighter.keys の操作キー設定
+        key_lst: pygame.key.get_pressed() の結果
+        pressed_keys: このフレームで KEYDOWN になったキーの集合
+    """
+    bits = 0
+    for name in HOLD_ACTIONS:
+        if key_lst[keys[name]]:
+            bits |= INPUT_BITS[name]
+    for name in PRESS_ACTIONS:
+        if keys[name] in pressed_keys:
+            bits |= INPUT_BITS[name]
+    return bits
+
+
+# =====================
+# コマンド技
+# =====================
+# 方向はテンキーの数字で表す（相手のいる側が 6、反対側が 4、下が 2）。
+#   7 8 9
+#   4 5 6
+#   1 2 3
+# コマンド: (方向の並び, ボタン, 技)
+# 技は ("projectile", Projectile の種類) か ("attack", Attack.DATA の種類)。
+COMMAND_LIST = (
+    ("236", "punch", ("projectile", "beam")),
+    ("214", "punch", ("projectile", "bomb")),
+    ("623", "punch", ("attack", "uppercut")),
+    ("236236", "punch", ("projectile", "rasensyuriken")),
+)
+# キャラクターごとのコマンド（ないキャラクターは COMMAND_LIST を使う）
+CHARACTER_COMMANDS: dict[str, tuple] = {}
+
+COMMAND_STEP_FRAMES = 10  # 方向と方向の間の猶予フレーム
+COMMAND_PRESS_FRAMES = 10  # 最後の方向からボタンまでの猶予フレーム
+
+
+def build_direction_table() -> tuple[tuple[int, ...], tuple[int, ...]]:
+    """
+    移動の入力ビットからテンキーの方向への表を作る。
+
+    Returns:
+        (右が前の表, 左が前の表)。どちらも (入力ビット & HOLD_MASK) で引く
+    """
+    tables = []
+    for facing in (1, -1):
+        table = []
+        for bits in range(HOLD_MASK + 1):
+            x = (1 if bits & IN_RIGHT else 0) - (1 if bits & IN_LEFT else 0)
+            y = (1 if bits & IN_JUMP else 0) - (1 if bits & IN_DOWN else 0)
+            table.append(5 + x * facing + 3 * y)
+        tables.append(tuple(table))
+    return tables[0], tables[1]
+
+
+DIRECTION_TABLE = build_direction_table()
+
+
+class CommandAutomaton:
+    """
+    コマンドの方向の並びをまとめた Aho-Corasick のオートマトン。
+    方向が変わるたびに表を1回引けば、それまでの並びの末尾に一致するコマンドが
+    わかるので、コマンドをいくつ登録しても1フレームの手間は変わらない。
+    """
+
+    def __init__(self, commands) -> None:
+        """
+        Args:
+            commands: (方向の並び, ボタン, 技) の並び
+        """
+        goto: list[dict[int, int]] = [{}]
+        outputs: list[list] = [[]]
+        for motion, button, action in commands:
+            state = 0
+            for ch in motion:
+                direction = int(ch)
+                if direction not in goto[state]:
+                    goto[state][direction] = len(goto)
+                    goto.append({})
+                    outputs.append([])
+                state = goto[state][direction]
+            outputs[state].append((len(motion), INPUT_BITS[button], action))
+
+        # 失敗したときの戻り先をたどって、全部の遷移を埋めた表にする
+        fail = [0] * len(goto)
+        delta = [[0] * 10 for _ in goto]
+        pending = []
+        for direction, child in goto[0].items():
+            delta[0][direction] = child
+            pending.append(child)
+        for state in pending:  # 浅い順に処理する
+            outputs[state] += outputs[fail[state]]
+            for direction in range(10):
+                child = goto[state].get(direction)
+                if child is None:
+                    delta[state][direction] = delta[fail[state]][direction]
+                else:
+                    fail[child] = delta[fail[state]][direction]
+                    delta[state][direction] = child
+                    pending.append(child)
+
+        self.delta = tuple(d for row in delta for d in row)  # delta[状態 * 10 + 方向]
+        # 長いコマンドを優先する（236236P は 236P より先に調べる）
+        self.outputs = tuple(tuple(sorted(out, key=lambda o: -o[0])) for out in outputs)
+        self.max_length = max((len(motion) for motion, _, _ in commands), default=1)
+
+    _cache: dict[str, "CommandAutomaton"] = {}
+
+    @classmethod
+    def for_character(cls, char_name: str) -> "CommandAutomaton":
+        """キャラクターのコマンドのオートマトン（キャラクターごとに1つを共有する）"""
+        automaton = cls._cache.get(char_name)
+        if automaton is None:
+            automaton = cls(CHARACTER_COMMANDS.get(char_name, COMMAND_LIST))
+            cls._cache[char_name] = automaton
+        return automaton
+
+
+class CommandReader:
+    """
+    ファイター1人分のコマンド入力の読み取り。
+    方向が変わったフレームを直近 max_length 個だけ輪状のバッファに残し、
+    ボタンが押されたときに猶予フレームに収まっているかを確かめる。
+    """
+
+    __slots__ = ("automaton", "state", "direction", "stamps", "count")
+
+    def __init__(self, automaton: CommandAutomaton) -> None:
+        self.automaton = automaton
+        self.state = 0
+        self.direction = 5
+        self.stamps = [0] * automaton.max_length  # 方向が変わったフレーム
+        self.count = 0  # これまでに記録した方向の数
+
+    def save_state(self) -> tuple:
+        return self.state, self.direction, tuple(self.stamps), self.count
+
+    def load_state(self, state: tuple) -> None:
+        self.state, self.direction, stamps, self.count = state
+        self.stamps[:] = stamps
+
+    def feed(self, frame: int, bits: int, side: int):
+        """
+        1フレーム分の入力を読み、成立したコマンドを返す。
+
+        Args:
+            frame: 今のフレーム番号
+            bits: 入力ビット
+            side: 前とみなす向き（1 なら右が前）
+
+        Returns:
+            (ボタンのビット, 技) か None
+        """
+        automaton = self.automaton
+        direction = DIRECTION_TABLE[side != 1][bits & HOLD_MASK]
+        if direction != self.direction:
+            self.direction = direction
+            # ニュートラルは並びに入れない（2→5→3→6 も 236 として読む）
+            if direction != 5:
+                self.state = automaton.delta[self.state * 10 + direction]
+                self.stamps[self.count % len(self.stamps)] = frame
+                self.count += 1
+
+        if not bits & ~HOLD_MASK:
+            return None
+        for length, button, action in automaton.outputs[self.state]:
+            if bits & button and self.in_time(frame, length):
+                self.state = 0  # 同じ入力で2回出ないように読み直す
+                return button, action
+        return None
+
+    def in_time(self, frame: int, length: int) -> bool:
+        """直近 length 個の方向とボタンが猶予フレームに収まっているか"""
+        stamps = self.stamps
+        size = len(stamps)
+        last = self.count - 1
+        if frame - stamps[last % size] > COMMAND_PRESS_FRAMES:
+            return False
+        for i in range(last, last - length + 1, -1):
+            if stamps[i % size] - stamps[(i - 1) % size] > COMMAND_STEP_FRAMES:
+                return False
+        return True
 
 
 # =====================
@@ -140,23 +1205,198 @@ class HurtBox(pg.sprite.Sprite):
             self.kill()
 
 # =====================
-# ノックバック関数
+# ファイター画像
 # =====================
-def apply_knockback(target, attacker, damage):
-    """ノックバックを適用"""
-    knockback = damage * 2
-    target.rect.x += knockback * attacker.facing
-    if abs(knockback) > 10:
-        target.vy = -8
-        target.on_ground = False
+# ポーズごとの画像ファイル名の末尾と表示サイズ。
+# 当たり判定はこのサイズから計算するので、画像がなくても対戦を進められる。
+FIGHTER_POSES = {
+    "idle": ("fighter", (150, 200)),
+    "punch": ("fighter_punch", (150, 200)),
+    "kick": ("fighter_kick", (190, 200)),
+    "crouch": ("fighter_crouch", (110, 150)),
+}
+# キャラクター名（画像は fig/{名前}{末尾}.png）。1P・2P・3人目…の順に繰り返し使う
+FIGHTER_CHARS = ("man", "woman")
+
+# 画像が読み込めなかったときの代わりの色
+FIGHTER_FALLBACK_COLORS = {
+    "idle": (255, 100, 100, 255),
+    "punch": (255, 100, 100, 255),
+    "kick": (100, 255, 100, 255),
+    "crouch": (100, 100, 255, 255),
+}
+
+
+# 攻撃中に前に出る手足のくらい判定: ポーズ名: (大きさ, (前方向, 上方向) のずれ)
+ATTACK_HURTBOXES = {
+    "punch": ((65, 30), (70, 60)),
+    "kick": ((85, 35), (70, -60)),
+}
+
+
+def place_in_front(size: tuple[int, int], offset: tuple[int, int],
+                   fighter_rect: pg.Rect, facing: int) -> pg.Rect:
+    """
+    ファイターの中心から前方向・上方向にずらした位置に矩形を置く。
+
+    Args:
+        size: 矩形の大きさ
+        offset: (前方向, 上方向) のずれ
+        fighter_rect: ファイターの矩形
+        facing: ファイターの向き
+    """
+    rect = pg.Rect((0, 0), size)
+    rect.center = (fighter_rect.centerx + offset[0] * facing, fighter_rect.centery - offset[1])
+    return rect
+
+
+def load_fighter_sprites(char_name: str) -> dict[str, tuple[pg.Surface, pg.Surface]]:
+    """
+    ファイターの画像を内部の解像度（RENDER_SCALE）の大きさで読み込む。
+
+    Args:
+        char_name: キャラクター名
+
+    Returns:
+        {ポーズ名: (右向き画像, 左向き画像)}
+    """
+    sprites = {}
+    for pose, (suffix, size) in FIGHTER_POSES.items():
+        path = f"fig/{char_name}{suffix}.png"
+        color = FIGHTER_FALLBACK_COLORS[pose]
+        size = render_size(size)
+        sprites[pose] = (ASSETS.image(path, size, False, color),
+                         ASSETS.image(path, size, True, color))
+    return sprites
+
+
+def load_fighter_masks(char_name: str) -> dict[str, tuple[pg.mask.Mask, pg.mask.Mask]]:
+    """
+    ファイターの画像のマスクを作る（精密な当たり判定用）。
+
+    Returns:
+        {ポーズ名: (右向きのマスク, 左向きのマスク)}
+    """
+    masks = {}
+    for pose, (suffix, size) in FIGHTER_POSES.items():
+        path = f"fig/{char_name}{suffix}.png"
+        color = FIGHTER_FALLBACK_COLORS[pose]
+        masks[pose] = (ASSETS.mask(path, size, False, color),
+                       ASSETS.mask(path, size, True, color))
+    return masks
+
+
+# =====================
+# 状態のスナップショット
+# =====================
+def as_tuple(value):
+    """JSON から戻したリストを（入れ子も）タプルにする"""
+    if isinstance(value, list):
+        return tuple(as_tuple(v) for v in value)
+    return value
+
+
+class State:
+    """
+    スナップショットの基底クラス。__slots__ に並べた値（数値・文字列・タプル）だけを持つ。
+    Surface などは入れないので、コピーも pickle も軽い。比較と pickle は値のタプルで行う。
+    """
+
+    __slots__ = ()
+
+    def values(self) -> tuple:
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def to_plain(self) -> dict:
+        """名前と値の辞書にする（リプレイのキーフレームに JSON で書く）"""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_plain(cls, data: dict) -> "State":
+        """to_plain() の結果（JSON から戻したもの）から作る"""
+        state = cls.__new__(cls)
+        for name in cls.__slots__:
+            setattr(state, name, as_tuple(data[name]))
+        return state
+
+    def __getstate__(self) -> tuple:
+        return self.values()
+
+    def __setstate__(self, values: tuple) -> None:
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def __eq__(self, other) -> bool:
+        return type(other) is type(self) and self.values() == other.values()
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class FighterState(State):
+    """Fighter の状態（矩形はタプルで持つ）"""
+
+    # Fighter の同じ名前の属性をそのままコピーするもの
+    VALUES = ("vx", "vy", "on_ground", "hp", "facing", "energy", "throw_cool", "pose",
+              "is_guarding", "is_crouching", "is_attacking", "attack_timer", "recover_timer")
+    __slots__ = ("rect", "hurtbox", "attack_hurtbox", "commands") + VALUES
+
+
+class AttackState(State):
+    """Attack の状態（owner は Battle.fighters の添字）"""
+
+    __slots__ = ("owner", "atk_type", "rect", "life", "damage")
+
+    def __init__(self, owner: int, atk_type: str, rect: tuple, life: int, damage: int) -> None:
+        self.owner = owner
+        self.atk_type = atk_type
+        self.rect = rect
+        self.life = life
+        self.damage = damage
+
+
+class ProjectileState(State):
+    """Projectile の状態（owner は Battle.fighters の添字）"""
+
+    __slots__ = ("owner", "kind", "facing", "angle", "rect", "hitbox")
+
+    def __init__(self, owner: int, kind: str, facing: int, angle: int,
+                 rect: tuple, hitbox: tuple) -> None:
+        self.owner = owner
+        self.kind = kind
+        self.facing = facing
+        self.angle = angle
+        self.rect = rect
+        self.hitbox = hitbox
+
+
+def restore_group(group: pg.sprite.Group, states, fighters, create) -> None:
+    """
+    グループの中身を states に合わせる。今あるスプライトは作り直さずに
+    load_state() で上書きし、足りない分だけ create(state, owner) で作る。
+    並び順（当たり判定の順番）は states の順になる。
+    """
+    sprites = group.sprites()
+    for sprite, state in zip(sprites, states):
+        sprite.load_state(state, fighters[state.owner])
+    if len(sprites) > len(states):
+        group.remove(*sprites[len(states):])
+    else:
+        group.add(*[create(state, fighters[state.owner]) for state in states[len(sprites):]])
+
 
 # =====================
 # Fighter クラス
 # =====================
+ENERGY_REGEN = 0.1  # 1フレームに回復するエネルギー
+
+
 class Fighter(pg.sprite.Sprite):
     """
     プレイヤーキャラクターを表すクラス。
     移動・ジャンプ・攻撃・防御・しゃがみの状態を管理する。
+    画像は描画で image を参照したときに初めて読み込む。
     """
 
     def __init__(self, x: int, keys: dict[str, int], char_name: str) -> None:
@@ -169,59 +1409,18 @@ class Fighter(pg.sprite.Sprite):
             char_name: キャラクター名
         """
         super().__init__()
-        self.energy = 100  # 追加：エネルギー
-        self.throw_cool = 0  # 追加：投げクールダウン
-        self.energy_regen = 0.1  # エネルギー回復速度
-
         # エネルギーと投げ技
         self.energy = 100
-        self.throw_cool = 0
-        self.energy_regen = 0.1
-
-        # ===== 画像読み込み =====
-        try:
-            self.idle_r = pg.transform.scale(
-                pg.image.load(f"fig/{char_name}fighter.png").convert_alpha(),
-                (150, 200)
-            )
-        except:
-            self.idle_r = pg.Surface((150, 200), pg.SRCALPHA)
-            self.idle_r.fill((255, 100, 100, 255))
-        self.idle_l = pg.transform.flip(self.idle_r, True, False)
-
-        try:
-            self.punch_r = pg.transform.scale(
-                pg.image.load(f"fig/{char_name}fighter_punch.png").convert_alpha(),
-                (150, 200)
-            )
-        except:
-            self.punch_r = self.idle_r.copy()
+        self.throw_cool = 0  # 投げクールダウン
+        self.energy_regen = ENERGY_REGEN  # エネルギー回復速度
 
-        self.punch_l = pg.transform.flip(self.punch_r, True, False)
+        # ===== 画像 =====
+        self.char_name = char_name
+        self.sprites = None
+        self.masks = None
+        self.pose = "idle"
 
-        try:
-            self.kick_r = pg.transform.scale(
-                pg.image.load(f"fig/{char_name}fighter_kick.png").convert_alpha(),
-                (190, 200)
-            )
-        except:
-            self.kick_r = pg.Surface((190, 200), pg.SRCALPHA)
-            self.kick_r.fill((100, 255, 100, 255))
-        self.kick_l = pg.transform.flip(self.kick_r, True, False)
-        
-        try:
-            self.crouch_r = pg.transform.scale(
-                pg.image.load(f"fig/{char_name}fighter_crouch.png").convert_alpha(),
-                (110, 150)
-            )
-        except:
-            self.crouch_r = pg.Surface((150, 140), pg.SRCALPHA)
-            self.crouch_r.fill((100, 100, 255, 255))
-
-        self.crouch_l = pg.transform.flip(self.crouch_r, True, False)
-
-        self.image = self.idle_r
-        self.rect = self.image.get_rect()
+        self.rect = pg.Rect((0, 0), FIGHTER_POSES["idle"][1])
         self.rect.bottomleft = (x, FLOOR)
 
         # ===== HurtBox =====
@@ -249,6 +1448,49 @@ class Fighter(pg.sprite.Sprite):
         self.attack_timer: int = 0
         self.recover_timer: int = 0
 
+        # コマンド入力
+        self.commands = CommandReader(CommandAutomaton.for_character(char_name))
+
+    @property
+    def image(self) -> pg.Surface:
+        """現在のポーズと向きに対応する画像（内部の解像度の大きさ。描画にだけ使う）"""
+        if self.sprites is None:
+            self.sprites = load_fighter_sprites(self.char_name)
+        return self.sprites[self.pose][0 if self.facing == 1 else 1]
+
+    @property
+    def mask(self) -> pg.mask.Mask:
+        """現在の画像のマスク（精密な当たり判定で rect と合わせて使う）"""
+        if self.masks is None:
+            self.masks = load_fighter_masks(self.char_name)
+        return self.masks[self.pose][0 if self.facing == 1 else 1]
+
+    def resize_for_pose(self, pose: str) -> None:
+        """ポーズの画像サイズに合わせて矩形を作り直す（足元の位置は保つ）"""
+        midbottom = self.rect.midbottom
+        self.rect = pg.Rect((0, 0), FIGHTER_POSES[pose][1])
+        self.rect.midbottom = midbottom
+
+    def save_state(self) -> FighterState:
+        """状態を値だけのスナップショットにする（画像や操作キーは含まない）"""
+        state = FighterState()
+        for name in FighterState.VALUES:
+            setattr(state, name, getattr(self, name))
+        state.rect = tuple(self.rect)
+        state.hurtbox = tuple(self.hurtbox)
+        state.attack_hurtbox = tuple(self.attack_hurtbox) if self.attack_hurtbox else None
+        state.commands = self.commands.save_state()
+        return state
+
+    def load_state(self, state: FighterState) -> None:
+        """save_state() の結果から状態を戻す"""
+        for name in FighterState.VALUES:
+            setattr(self, name, getattr(state, name))
+        self.rect = pg.Rect(state.rect)
+        self.hurtbox = pg.Rect(state.hurtbox)
+        self.attack_hurtbox = pg.Rect(state.attack_hurtbox) if state.attack_hurtbox else None
+        self.commands.load_state(state.commands)
+
     def update_hurtbox(self):
         """本体のくらい判定を更新"""
         self.hurtbox.centerx = self.rect.centerx
@@ -260,28 +1502,20 @@ class Fighter(pg.sprite.Sprite):
             self.attack_hurtbox = None
             return
 
-        if self.image in (self.punch_r, self.punch_l):
-            w, h = 65, 30
-            offset_x = 70 if self.facing == 1 else -70
-            offset_y = 60
-        elif self.image in (self.kick_r, self.kick_l):
-            w, h = 85, 35
-            offset_x = 70 if self.facing == 1 else -70
-            offset_y = -60
-        else:
+        box = ATTACK_HURTBOXES.get(self.pose)
+        if box is None:
             self.attack_hurtbox = None
             return
 
-        self.attack_hurtbox = pg.Rect(0, 0, w, h)
-        self.attack_hurtbox.centerx = self.rect.centerx + offset_x
-        self.attack_hurtbox.centery = self.rect.centery - offset_y
+        size, offset = box
+        self.attack_hurtbox = place_in_front(size, offset, self.rect, self.facing)
 
-    def update(self, key_lst: list[bool], enemy: "Fighter" = None) -> None:
+    def update(self, held: int, enemy: "Fighter" = None) -> None:
         """
         キャラクターの状態更新を行う。
 
         Args:
-            key_lst: pygame.key.get_pressed() の結果
+            held: 入力ビット（read_input() の結果）
             enemy: 対戦相手の Fighter
         """
         self.vx = 0
@@ -310,59 +1544,56 @@ class Fighter(pg.sprite.Sprite):
         # =====================
         # しゃがみ処理
         # =====================
-        if key_lst[self.keys["down"]] and self.on_ground and can_move:
+        if held & IN_DOWN and self.on_ground and can_move:
             if not self.is_crouching:
                 self.is_crouching = True
-                old_bottom = self.rect.bottom
-                self.image = self.crouch_r if self.facing == 1 else self.crouch_l
-                self.rect = self.image.get_rect(
-                    midbottom=(self.rect.centerx, old_bottom)
-                )
+                self.pose = "crouch"
+                self.resize_for_pose("crouch")
         else:
             if self.is_crouching:
                 self.is_crouching = False
-                self.image = self.idle_r if self.facing == 1 else self.idle_l
-                self.rect = self.image.get_rect(midbottom=self.rect.midbottom)
+                self.pose = "idle"
+                self.resize_for_pose("idle")
 
         # =====================
         # 防御処理（攻撃中・しゃがみ中は不可）
         # =====================
         if not self.is_attacking and not self.is_crouching and enemy and can_move:
-            back_key = (
-                self.keys["left"]
+            back_bit = (
+                IN_LEFT
                 if enemy.rect.centerx > self.rect.centerx
-                else self.keys["right"]
+                else IN_RIGHT
             )
 
-            if key_lst[back_key]:
+            if held & back_bit:
                 self.is_guarding = True
                 self.vx = (
-                    -1 if back_key == self.keys["left"] else 1
+                    -1 if back_bit == IN_LEFT else 1
                 ) * (self.walk_speed // 2)
 
         # =====================
         # 通常移動
         # =====================
         if not self.is_guarding and not self.is_crouching and can_move:
-            if key_lst[self.keys["left"]]:
+            if held & IN_LEFT:
                 self.vx = -self.walk_speed
                 self.facing = -1
-            if key_lst[self.keys["right"]]:
+            if held & IN_RIGHT:
                 self.vx = self.walk_speed
                 self.facing = 1
 
         # =====================
         # ジャンプ
         # =====================
-        if (key_lst[self.keys["jump"]] and self.on_ground and 
+        if (held & IN_JUMP and self.on_ground and
             not self.is_crouching and can_move):
             self.vy = -20
             self.on_ground = False
 
         # 待機画像更新
-        if (self.attack_timer == 0 and self.recover_timer == 0 and 
+        if (self.attack_timer == 0 and self.recover_timer == 0 and
             not self.is_crouching):
-            self.image = self.idle_r if self.facing == 1 else self.idle_l
+            self.pose = "idle"
 
         # =====================
         # 重力・位置更新
@@ -384,14 +1615,10 @@ class Fighter(pg.sprite.Sprite):
         if self.attack_timer > 0 or self.recover_timer > 0:
             return
 
-        if atk_type == "punch":
-            self.image = self.punch_r if self.facing == 1 else self.punch_l
-            self.attack_timer = 10
-            self.is_attacking = True
-        elif atk_type == "kick":
-            self.image = self.kick_r if self.facing == 1 else self.kick_l
-            self.attack_timer = 15
-            self.is_attacking = True
+        data = Attack.DATA[atk_type]
+        self.pose = data["pose"]
+        self.attack_timer = data["timer"]
+        self.is_attacking = True
 
         attacks.add(Attack(self, atk_type))
 
@@ -402,178 +1629,1481 @@ class Fighter(pg.sprite.Sprite):
 class Attack(pg.sprite.Sprite):
     """攻撃判定用のヒットボックスクラス"""
 
+    # pose: ファイターのポーズ  timer: 攻撃の硬直フレーム
+    # offset: ファイターの中心から判定の中心まで（前方向, 上方向）
+    DATA = {
+        "punch": {"size": (40, 20), "life": 6, "damage": 5, "pose": "punch", "timer": 10, "offset": (70, 60)},
+        "kick": {"size": (65, 25), "life": 8, "damage": 8, "pose": "kick", "timer": 15, "offset": (70, -60)},
+        "uppercut": {"size": (40, 70), "life": 8, "damage": 12, "pose": "punch", "timer": 20, "offset": (60, 80)},
+    }
+
+    # 攻撃判定の表示用画像（種類と内部の解像度ごと）とマスク（種類ごと）。1つを共有する
+    _images: dict[tuple[str, float], pg.Surface] = {}
+    _masks: dict[str, pg.mask.Mask] = {}
+
+    def __init__(self, fighter: Fighter, atk_type: str) -> None:
+        super().__init__()
+        self.owner = fighter
+        self.atk_type = atk_type
+        self.damage = self.DATA[atk_type]["damage"]
+
+        data = self.DATA[atk_type]
+        self.rect = place_in_front(data["size"], data["offset"], fighter.rect, fighter.facing)
+
+        self.life = self.DATA[atk_type]["life"]
+
+    @classmethod
+    def from_state(cls, state: AttackState, owner: Fighter) -> "Attack":
+        atk = cls(owner, state.atk_type)
+        atk.load_state(state, owner)
+        return atk
+
+    def save_state(self, owner: int) -> AttackState:
+        """状態をスナップショットにする（owner は持ち主の添字）"""
+        return AttackState(owner, self.atk_type, tuple(self.rect), self.life, self.damage)
+
+    def load_state(self, state: AttackState, owner: Fighter) -> None:
+        """save_state() の結果から状態を戻す"""
+        self.owner = owner
+        self.atk_type = state.atk_type
+        self.rect = pg.Rect(state.rect)
+        self.life = state.life
+        self.damage = state.damage
+
+    @property
+    def image(self) -> pg.Surface:
+        """攻撃判定の表示用画像（内部の解像度の大きさ）"""
+        key = (self.atk_type, RENDER_SCALE)
+        img = Attack._images.get(key)
+        if img is None:
+            img = pg.Surface(render_size(self.DATA[self.atk_type]["size"]), pg.SRCALPHA)
+            img.fill((255, 0, 0, 120))
+            Attack._images[key] = img
+        return img
+
+    @property
+    def mask(self) -> pg.mask.Mask:
+        """攻撃判定のマスク（矩形全体）"""
+        mask = Attack._masks.get(self.atk_type)
+        if mask is None:
+            mask = pg.mask.Mask(self.DATA[self.atk_type]["size"], fill=True)
+            Attack._masks[self.atk_type] = mask
+        return mask
+
+    def update(self) -> None:
+        """攻撃判定の寿命管理"""
+        self.life -= 1
+        if self.life <= 0:
+            self.kill()
+
+
+# =====================
+# 飛び道具
+# =====================
+def rotated_size(size: tuple[int, int], angle: float) -> tuple[int, int]:
+    """
+    pg.transform.rotate() で回転した画像の大きさを計算する。
+    Surface を作らずに回転後の矩形を求めるために使う。
+    """
+    w, h = size
+    if angle % 90 == 0:
+        return (w, h) if angle % 180 == 0 else (h, w)
+
+    rad = math.radians(angle)
+    cx, cy = math.cos(rad) * w, math.cos(rad) * h
+    sx, sy = math.sin(rad) * w, math.sin(rad) * h
+    new_w = int(max(abs(cx + sy), abs(cx - sy), abs(-cx + sy), abs(-cx - sy)))
+    new_h = int(max(abs(sx + cy), abs(sx - cy), abs(-sx + cy), abs(-sx - cy)))
+    return new_w, new_h
+
+
+class Projectile(pg.sprite.Sprite):
+    """飛び道具（手裏剣・螺旋丸・螺旋手裏剣）"""
+
     DATA = {
-        "punch": {"size": (40, 20), "life": 6, "damage": 5},
-        "kick": {"size": (65, 25), "life": 8, "damage": 8},
+        "beam": {
+            "file": "fig/syuriken.png", "size": (30, 30), "color": (255, 200, 0, 255),
+            "hitbox": (15, 15), "speed": 12, "damage": 10, "rotate_speed": 20,
+        },
+        "bomb": {
+            "file": "fig/rasengan1.png", "size": (80, 80), "color": (0, 150, 255, 255),
+            "hitbox": (40, 40), "speed": 8, "damage": 15, "rotate_speed": 0,
+        },
+        "rasensyuriken": {
+            "file": "fig/rasensyuriken.png", "size": (80, 80), "color": (255, 100, 0, 255),
+            "hitbox": (45, 45), "speed": 8, "damage": 30, "rotate_speed": 15,
+        },
     }
 
-    def __init__(self, fighter: Fighter, atk_type: str) -> None:
-        super().__init__()
-        self.owner = fighter
-        self.damage = self.DATA[atk_type]["damage"]
+    # 回転済み画像の一覧（種類・向き・倍率ごと）と、その大きさの一覧（種類ごと）。
+    # 角度 angle の画像は [angle // 刻み] 番目にある。全弾で共有し、一度だけ作る
+    _frames: dict[tuple[str, int, float], list[pg.Surface]] = {}
+    _masks: dict[tuple[str, int], list[pg.mask.Mask]] = {}
+    _sizes: dict[str, list[tuple[int, int]]] = {}
+
+    @classmethod
+    def angle_step(cls, kind: str) -> int:
+        """回転角度の刻み（この倍数の角度しか取らない）"""
+        return math.gcd(cls.DATA[kind]["rotate_speed"], 360)
+
+    @classmethod
+    def rotation_sizes(cls, kind: str) -> list[tuple[int, int]]:
+        """角度ごとの回転後の大きさ（Surface を作らずに計算する）"""
+        sizes = cls._sizes.get(kind)
+        if sizes is None:
+            size = cls.DATA[kind]["size"]
+            sizes = [rotated_size(size, a) for a in range(0, 360, cls.angle_step(kind))]
+            cls._sizes[kind] = sizes
+        return sizes
+
+    @classmethod
+    def rotation_frames(cls, kind: str, facing: int, scale: float = 1.0) -> list[pg.Surface]:
+        """
+        角度ごとの回転済み画像（初めて使うときに作る）。
+        描画には scale=RENDER_SCALE、マスクには論理座標の大きさ（scale=1.0）を使う。
+        """
+        key = (kind, facing, scale)
+        frames = cls._frames.get(key)
+        if frames is None:
+            data = cls.DATA[kind]
+            size = scale_size(data["size"], scale)
+            frames = [ASSETS.image(data["file"], size, facing == -1, data["color"], angle=a)
+                      for a in range(0, 360, cls.angle_step(kind))]
+            cls._frames[key] = frames
+        return frames
+
+    @classmethod
+    def rotation_masks(cls, kind: str, facing: int) -> list[pg.mask.Mask]:
+        """回転済み画像ごとのマスク（rotation_frames() と同じ並び）"""
+        masks = cls._masks.get((kind, facing))
+        if masks is None:
+            masks = [pg.mask.from_surface(f) for f in cls.rotation_frames(kind, facing)]
+            cls._masks[(kind, facing)] = masks
+        return masks
+
+    def __init__(self, fighter, kind):
+        super().__init__()
+        self.owner = fighter
+        self.set_kind(kind)
+        self.facing = fighter.facing
+        self.angle = 0
+
+        self.rect = pg.Rect((0, 0), self.size)
+        self.hitbox = pg.Rect(0, 0, *self.hitbox_size)
+
+        if self.facing == 1:
+            self.rect.midleft = fighter.rect.midright
+        else:
+            self.rect.midright = fighter.rect.midleft
+
+        self.hitbox.center = self.rect.center
+
+    def set_kind(self, kind: str) -> None:
+        """種類ごとに決まっている値を設定する"""
+        data = self.DATA[kind]
+        self.kind = kind
+        self.rot_step = self.angle_step(kind)
+        self.rot_sizes = self.rotation_sizes(kind)
+
+        self.size = data["size"]
+        self.hitbox_size = data["hitbox"]
+        self.speed = data["speed"]
+        self.damage = data["damage"]
+        self.rotate_speed = data["rotate_speed"]
+
+    @classmethod
+    def from_state(cls, state: ProjectileState, owner: Fighter) -> "Projectile":
+        proj = cls(owner, state.kind)
+        proj.load_state(state, owner)
+        return proj
+
+    def save_state(self, owner: int) -> ProjectileState:
+        """状態をスナップショットにする（owner は持ち主の添字）"""
+        return ProjectileState(owner, self.kind, self.facing, self.angle,
+                               tuple(self.rect), tuple(self.hitbox))
+
+    def load_state(self, state: ProjectileState, owner: Fighter) -> None:
+        """save_state() の結果から状態を戻す"""
+        if state.kind != self.kind:
+            self.set_kind(state.kind)
+        self.owner = owner
+        self.facing = state.facing
+        self.angle = state.angle
+        self.rect = pg.Rect(state.rect)
+        self.hitbox = pg.Rect(state.hitbox)
+
+    @property
+    def image(self) -> pg.Surface:
+        """現在の角度に回転した画像（内部の解像度の大きさ）"""
+        return self.rotation_frames(self.kind, self.facing, RENDER_SCALE)[self.angle // self.rot_step]
+
+    @property
+    def mask(self) -> pg.mask.Mask:
+        """現在の角度の画像のマスク"""
+        return self.rotation_masks(self.kind, self.facing)[self.angle // self.rot_step]
+
+    def update(self):
+        self.rect.x += self.speed * self.facing
+        self.hitbox.center = self.rect.center
+
+        if self.rotate_speed != 0:
+            self.angle = (self.angle + self.rotate_speed) % 360
+            center = self.rect.center
+            self.rect.size = self.rot_sizes[self.angle // self.rot_step]
+            self.rect.center = center
+            self.hitbox.center = center
+
+        if self.rect.right < 0 or self.rect.left > WIDTH:
+            self.kill()
+
+
+# =====================
+# 投げ技
+# =====================
+THROW_DAMAGE = 20
+THROW_COOLDOWN = 40  # 投げたあと次に投げられるまでのフレーム数
+
+
+def try_throw(attacker, defender):
+    """投げ技を試行"""
+    if attacker.throw_cool > 0:
+        return False
+
+    dist = abs(attacker.rect.centerx - defender.rect.centerx)
+    height = abs(attacker.rect.bottom - defender.rect.bottom)
+
+    if dist < 70 and height < 20:
+        defender.hp -= THROW_DAMAGE
+        knock = 140
+        defender.rect.x += knock * attacker.facing
+        defender.vy = -15
+        defender.on_ground = False
+        attacker.energy = min(100, attacker.energy + 10)
+        attacker.throw_cool = THROW_COOLDOWN
+        return True
+    return False
+
+
+# =====================
+# 弾幕（大量の飛び道具）
+# =====================
+# 弾幕モードで手裏剣ボタン1回で撃つ数と、1発のダメージ
+BARRAGE_VOLLEY = 300
+BARRAGE_DAMAGE = 1
+
+
+class ProjectileField:
+    """
+    大量の飛び道具を NumPy の配列でまとめて扱う（弾幕モード用）。
+    位置・速度・種類・持ち主・角度を種類ごとの配列に持ち、
+    移動・画面外の削除・当たり判定を配列演算で一度に行う。
+    """
+
+    KINDS = tuple(Projectile.DATA)
+
+    def __init__(self, capacity: int = 1024, seed: int = 0) -> None:
+        self.rng = np.random.default_rng(seed)
+        self.count = 0
+        self.alloc(capacity)
+
+        # 種類ごとの表（回転後の大きさは角度 0〜359 すべてについて持つ）
+        n = len(self.KINDS)
+        self.rotate_speed = np.array([Projectile.DATA[k]["rotate_speed"] for k in self.KINDS], np.int16)
+        self.angle_step = np.array([Projectile.angle_step(k) for k in self.KINDS], np.int16)
+        self.hit_w = np.array([Projectile.DATA[k]["hitbox"][0] for k in self.KINDS], np.int32)
+        self.hit_h = np.array([Projectile.DATA[k]["hitbox"][1] for k in self.KINDS], np.int32)
+        self.size_w = np.zeros((n, 360), np.int32)
+        self.size_h = np.zeros((n, 360), np.int32)
+        for k, kind in enumerate(self.KINDS):
+            for a in range(360):
+                self.size_w[k, a], self.size_h[k, a] = rotated_size(Projectile.DATA[kind]["size"], a)
+
+    def alloc(self, capacity: int) -> None:
+        """配列を capacity 個分確保する（今ある弾は残す）"""
+        old = self.count
+        arrays = {
+            "x": np.float64, "y": np.float64, "vx": np.float64, "vy": np.float64,
+            "kind": np.int8, "owner": np.int8, "facing": np.int8,
+            "angle": np.int16, "damage": np.int16,
+        }
+        for name, dtype in arrays.items():
+            arr = np.zeros(capacity, dtype)
+            if old:
+                arr[:old] = getattr(self, name)[:old]
+            setattr(self, name, arr)
+        self.capacity = capacity
+
+    def clear(self) -> None:
+        self.count = 0
+
+    def spawn(self, x, y, vx, vy, kind: str, owner: int, facing: int, damage: int) -> None:
+        """
+        飛び道具をまとめて追加する。
+
+        Args:
+            x, y: 中心座標の配列
+            vx, vy: 速度の配列
+            kind: 種類（Projectile.DATA のキー）
+            owner: 撃ったファイターの番号（-1 なら誰にでも当たる）
+            facing: 画像の向き
+            damage: 1発のダメージ
+        """
+        n = len(x)
+        start = self.count
+        if start + n > self.capacity:
+            self.alloc(max(self.capacity * 2, start + n))
+        end = start + n
+        self.x[start:end] = x
+        self.y[start:end] = y
+        self.vx[start:end] = vx
+        self.vy[start:end] = vy
+        self.kind[start:end] = self.KINDS.index(kind)
+        self.owner[start:end] = owner
+        self.facing[start:end] = facing
+        self.angle[start:end] = 0
+        self.damage[start:end] = damage
+        self.count = end
+
+    def spawn_volley(self, fighter: "Fighter", owner: int, n: int = BARRAGE_VOLLEY) -> None:
+        """fighter の前方へ手裏剣を扇状にばらまく"""
+        facing = fighter.facing
+        half = Projectile.DATA["beam"]["size"][0] // 2
+        x0 = fighter.rect.right + half if facing == 1 else fighter.rect.left - half
+        vx = facing * self.rng.uniform(6, 14, n)
+        vy = self.rng.uniform(-4, 4, n)
+        # 同じ場所に重ならないよう、少しずつ進んだ位置から出す
+        t0 = self.rng.uniform(0, 4, n)
+        self.spawn(x0 + vx * t0, fighter.rect.centery + vy * t0, vx, vy,
+                   "beam", owner, facing, BARRAGE_DAMAGE)
+
+    def rects(self):
+        """描画用の矩形 (left, top, 幅, 高さ) の配列"""
+        n = self.count
+        kind = self.kind[:n]
+        angle = self.angle[:n]
+        w = self.size_w[kind, angle]
+        h = self.size_h[kind, angle]
+        left = np.floor(self.x[:n]).astype(np.int32) - w // 2
+        top = np.floor(self.y[:n]).astype(np.int32) - h // 2
+        return left, top, w, h
+
+    def save_state(self) -> tuple:
+        """弾の配列のコピーと乱数の状態"""
+        n = self.count
+        arrays = tuple(getattr(self, name)[:n].copy() for name in
+                       ("x", "y", "vx", "vy", "kind", "owner", "facing", "angle", "damage"))
+        return arrays, self.rng.bit_generator.state
+
+    def load_state(self, state: tuple) -> None:
+        """save_state() の結果から戻す"""
+        arrays, rng_state = state
+        n = len(arrays[0])
+        if n > self.capacity:
+            self.alloc(n)
+        for name, arr in zip(("x", "y", "vx", "vy", "kind", "owner", "facing", "angle", "damage"), arrays):
+            getattr(self, name)[:n] = arr
+        self.count = n
+        self.rng.bit_generator.state = rng_state
+
+    def keep(self, mask) -> None:
+        """mask が True の弾だけを残して詰める"""
+        n = self.count
+        k = int(np.count_nonzero(mask))
+        for name in ("x", "y", "vx", "vy", "kind", "owner", "facing", "angle", "damage"):
+            arr = getattr(self, name)
+            arr[:k] = arr[:n][mask]
+        self.count = k
+
+    def update(self) -> None:
+        """移動・回転させ、画面外に出た弾を消す"""
+        n = self.count
+        if n == 0:
+            return
+        self.x[:n] += self.vx[:n]
+        self.y[:n] += self.vy[:n]
+        angle = self.angle[:n]
+        angle += self.rotate_speed[self.kind[:n]]
+        angle %= 360
+
+        left, top, w, h = self.rects()
+        on_screen = (left + w >= 0) & (left <= WIDTH) & (top + h >= 0) & (top <= HEIGHT)
+        if not on_screen.all():
+            self.keep(on_screen)
+
+    def resolve_hits(self, fighters: list["Fighter"], teams, active, log=None) -> None:
+        """
+        ファイターに当たった弾のダメージをまとめて与え、その弾を消す。
+        弾は撃ったファイターと別のチームにだけ当たる。
+
+        Args:
+            fighters: ファイターの並び
+            teams: 各ファイターのチーム
+            active: 各ファイターが試合に残っているか（外れたファイターには当たらない）
+            log: 与えたダメージを知らせる log(撃った側の添字, 技, ダメージ)（集計用）
+        """
+        n = self.count
+        if n == 0:
+            return
+        kind = self.kind[:n]
+        hw = self.hit_w[kind]
+        hh = self.hit_h[kind]
+        hl = np.floor(self.x[:n]).astype(np.int32) - hw // 2
+        ht = np.floor(self.y[:n]).astype(np.int32) - hh // 2
+        owner = self.owner[:n]
+        owner_team = np.asarray(teams)[owner]
+
+        # 並び順で最初に当たったファイター（-1 は当たっていない）
+        target = np.full(n, -1, np.int8)
+        for i, f in enumerate(fighters):
+            if not active[i]:
+                continue
+            hb = f.hurtbox
+            hit = ((target < 0) & (owner_team != teams[i]) &
+                   (hl < hb.right) & (hl + hw > hb.left) &
+                   (ht < hb.bottom) & (ht + hh > hb.top))
+            target[hit] = i
+
+        if not (target >= 0).any():
+            return
+
+        for i, f in enumerate(fighters):
+            hit = target == i
+            if not hit.any():
+                continue
+            damage = self.damage[:n][hit].astype(np.int32)
+            # 防御中は軽減
+            if f.is_guarding:
+                damage //= 3
+            f.hp -= int(damage.sum())
+            if log is not None:
+                for o, d in enumerate(np.bincount(owner[hit], damage, len(fighters))):
+                    if d:
+                        log(o, "barrage", int(d))
+            # ノックバックは弾の飛んできた向きに押す
+            knockback = damage * 2
+            f.rect.x += int((knockback * self.facing[:n][hit]).sum())
+            if (np.abs(knockback) > 10).any():
+                f.vy = -8
+                f.on_ground = False
+
+        self.keep(target < 0)
+
+    def draw(self, screen: pg.Surface) -> None:
+        """種類・向きごとの回転済み画像を Surface.blits() でまとめて描画する"""
+        n = self.count
+        if n == 0:
+            return
+        left, top, _, _ = self.rects()
+        if RENDER_SCALE != 1.0:
+            left = np.floor(left * RENDER_SCALE).astype(np.int32)
+            top = np.floor(top * RENDER_SCALE).astype(np.int32)
+        kind = self.kind[:n]
+        facing = self.facing[:n]
+        angle = self.angle[:n]
+        seq = []
+        for k, name in enumerate(self.KINDS):
+            for fc in (1, -1):
+                idx = np.flatnonzero((kind == k) & (facing == fc))
+                if idx.size == 0:
+                    continue
+                frames = Projectile.rotation_frames(name, fc, RENDER_SCALE)
+                frame_idx = (angle[idx] // self.angle_step[k]).tolist()
+                seq.extend(zip([frames[i] for i in frame_idx],
+                               zip(left[idx].tolist(), top[idx].tolist())))
+        screen.blits(seq, doreturn=False)
+
+
+# =====================
+# 当たり判定（広域）
+# =====================
+class CollisionGrid:
+    """
+    一様グリッドで当たり判定の候補を絞り込む。
+    矩形を層ごと・セルごとに登録しておき、同じ層・同じセルにあるものとだけ colliderect する。
+    """
+
+    def __init__(self, cell_size: int = 128) -> None:
+        self.cell_size = cell_size
+        self.layers: dict[object, dict[tuple[int, int], list]] = {}
+
+    def clear(self) -> None:
+        self.layers.clear()
+
+    def insert(self, layer, rect: pg.Rect, entry: tuple) -> None:
+        """
+        矩形を登録する。
+
+        Args:
+            layer: 層（同じ層どうしでしか当たらない）
+            rect: 当たり判定の矩形
+            entry: (並び順, オブジェクト) のタプル
+        """
+        cells = self.layers.setdefault(layer, {})
+        cs = self.cell_size
+        item = (rect, entry)
+        for cx in range(rect.left // cs, (rect.right - 1) // cs + 1):
+            for cy in range(rect.top // cs, (rect.bottom - 1) // cs + 1):
+                bucket = cells.get((cx, cy))
+                if bucket is None:
+                    cells[(cx, cy)] = [item]
+                else:
+                    bucket.append(item)
+
+    def query(self, layer, rect: pg.Rect) -> list[tuple]:
+        """layer に登録した entry のうち、rect と重なるものを並び順に返す"""
+        cells = self.layers.get(layer)
+        if not cells:
+            return []
+        cs = self.cell_size
+        found = {}
+        for cx in range(rect.left // cs, (rect.right - 1) // cs + 1):
+            for cy in range(rect.top // cs, (rect.bottom - 1) // cs + 1):
+                for other, entry in cells.get((cx, cy), ()):
+                    if entry[0] not in found and rect.colliderect(other):
+                        found[entry[0]] = entry
+        return [found[k] for k in sorted(found)]
+
+
+# 当たり判定の層
+LAYER_HURT = "hurt"  # Fighter.hurtbox
+LAYER_ATTACK_HURT = "attack_hurt"  # Fighter.attack_hurtbox
+LAYER_BOMB = "bomb"  # 螺旋丸の Projectile.rect（持ち主ごとに分ける。融合の判定に使う）
+
+
+# =====================
+# フレームプロファイラ
+# =====================
+PROFILE_PHASES = ("event", "fighter", "sprites", "contacts", "fusion", "hits",
+                  "background", "draw", "hud", "display", "cpu", "other")
+(P_EVENT, P_FIGHTER, P_SPRITES, P_CONTACTS, P_FUSION, P_HITS,
+ P_BACKGROUND, P_DRAW, P_HUD, P_DISPLAY, P_CPU, P_OTHER) = range(len(PROFILE_PHASES))
+# 記録しておくフレーム数
+PROFILE_FRAMES = 600
+# オーバーレイの表示を切り替えるキー
+PROFILE_KEY = pg.K_F3
+# 指定すると、終了時に記録を CSV で書き出す（最初から計測する）
+PROFILE_CSV = os.environ.get("KOUKATON_PROFILE_CSV")
+
+
+class FrameProfiler:
+    """
+    1フレームを処理の段階ごとに perf_counter_ns で計り、直近 PROFILE_FRAMES
+    フレーム分をリングバッファに残す。
+    計測する場所では `if PROFILER.enabled: PROFILER.lap(P_xxx)` と書く。
+    lap() は前の lap() からの時間をその段階に足す。止めているときは
+    真偽値を1回見るだけなので、ほとんど負担にならない。
+    """
+
+    def __init__(self, size: int = PROFILE_FRAMES) -> None:
+        self.enabled = False
+        self.size = size
+        self.phases = len(PROFILE_PHASES)
+        # samples[フレーム * phases + 段階] に ns を入れる
+        self.samples = array.array("q", bytes(8 * size * self.phases))
+        self.totals = array.array("q", bytes(8 * size))
+        self.count = 0  # 記録したフレーム数（リングバッファを回った分も含む）
+        self.current = [0] * self.phases
+        self.start = 0
+        self.last = 0
+
+    def begin_frame(self) -> None:
+        """フレームの計測を始める"""
+        self.current = [0] * self.phases
+        self.start = self.last = time.perf_counter_ns()
+
+    def lap(self, phase: int) -> None:
+        """前の lap() から今までを phase の時間にする"""
+        now = time.perf_counter_ns()
+        self.current[phase] += now - self.last
+        self.last = now
+
+    def end_frame(self) -> None:
+        """フレームの計測を終えてリングバッファに入れる"""
+        self.lap(P_OTHER)
+        slot = self.count % self.size
+        self.samples[slot * self.phases:(slot + 1) * self.phases] = array.array("q", self.current)
+        self.totals[slot] = self.last - self.start
+        self.count += 1
+
+    def recent(self) -> range:
+        """記録が残っているフレームの番号（古い順）"""
+        return range(max(0, self.count - self.size), self.count)
+
+    def phase_times(self, phase: int) -> list[int]:
+        """phase の時間(ns)を古い順に返す"""
+        return [self.samples[(i % self.size) * self.phases + phase] for i in self.recent()]
+
+    def frame_times(self) -> list[int]:
+        """フレーム全体の時間(ns)を古い順に返す"""
+        return [self.totals[i % self.size] for i in self.recent()]
+
+    def stats(self) -> list[tuple[str, float, float, float]]:
+        """
+        段階ごとの統計。
+
+        Returns:
+            (段階名, 最小, 平均, 99パーセンタイル) のリスト（単位はマイクロ秒）
+        """
+        result = []
+        columns = [(name, self.phase_times(i)) for i, name in enumerate(PROFILE_PHASES)]
+        columns.append(("frame", self.frame_times()))
+        for name, times in columns:
+            if not times:
+                result.append((name, 0.0, 0.0, 0.0))
+                continue
+            ordered = sorted(times)
+            p99 = ordered[min(len(ordered) - 1, len(ordered) * 99 // 100)]
+            result.append((name, ordered[0] / 1000, sum(ordered) / len(ordered) / 1000, p99 / 1000))
+        return result
+
+    def dump_csv(self, path: str) -> None:
+        """記録をフレームごとに CSV で書き出す（単位はナノ秒）"""
+        try:
+            with open(path, "w", encoding="utf-8") as fp:
+                fp.write(",".join(("frame",) + PROFILE_PHASES + ("total",)) + "\n")
+                for i in self.recent():
+                    slot = i % self.size
+                    row = self.samples[slot * self.phases:(slot + 1) * self.phases]
+                    fp.write(",".join(map(str, (i, *row, self.totals[slot]))) + "\n")
+        except OSError as e:
+            print(f"[profile save error] {path} : {e}")
+
+
+PROFILER = FrameProfiler()
+
+
+class ProfilerOverlay:
+    """プロファイラの統計とフレーム時間のグラフを画面の右上に表示する"""
+
+    WIDTH = 330
+    ROW_HEIGHT = 15
+    GRAPH_HEIGHT = 70
+    GRAPH_FRAMES = 300
+    GRAPH_MAX_MS = 2 * TICK_MS  # グラフの上端
+    # 文字を作り直す間隔（フレーム）
+    REFRESH = 15
+    # min / avg / p99 の列の右端
+    COLUMNS = (170, 245, 320)
+
+    def __init__(self, profiler: FrameProfiler) -> None:
+        self.profiler = profiler
+        rows = len(PROFILE_PHASES) + 2
+        self.rect = pg.Rect(WIDTH - self.WIDTH - 10, HUD.TOP_HEIGHT + 10,
+                            self.WIDTH, rows * self.ROW_HEIGHT + self.GRAPH_HEIGHT + 12)
+        self.surface = None
+        self.built_at = -self.REFRESH
+
+    def build(self) -> None:
+        """表を描き直す"""
+        surf = pg.Surface(self.rect.size)
+        surf.fill((10, 10, 20))
+        rows = [("phase (us)", "min", "avg", "p99")]
+        rows += [(name, f"{lo:.0f}", f"{avg:.0f}", f"{p99:.0f}")
+                 for name, lo, avg, p99 in self.profiler.stats()]
+        for i, row in enumerate(rows):
+            color = (255, 255, 0) if i == 0 else (230, 230, 230)
+            y = 4 + i * self.ROW_HEIGHT
+            surf.blit(TEXT.render(FONT_SMALL, row[0], color), (6, y))
+            # 数値は右揃え
+            for right, text in zip(self.COLUMNS, row[1:]):
+                label = TEXT.render(FONT_SMALL, text, color)
+                surf.blit(label, (right - label.get_width(), y))
+
+        # フレーム時間のグラフ（黄色の線が 1 ティック）
+        graph = pg.Rect(6, self.rect.height - self.GRAPH_HEIGHT - 6, self.WIDTH - 12, self.GRAPH_HEIGHT)
+        pg.draw.rect(surf, (40, 40, 60), graph)
+        times = self.profiler.frame_times()[-self.GRAPH_FRAMES:]
+        scale = graph.height / (self.GRAPH_MAX_MS * 1_000_000)
+        for i, ns in enumerate(times):
+            x = graph.right - len(times) + i
+            h = min(graph.height, int(ns * scale))
+            color = (90, 200, 90) if ns <= TICK_MS * 1_000_000 else (230, 70, 70)
+            pg.draw.line(surf, color, (x, graph.bottom - 1), (x, graph.bottom - h))
+        y = graph.bottom - int(TICK_MS * 1_000_000 * scale)
+        pg.draw.line(surf, (255, 255, 0), (graph.left, y), (graph.right - 1, y))
+        self.surface = to_render(surf)
+        self.built_at = self.profiler.count
+
+    def draw(self, screen) -> pg.Rect:
+        """表示して、更新した矩形（内部の解像度）を返す"""
+        if self.surface is None or self.profiler.count - self.built_at >= self.REFRESH:
+            self.build()
+        rect = self.surface.get_rect(topleft=render_pos(self.rect.topleft))
+        screen.blit(self.surface, rect)
+        return rect
+
+
+def masks_touch(a, b) -> bool:
+    """rect と mask を持つ2つのものの不透明な部分が重なっているか（矩形は重なっている前提）"""
+    ra, rb = a.rect, b.rect
+    return a.mask.overlap(b.mask, (rb.x - ra.x, rb.y - ra.y)) is not None
+
+
+# =====================
+# 対戦シミュレーション
+# =====================
+# 対戦形式: 名前: 各ファイターのチーム（1P・2P は添字 0・1。チーム戦では別のチームにする）
+BATTLE_MODES = {
+    "1v1": (0, 1),
+    "2v2": (0, 1, 0, 1),
+    "FFA4": (0, 1, 2, 3),
+    "FFA8": (0, 1, 2, 3, 4, 5, 6, 7),
+}
+BATTLE_MODE_NAMES = tuple(BATTLE_MODES)
+
+
+class Battle:
+    """
+    画面を使わない対戦の進行役。
+    ファイターの人数分の入力ビットを受け取り、1フレームずつ試合を進める。
+    描画側は fighters / attacks / projectiles を読むだけでよい。
+
+    ファイターはそれぞれチームに属し、別のチームのいちばん近いファイターを狙う。
+    攻撃と飛び道具は別のチームにだけ当たる。体力が 0 になったファイターは試合から外れ、
+    残りが1チームになるか時間切れで決着する。
+    """
 
-        w, h = self.DATA[atk_type]["size"]
-        self.image = pg.Surface((w, h), pg.SRCALPHA)
-        self.image.fill((255, 0, 0, 120))
+    # 飛び道具の種類と消費エネルギー
+    PROJECTILE_COST = {"beam": 20, "bomb": 30, "rasensyuriken": 60}
+
+    def __init__(self, fighters: list[Fighter], barrage: bool = False,
+                 precise: bool = PRECISE_HITS, mode: str = "1v1") -> None:
+        self.fighters = list(fighters)
+        self.mode = mode
+        self.teams = BATTLE_MODES[mode]
+        if len(self.teams) != len(self.fighters):
+            raise ValueError(f"{mode} は {len(self.teams)} 人で対戦します")
+        self.team_of = dict(zip(self.fighters, self.teams))
+        # 精密な当たり判定（矩形が重なったときだけ画像のマスクで確かめる）
+        self.precise = precise
+        self.attacks = pg.sprite.Group()
+        self.projectiles = pg.sprite.Group()
+        self.grid = CollisionGrid()
+        self.field = None  # 弾幕モードの飛び道具（ProjectileField）
+        self.set_barrage(barrage)
+        self.frame = 0
+        self.time_left = MATCH_TIME  # 残り時間（更新回数）
+        self.result = None  # None / "K.O." / "Time Up"
+        self.winner = None  # 勝った Fighter（引き分けは None）
+        # 集計するときだけ辞書にする {(与えた側の添字, 技): ダメージ}。状態には含めない
+        self.damage_log: dict[tuple[int, str], int] | None = None
+
+        # 試合に残っているか（フレームの始めに体力から決める。状態には含めない）
+        self.active = [True] * len(self.fighters)
+
+        # ラウンド開始時のファイターの状態（狙う相手に向けてから記録し、reset() で戻す）
+        for i, f in enumerate(self.fighters):
+            f.facing = self.side(i)
+        self.start_states = [f.save_state() for f in self.fighters]
+
+    def set_barrage(self, barrage: bool) -> None:
+        """弾幕モード（手裏剣が大量にばらまかれる）を切り替える"""
+        self.field = ProjectileField() if barrage else None
+
+    @property
+    def seconds_left(self) -> int:
+        """残り時間（秒、切り上げ）"""
+        return -(-self.time_left // TICK_RATE)
+
+    @property
+    def winner_team(self) -> int | None:
+        """勝ったチーム（引き分けや決着前は None）"""
+        return self.team_of[self.winner] if self.winner is not None else None
+
+    def target(self, index: int) -> Fighter | None:
+        """
+        index のファイターが狙う相手（別のチームで体力の残っている、横にいちばん近いファイター）。
+        同じ距離なら並び順の早い方。相手がいなければ None。
+        """
+        me = self.fighters[index]
+        team = self.teams[index]
+        best = None
+        best_distance = 0
+        for i, f in enumerate(self.fighters):
+            if self.teams[i] == team or f.hp <= 0:
+                continue
+            distance = abs(f.rect.centerx - me.rect.centerx)
+            if best is None or distance < best_distance:
+                best, best_distance = f, distance
+        return best
+
+    def side(self, index: int) -> int:
+        """index のファイターから見た狙う相手の向き（1 なら右。相手がいなければ今の向き）"""
+        enemy = self.target(index)
+        me = self.fighters[index]
+        if enemy is None:
+            return me.facing
+        return 1 if enemy.rect.centerx >= me.rect.centerx else -1
+
+    def advantage(self, index: int) -> float:
+        """index のファイターのチームの体力の合計から、ほかのチームの体力の平均を引いたもの"""
+        team = self.teams[index]
+        mine = theirs = 0
+        for t, f in zip(self.teams, self.fighters):
+            if t == team:
+                mine += f.hp
+            else:
+                theirs += f.hp
+        others = len(set(self.teams)) - 1
+        return mine - theirs / max(others, 1)
+
+    def reset(self) -> None:
+        """ラウンド開始時の状態に戻す（速度・タイマー・しゃがみなども含めてすべて）"""
+        for f, state in zip(self.fighters, self.start_states):
+            f.load_state(state)
+        self.attacks.empty()
+        self.projectiles.empty()
+        if self.field is not None:
+            self.field.clear()
+        self.frame = 0
+        self.time_left = MATCH_TIME
+        self.result = None
+        self.winner = None
+
+    def step(self, inputs: tuple[int, int]) -> None:
+        """
+        試合を1フレーム（1/TICK_RATE 秒）進める。
 
-        self.rect = self.image.get_rect()
-        offset_x = 70 if fighter.facing == 1 else -70
-        offset_y = 60 if atk_type == "punch" else -60
+        Args:
+            inputs: 各ファイターの入力ビット（fighters と同じ並び）
+        """
+        if self.result is not None:
+            return
+        if PROFILER.enabled:
+            PROFILER.lap(P_OTHER)
+
+        # 試合から外れたファイターの入力は読まない
+        self.active = [f.hp > 0 for f in self.fighters]
+        inputs = [bits if active else 0 for bits, active in zip(inputs, self.active)]
+        targets = [self.target(i) for i in range(len(self.fighters))]
+
+        # 時間更新
+        if self.time_left > 0:
+            self.time_left -= 1
+
+        # コマンド技（方向は狙う相手のいる側を前として読む。成立したボタンの通常の技は出さない）
+        read = []
+        for i, (f, bits) in enumerate(zip(self.fighters, inputs)):
+            side = self.side(i)
+            command = f.commands.feed(self.frame, bits, side)
+            if command is not None:
+                button, (kind, name) = command
+                bits &= ~button
+                f.facing = side
+                if kind == "attack":
+                    f.do_attack(name, self.attacks)
+                else:
+                    self.fire(i, f, name)
+            read.append(bits)
+        inputs = read
+
+        # パンチ・キック
+        for f, bits in zip(self.fighters, inputs):
+            if bits & IN_PUNCH:
+                f.do_attack("punch", self.attacks)
+            if bits & IN_KICK:
+                f.do_attack("kick", self.attacks)
+
+        # 飛び道具（弾幕モードでは手裏剣をまとめてばらまく）
+        for i, (f, bits) in enumerate(zip(self.fighters, inputs)):
+            for kind in ("beam", "bomb"):
+                if bits & INPUT_BITS[kind]:
+                    self.fire(i, f, kind)
+
+        # 投げ技（狙っている相手を投げる）
+        for i, (f, bits) in enumerate(zip(self.fighters, inputs)):
+            if bits & IN_THROW and targets[i] is not None and try_throw(f, targets[i]):
+                self.log_damage(i, "throw", THROW_DAMAGE)
+
+        # ファイター更新
+        for f, bits, enemy in zip(self.fighters, inputs, targets):
+            f.update(bits, enemy)
+        if PROFILER.enabled:
+            PROFILER.lap(P_FIGHTER)
+
+        self.attacks.update()
+        self.projectiles.update()
+        if self.field is not None:
+            self.field.update()
+        if PROFILER.enabled:
+            PROFILER.lap(P_SPRITES)
+
+        self.collide()
+        self.judge(self.time_left <= 0)
+        self.frame += 1
+
+    def find_contacts(self) -> list[tuple[str, pg.sprite.Sprite, pg.sprite.Sprite]]:
+        """
+        当たっている組をまとめて求める。
 
-        self.rect.centerx = fighter.rect.centerx + offset_x
-        self.rect.centery = fighter.rect.centery - offset_y
+        Returns:
+            ("fuse", 飛び道具, 飛び道具) / ("attack", 攻撃, Fighter) /
+            ("projectile", 飛び道具, Fighter) のリスト。処理する順に並んでいる
+        """
+        grid = self.grid
+        grid.clear()
+        precise = self.precise
+        teams = self.teams
+        for i, f in enumerate(self.fighters):
+            if not self.active[i]:
+                continue
+            if precise:
+                # 画像のマスクに手足も入っているので、攻撃中のくらい判定はいらない
+                grid.insert(LAYER_HURT, f.rect, (i, f))
+                continue
+            grid.insert(LAYER_HURT, f.hurtbox, (i, f))
+            if f.attack_hurtbox:
+                grid.insert(LAYER_ATTACK_HURT, f.attack_hurtbox, (i, f))
+
+        projectiles = list(self.projectiles)
+        for j, proj in enumerate(projectiles):
+            if proj.kind == "bomb":
+                grid.insert((LAYER_BOMB, proj.owner), proj.rect, (j, proj))
+
+        contacts = []
+
+        # 同じ持ち主の手裏剣と螺旋丸（並び順の早い組から）
+        fuse = []
+        for i, proj in enumerate(projectiles):
+            if proj.kind == "beam":
+                for j, other in grid.query((LAYER_BOMB, proj.owner), proj.rect):
+                    if not precise or masks_touch(proj, other):
+                        fuse.append((min(i, j), max(i, j)))
+        fuse.sort()
+        contacts.extend(("fuse", projectiles[i], projectiles[j]) for i, j in fuse)
+
+        # 攻撃とファイター（別のチームで、本体か攻撃中のくらい判定に当たった最初の1人）
+        for atk in self.attacks:
+            team = self.team_of[atk.owner]
+            hits = [i for i, f in grid.query(LAYER_HURT, atk.rect)
+                    if teams[i] != team and (not precise or masks_touch(atk, f))]
+            hits += [i for i, f in grid.query(LAYER_ATTACK_HURT, atk.rect) if teams[i] != team]
+            if hits:
+                contacts.append(("attack", atk, self.fighters[min(hits)]))
+
+        # 飛び道具とファイター
+        for proj in projectiles:
+            contacts.extend(self.projectile_contacts(proj))
+        return contacts
+
+    def projectile_contacts(self, proj) -> list[tuple[str, pg.sprite.Sprite, Fighter]]:
+        """飛び道具が当たる、別のチームの最初のファイター（find_contacts() の後に呼ぶ）"""
+        team = self.team_of[proj.owner]
+        if self.precise:
+            for i, f in self.grid.query(LAYER_HURT, proj.rect):
+                if self.teams[i] != team and masks_touch(proj, f):
+                    return [("projectile", proj, f)]
+            return []
+        for i, f in self.grid.query(LAYER_HURT, proj.hitbox):
+            if self.teams[i] != team:
+                return [("projectile", proj, f)]
+        return []
+
+    def collide(self) -> None:
+        """融合・攻撃・飛び道具の当たり判定を1つの接触リストから処理する"""
+        contacts = self.find_contacts()
+        fused = set()
+        profiling = PROFILER.enabled
+        if profiling:
+            PROFILER.lap(P_CONTACTS)
+
+        for kind, a, b in contacts:
+            if kind == "fuse":
+                # 飛び道具の融合（1つの飛び道具は1回だけ融合する）
+                if a in fused or b in fused:
+                    continue
+                fused.update((a, b))
+                if profiling:
+                    PROFILER.lap(P_HITS)
+
+                x = (a.rect.centerx + b.rect.centerx) // 2
+                y = (a.rect.centery + b.rect.centery) // 2
+
+                a.kill()
+                b.kill()
+
+                new_proj = Projectile(a.owner, "rasensyuriken")
+                new_proj.rect.center = (x, y)
+                new_proj.hitbox.center = (x, y)
+                self.projectiles.add(new_proj)
+                # 融合でできた飛び道具も、このフレームのうちに当たり判定する
+                contacts.extend(self.projectile_contacts(new_proj))
+                if profiling:
+                    PROFILER.lap(P_FUSION)
+
+            elif kind == "attack":
+                damage = a.damage
+                # 防御中は軽減
+                if b.is_guarding:
+                    damage = damage // 3
+                b.hp -= damage
+                apply_knockback(b, a.owner, damage)
+                a.kill()
+                if self.damage_log is not None:
+                    self.log_damage(self.fighters.index(a.owner), a.atk_type, damage)
+
+            elif kind == "projectile":
+                if not a.alive():
+                    continue
+                damage = a.damage
+                if b.is_guarding:
+                    damage = damage // 3
+                b.hp -= damage
+                apply_knockback(b, a.owner, damage)
+                a.kill()
+                if self.damage_log is not None:
+                    self.log_damage(self.fighters.index(a.owner), a.kind, damage)
+
+        # 弾幕の飛び道具はまとめて判定する
+        if self.field is not None:
+            log = self.log_damage if self.damage_log is not None else None
+            self.field.resolve_hits(self.fighters, self.teams, self.active, log)
+        if profiling:
+            PROFILER.lap(P_HITS)
+
+    def log_damage(self, index: int, source: str, damage: int) -> None:
+        """damage_log があれば、与えたダメージを技ごとに足す"""
+        if self.damage_log is not None:
+            key = (index, source)
+            self.damage_log[key] = self.damage_log.get(key, 0) + damage
+
+    def fire(self, index: int, fighter: Fighter, kind: str) -> None:
+        """エネルギーが足りていれば飛び道具を撃つ（弾幕モードでは手裏剣をまとめてばらまく）"""
+        cost = self.PROJECTILE_COST[kind]
+        if fighter.energy < cost:
+            return
+        if kind == "beam" and self.field is not None:
+            self.field.spawn_volley(fighter, index)
+        else:
+            self.projectiles.add(Projectile(fighter, kind))
+        fighter.energy -= cost
 
-        self.life = self.DATA[atk_type]["life"]
+    def save_state(self) -> tuple:
+        """
+        対戦の状態を値だけのタプルにして返す（ロールバック用）。
+        ファイター・攻撃・飛び道具・残り時間・勝敗をすべて含む。
+        """
+        index = {f: i for i, f in enumerate(self.fighters)}
+        attacks = tuple(a.save_state(index[a.owner]) for a in self.attacks)
+        projectiles = tuple(p.save_state(index[p.owner]) for p in self.projectiles)
+        field = self.field.save_state() if self.field is not None else None
+        winner = index[self.winner] if self.winner is not None else -1
+        return (self.frame, self.time_left, self.result, winner,
+                tuple(f.save_state() for f in self.fighters), attacks, projectiles, field)
+
+    def load_state(self, state: tuple) -> None:
+        """
+        save_state() の結果から対戦の状態を戻す。
 
-    def update(self) -> None:
-        """攻撃判定の寿命管理"""
-        self.life -= 1
-        if self.life <= 0:
-            self.kill()
+        Raises:
+            ValueError: 人数が違う対戦や、弾幕モードでない対戦に弾幕モードの状態を戻そうとしたとき
+        """
+        (frame, time_left, result, winner, fighters, attacks, projectiles, field) = state
+        if len(fighters) != len(self.fighters):
+            raise ValueError("対戦の人数が違います")
+        if field is not None and self.field is None:
+            raise ValueError("弾幕モードの状態は弾幕モードの対戦にしか戻せません")
+        self.frame, self.time_left, self.result = frame, time_left, result
+        for f, fs in zip(self.fighters, fighters):
+            f.load_state(fs)
+        self.winner = self.fighters[winner] if winner >= 0 else None
+
+        # 今ある攻撃・飛び道具は作り直さずに使い回す
+        restore_group(self.attacks, attacks, self.fighters, Attack.from_state)
+        restore_group(self.projectiles, projectiles, self.fighters, Projectile.from_state)
+
+        # 弾幕モードでない状態を戻すときは、残っている弾を消す
+        if field is not None:
+            self.field.load_state(field)
+        elif self.field is not None:
+            self.field.clear()
+
+    def judge(self, time_up: bool) -> None:
+        """
+        勝敗判定。体力の残っているチームが1つ以下になったら K.O.。
+        チームの体力の合計がいちばん多いチームの勝ち（並べば引き分け）で、
+        勝者にはそのチームでいちばん体力の多いファイターを入れる。
+        """
+        alive = {t for t, f in zip(self.teams, self.fighters) if f.hp > 0}
+        if not (time_up or len(alive) <= 1):
+            return
+        totals: dict[int, int] = {}
+        for t, f in zip(self.teams, self.fighters):
+            totals[t] = totals.get(t, 0) + f.hp
+        best = max(totals.values())
+        leaders = [t for t, total in totals.items() if total == best]
+        if len(leaders) == 1:
+            members = [f for t, f in zip(self.teams, self.fighters) if t == leaders[0]]
+            self.winner = max(members, key=lambda f: f.hp)
+        self.result = "K.O." if len(alive) <= 1 else "Time Up"
+
+
+def start_positions(teams: tuple[int, ...]) -> list[int]:
+    """ファイターの最初の X 座標（チームごとにまとめて、左から等間隔に並べる）"""
+    if len(teams) == 2:
+        return [200, 700]
+    width = FIGHTER_POSES["idle"][1][0]
+    left, right = 20, WIDTH - 20 - width
+    order = sorted(range(len(teams)), key=lambda i: (teams[i], i))
+    xs = [0] * len(teams)
+    for k, i in enumerate(order):
+        xs[i] = left + (right - left) * k // (len(teams) - 1)
+    return xs
+
+
+def create_battle(barrage: bool = False, precise: bool = PRECISE_HITS, mode: str = "1v1") -> Battle:
+    """
+    対戦を作る。1P（man）と 2P（woman）のあとに、3人目からは man と woman を交互に並べる。
+    3人目からは操作キーを持たない（CPU が操作する）。
+    """
+    teams = BATTLE_MODES[mode]
+    keys = [P1_KEYS, P2_KEYS] + [None] * (len(teams) - 2)
+    fighters = [Fighter(x, keys[i], FIGHTER_CHARS[i % len(FIGHTER_CHARS)])
+                for i, x in enumerate(start_positions(teams))]
+    return Battle(fighters, barrage, precise, mode)
 
 
 # =====================
-# 飛び道具
+# リプレイ
 # =====================
-class Projectile(pg.sprite.Sprite):
-    def __init__(self, fighter, kind):
-        super().__init__()
-        self.owner = fighter
-        self.kind = kind
-        self.facing = fighter.facing
-        self.angle = 0
-        self.rotate_speed = 0
+# ファイルの中身:
+#   ヘッダ        REPLAY_HEADER
+#   入力          全員分の入力ビット(uint16)をフレーム順に並べて zlib で圧縮したもの
+#   キーフレーム  Battle.save_state() を encode_keyframe() で JSON にして zlib で圧縮したもの（数個）
+#   索引          REPLAY_INDEX をキーフレームの数だけ
+REPLAY_DIR = "replays"
+REPLAY_MAGIC = b"KKRP"
+REPLAY_VERSION = 5
+# 何フレームごとに状態を丸ごと保存するか（シークで早送りする最大フレーム数）
+REPLAY_KEYFRAME_INTERVAL = 120
+# マジック, バージョン, ステージ, 弾幕モード, 精密な当たり判定, 対戦形式（BATTLE_MODE_NAMES の添字）,
+# キーフレーム間隔, フレーム数, 入力の長さ, キーフレーム数
+REPLAY_HEADER = struct.Struct("<4sBBBBBHIII")
+# フレーム, ファイル先頭からの位置, 長さ
+REPLAY_INDEX = struct.Struct("<III")
+
+
+def encode_keyframe(state: tuple) -> bytes:
+    """
+    Battle.save_state() の結果をキーフレームのバイト列にする。
+    クラスの並びに頼らないように、値を名前つきの JSON にして zlib で圧縮する。
+    """
+    frame, time_left, result, winner, fighters, attacks, projectiles, field = state
+    if field is not None:
+        arrays, rng_state = field
+        field = {"arrays": [a.tolist() for a in arrays], "rng": rng_state}
+    plain = {
+        "frame": frame, "time_left": time_left, "result": result, "winner": winner,
+        "fighters": [s.to_plain() for s in fighters],
+        "attacks": [s.to_plain() for s in attacks],
+        "projectiles": [s.to_plain() for s in projectiles],
+        "field": field,
+    }
+    return zlib.compress(json.dumps(plain, separators=(",", ":")).encode())
 
-        if kind == "beam":
-            try:
-                self.original_image = pg.transform.scale(
-                    pg.image.load("fig/syuriken.png").convert_alpha(), (30, 30)
-                )
-            except:
-                self.original_image = pg.Surface((30, 30), pg.SRCALPHA)
-                self.original_image.fill((255, 200, 0, 255))
 
-            self.hitbox_size = (15, 15)
-            self.speed = 12
-            self.damage = 10
-            self.rotate_speed = 20
+def decode_keyframe(data: bytes) -> tuple:
+    """encode_keyframe() の結果を Battle.load_state() に渡せる形に戻す（壊れていれば ValueError）"""
+    try:
+        plain = json.loads(zlib.decompress(data))
+        field = plain["field"]
+        if field is not None:
+            field = (tuple(field["arrays"]), field["rng"])
+        return (plain["frame"], plain["time_left"], plain["result"], plain["winner"],
+                tuple(FighterState.from_plain(s) for s in plain["fighters"]),
+                tuple(AttackState.from_plain(s) for s in plain["attacks"]),
+                tuple(ProjectileState.from_plain(s) for s in plain["projectiles"]),
+                field)
+    except (zlib.error, ValueError, KeyError, TypeError) as e:
+        raise ValueError(f"キーフレームが壊れています: {e}") from e
+
+
+class ReplayRecorder:
+    """対戦の入力を1フレームずつ記録し、リプレイファイルにする"""
+
+    def __init__(self, stage: int, barrage: bool = False, precise: bool = False,
+                 mode: str = "1v1", interval: int = REPLAY_KEYFRAME_INTERVAL) -> None:
+        self.stage = stage
+        self.barrage = barrage
+        self.precise = precise
+        self.mode = mode
+        self.players = len(BATTLE_MODES[mode])
+        self.interval = interval
+        self.inputs = array.array("H")
+        self.keyframes: list[tuple[int, bytes]] = []
+
+    @property
+    def frames(self) -> int:
+        return len(self.inputs) // self.players
+
+    def record(self, battle, inputs: tuple[int, ...]) -> None:
+        """Battle.step(inputs) の直前に呼ぶ"""
+        if self.frames % self.interval == 0:
+            self.keyframes.append((self.frames, encode_keyframe(battle.save_state())))
+        self.inputs.extend(inputs)
+
+    def to_bytes(self) -> bytes:
+        """リプレイファイルの中身を作る"""
+        inputs = self.inputs
+        if sys.byteorder != "little":
+            inputs = array.array("H", inputs)
+            inputs.byteswap()
+        packed = zlib.compress(inputs.tobytes(), 9)
+
+        offset = REPLAY_HEADER.size + len(packed)
+        index = []
+        for frame, data in self.keyframes:
+            index.append(REPLAY_INDEX.pack(frame, offset, len(data)))
+            offset += len(data)
+        header = REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, self.stage, self.barrage,
+                                    self.precise, BATTLE_MODE_NAMES.index(self.mode), self.interval,
+                                    self.frames, len(packed), len(self.keyframes))
+        return b"".join([header, packed, *(data for _, data in self.keyframes), *index])
+
+    def save(self, path: str | None = None) -> str | None:
+        """
+        リプレイファイルを書き出す。
 
-        elif kind == "bomb":
-            try:
-                self.original_image = pg.transform.scale(
-                    pg.image.load("fig/rasengan1.png").convert_alpha(), (80, 80)
-                )
-            except:
-                self.original_image = pg.Surface((80, 80), pg.SRCALPHA)
-                self.original_image.fill((0, 150, 255, 255))
+        Args:
+            path: 書き出す先（None なら REPLAY_DIR に日時の名前で作る）
+        Returns:
+            書き出したファイルのパス（失敗したときは None）
+        """
+        if self.frames == 0:
+            return None
+        if path is None:
+            name = time.strftime("replay_%Y%m%d_%H%M%S.kkr")
+            path = os.path.join(resource_path(REPLAY_DIR), name)
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "wb") as fp:
+                fp.write(self.to_bytes())
+        except OSError as e:
+            print(f"[replay save error] {path} : {e}")
+            return None
+        return path
 
-            self.hitbox_size = (40, 40)
-            self.speed = 8
-            self.damage = 15
-            self.rotate_speed = 0
 
-        elif kind == "rasensyuriken":
-            try:
-                self.original_image = pg.transform.scale(
-                    pg.image.load("fig/rasensyuriken.png").convert_alpha(), (80, 80)
-                )
-            except:
-                self.original_image = pg.Surface((80, 80), pg.SRCALPHA)
-                self.original_image.fill((255, 100, 0, 255))
+class Replay:
+    """
+    リプレイファイルを読み、好きなフレームの状態を再現する。
+    シークはいちばん近い手前のキーフレームに戻し、そこから画面なしで早送りする。
+    """
 
-            self.hitbox_size = (45, 45)
-            self.speed = 8
-            self.damage = 30
-            self.rotate_speed = 15
+    def __init__(self, data: bytes) -> None:
+        """
+        リプレイファイルの中身を読む。キーフレームもここで全部確かめて展開する。
 
-        if self.facing == -1:
-            self.original_image = pg.transform.flip(self.original_image, True, False)
+        Raises:
+            ValueError: リプレイファイルでないとき・途中で切れていたり壊れていたりするとき
+        """
+        if len(data) < REPLAY_HEADER.size:
+            raise ValueError("リプレイファイルではありません")
+        (magic, version, self.stage, barrage, precise, mode, self.interval, self.frames,
+         input_size, keyframe_count) = REPLAY_HEADER.unpack_from(data)
+        if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+            raise ValueError("リプレイファイルではありません")
+        if mode >= len(BATTLE_MODE_NAMES):
+            raise ValueError("対戦形式が不明です")
+        self.barrage = bool(barrage)
+        self.precise = bool(precise)
+        self.mode = BATTLE_MODE_NAMES[mode]
+        self.players = len(BATTLE_MODES[self.mode])
+
+        start = REPLAY_HEADER.size
+        index_start = len(data) - REPLAY_INDEX.size * keyframe_count
+        if keyframe_count == 0 or index_start < start + input_size:
+            raise ValueError("ファイルが途中で切れています")
+        try:
+            self.inputs = array.array("H", zlib.decompress(data[start:start + input_size]))
+        except (zlib.error, ValueError) as e:
+            raise ValueError(f"入力が壊れています: {e}") from e
+        if sys.byteorder != "little":
+            self.inputs.byteswap()
+        if len(self.inputs) != self.frames * self.players:
+            raise ValueError("入力の長さがフレーム数と合いません")
+
+        self.keyframe_frames = []
+        self.states = []  # 展開したキーフレーム
+        for i in range(keyframe_count):
+            frame, offset, length = REPLAY_INDEX.unpack_from(data, index_start + i * REPLAY_INDEX.size)
+            if offset < start + input_size or offset + length > index_start:
+                raise ValueError("キーフレームの位置が壊れています")
+            if frame > self.frames or (self.keyframe_frames and frame <= self.keyframe_frames[-1]):
+                raise ValueError("キーフレームの順番が壊れています")
+            state = decode_keyframe(data[offset:offset + length])
+            if len(state[4]) != self.players:
+                raise ValueError("キーフレームの人数が対戦形式と合いません")
+            if (state[7] is not None) != self.barrage:
+                raise ValueError("キーフレームの弾幕モードが合いません")
+            self.keyframe_frames.append(frame)
+            self.states.append(state)
+        if self.keyframe_frames[0] != 0:
+            raise ValueError("最初のキーフレームがありません")
+        self.data = data
+        self.battle = None  # 最後に seek() した Battle
+
+    @classmethod
+    def load(cls, path: str) -> "Replay":
+        with open(path, "rb") as fp:
+            return cls(fp.read())
+
+    def new_battle(self) -> Battle:
+        """このリプレイを再生する Battle を作る"""
+        return create_battle(self.barrage, self.precise, self.mode)
+
+    def inputs_at(self, frame: int) -> tuple[int, ...]:
+        """frame フレーム目の全員分の入力"""
+        start = self.players * frame
+        return tuple(self.inputs[start:start + self.players])
+
+    def keyframe(self, i: int) -> tuple:
+        """i 番目のキーフレームの状態"""
+        return self.states[i]
+
+    def seek(self, battle, frame: int) -> None:
+        """
+        battle を frame フレーム目の直前の状態にする。
 
-        self.image = self.original_image.copy()
-        self.rect = self.original_image.get_rect()
-        self.hitbox = pg.Rect(0, 0, *self.hitbox_size)
+        Args:
+            battle: new_battle() で作った Battle
+            frame: 0 〜 self.frames
+        """
+        frame = max(0, min(frame, self.frames))
+        i = bisect.bisect_right(self.keyframe_frames, frame) - 1
+        start = self.keyframe_frames[i]
+        # 同じキーフレームの区間を前に進むだけなら、今の状態から続ける
+        if not (battle is self.battle and start <= battle.frame <= frame):
+            battle.load_state(self.keyframe(i))
+            self.battle = battle
+        for f in range(battle.frame, frame):
+            battle.step(self.inputs_at(f))
 
-        if self.facing == 1:
-            self.rect.midleft = fighter.rect.midright
-        else:
-            self.rect.midright = fighter.rect.midleft
 
-        self.hitbox.center = self.rect.center
+# =====================
+# HPバー
+# =====================
+def draw_hp(screen, fighter, x, width=300, y=20, height=20):
+    pg.draw.rect(screen, (255, 0, 0), (x, y, width, height))
+    pg.draw.rect(screen, (0, 255, 0), (x, y, width * fighter.hp // 100, height))
 
-    def update(self):
-        self.rect.x += self.speed * self.facing
-        self.hitbox.center = self.rect.center
 
-        if self.rotate_speed != 0:
-            self.angle = (self.angle + self.rotate_speed) % 360
-            center = self.rect.center
-            self.image = pg.transform.rotate(self.original_image, self.angle)
-            self.rect = self.image.get_rect(center=center)
-            self.hitbox.center = center
+def energy_width(fighter, width=300) -> int:
+    """エネルギーバーの中身の幅"""
+    return int(width / 100 * max(0, fighter.energy))
 
-        if self.rect.right < 0 or self.rect.left > WIDTH:
-            self.kill()
 
+def draw_energy(screen, fighter, x, width=300, y=45, height=12):
+    """エネルギーバーを描画"""
+    pg.draw.rect(screen, (100, 100, 100), (x, y, width, height))
+    pg.draw.rect(screen, (0, 150, 255), (x, y, energy_width(fighter, width), height))
+    pg.draw.rect(screen, (255, 255, 255), (x, y, width, height), 1)
 
-# =====================
-# 投げ技
-# =====================
-def try_throw(attacker, defender):
-    """投げ技を試行"""
-    if attacker.throw_cool > 0:
-        return False
 
-    dist = abs(attacker.rect.centerx - defender.rect.centerx)
-    height = abs(attacker.rect.bottom - defender.rect.bottom)
+# 3人以上のときのバー: チームの色（枠）、体力バーとエネルギーバーの (Y, 高さ)、バーの間隔
+TEAM_COLORS = ((255, 80, 80), (80, 160, 255), (255, 220, 0), (0, 220, 120),
+               (220, 100, 255), (255, 150, 50), (0, 220, 220), (240, 240, 240))
+HUD_MULTI_HP = (46, 14)
+HUD_MULTI_ENERGY = (64, 6)
+HUD_MULTI_GAP = 10
 
-    if dist < 70 and height < 20:
-        defender.hp -= 20
-        knock = 140
-        defender.rect.x += knock * attacker.facing
-        defender.vy = -15
-        defender.on_ground = False
-        attacker.energy = min(100, attacker.energy + 10)
-        attacker.throw_cool = 40
-        return True
-    return False
 
+def hud_bar_layout(count: int) -> tuple[list[int], int]:
+    """
+    体力・エネルギーバーの並べ方。
+
+    Returns:
+        (各ファイターのバーの左端の X 座標, バーの幅)。
+        2人なら左右に 300 ずつ、3人以上なら上部の横幅を人数で等分する
+    """
+    if count == 2:
+        return [50, WIDTH - 350], 300
+    width = (WIDTH - 2 * HUD_MULTI_GAP - HUD_MULTI_GAP * (count - 1)) // count
+    return [HUD_MULTI_GAP + i * (width + HUD_MULTI_GAP) for i in range(count)], width
 
-# =====================
-# HPバー
-# =====================
-def draw_hp(screen, fighter, x):
-    pg.draw.rect(screen, (255, 0, 0), (x, 20, 300, 20))
-    pg.draw.rect(screen, (0, 255, 0), (x, 20, 3 * fighter.hp, 20))
 
-            
 # =====================
 # HUD クラス
 # =====================
 class HUD:
-    """画面上部のタイマー・スコア・ポーズボタン・下部の操作説明を描画"""
+    """
+    画面上部のタイマー・スコア・ポーズボタン・体力/エネルギーバーと、
+    下部の操作説明を描画する。
+    表示する値が変わったときだけ描き直し、普段は作っておいた画像を貼るだけにする。
+    画像は論理座標で作り、作り直したときに内部の解像度に縮めたものを貼る。
+    """
+
+    TOP_HEIGHT = 110  # 上部 HUD の高さ（ポーズボタンの下端まで）
 
     def __init__(self):
-        self.match_time = MATCH_TIME
+        self.match_time = MATCH_TIME // TICK_RATE
         self.p1_wins = 0
         self.p2_wins = 0
         self.pause_rect = pg.Rect(WIDTH - 110, 70, 100, 40)
         self.volume = 0.5
-        self.last_time_check = pg.time.get_ticks()
-
-    def update_time(self):
-        """秒単位の時間を減少させる"""
-        current_time = pg.time.get_ticks()
-        elapsed = (current_time - self.last_time_check) / 1000.0
-        if elapsed >= 1.0:
-            self.match_time = max(0, self.match_time - 1)
-            self.last_time_check = current_time
-
-    def draw_top(self, screen):
-        """上部中央に時間、左/右にスコア、右上にポーズボタンを描画"""
-        score_left = FONT_MED.render(f"P1 Wins: {self.p1_wins}", True, (255, 255, 255))
-        score_right = FONT_MED.render(f"P2 Wins: {self.p2_wins}", True, (255, 255, 255))
-        screen.blit(score_left, (10, 10))
-        screen.blit(score_right, (WIDTH - 10 - score_right.get_width(), 10))
+
+        # 作っておいた HUD 画像（論理座標の大きさと内部の解像度のもの）と、そのときの表示内容
+        self.top_layer = None
+        self.top_render = None
+        self.top_state = None
+        self.bottom_layer = None
+        self.bottom_state = None
+
+    def invalidate(self) -> None:
+        """次に描くときに作り直す（内部の解像度を変えたときなど）"""
+        self.top_state = None
+        self.bottom_state = None
+
+    def update_time(self, battle):
+        """対戦の残り時間(秒)を表示用に反映する"""
+        self.match_time = battle.seconds_left
+
+    def draw_top(self, screen, battle):
+        """上部中央に時間、左/右にスコアと体力・エネルギー、右上にポーズボタンを描画"""
+        self.update_top(battle)
+        screen.blit(self.top_render, (0, 0))
+
+    def update_top(self, battle) -> bool:
+        """表示する値が変わっていれば上部 HUD を作り直し、作り直したかを返す"""
+        _, width = hud_bar_layout(len(battle.fighters))
+        # バーは1ピクセル単位でしか変わらないので、幅が同じなら描き直さない
+        state = (tuple((f.hp, energy_width(f, width)) for f in battle.fighters),
+                 int(self.match_time), self.p1_wins, self.p2_wins)
+        if state == self.top_state:
+            return False
+        self.top_state = state
+        self.compose_top(battle)
+        return True
+
+    def compose_top(self, battle):
+        """上部 HUD の画像を作り直す"""
+        if self.top_layer is None:
+            self.top_layer = pg.Surface((WIDTH, self.TOP_HEIGHT), pg.SRCALPHA)
+        layer = self.top_layer
+        layer.fill((0, 0, 0, 0))
+
+        fighters = battle.fighters
+        xs, width = hud_bar_layout(len(fighters))
+        if len(fighters) == 2:
+            for f, x in zip(fighters, xs):
+                draw_hp(layer, f, x)
+                draw_energy(layer, f, x)
+        else:
+            # 人数が多いときは細いバーを横に並べ、チームの色の枠と名前を付ける
+            for i, (f, x) in enumerate(zip(fighters, xs)):
+                color = TEAM_COLORS[battle.teams[i] % len(TEAM_COLORS)]
+                y, height = HUD_MULTI_HP
+                draw_hp(layer, f, x, width, y, height)
+                pg.draw.rect(layer, color, (x - 1, y - 1, width + 2, height + 2), 1)
+                name = TEXT.render(FONT_SMALL, f"{i + 1}P", (0, 0, 0) if f.hp > 0 else (120, 120, 120))
+                layer.blit(name, (x + 3, y + (height - name.get_height()) // 2))
+                y, height = HUD_MULTI_ENERGY
+                draw_energy(layer, f, x, width, y, height)
+
+        score_left = TEXT.render(FONT_MED, f"P1 Wins: {self.p1_wins}", (255, 255, 255))
+        score_right = TEXT.render(FONT_MED, f"P2 Wins: {self.p2_wins}", (255, 255, 255))
+        layer.blit(score_left, (10, 10))
+        layer.blit(score_right, (WIDTH - 10 - score_right.get_width(), 10))
 
         time_sec = int(self.match_time)
         if time_sec <= 30 and time_sec % 2 == 0:
@@ -581,27 +3111,63 @@ class HUD:
         else:
             time_color = (255, 255, 255)
 
-        time_text = FONT_MED.render(f"Time: {time_sec}", True, time_color)
-        screen.blit(time_text, (WIDTH // 2 - time_text.get_width() // 2, 10))
+        time_text = TEXT.render(FONT_MED, f"Time: {time_sec}", time_color)
+        layer.blit(time_text, (WIDTH // 2 - time_text.get_width() // 2, 10))
 
-        pg.draw.rect(screen, (180, 180, 180), self.pause_rect)
-        p_label = FONT_SMALL.render("PAUSE", True, (0, 0, 0))
-        screen.blit(p_label, (self.pause_rect.centerx - p_label.get_width() // 2,
-                              self.pause_rect.centery - p_label.get_height() // 2))
+        pg.draw.rect(layer, (180, 180, 180), self.pause_rect)
+        p_label = TEXT.render(FONT_SMALL, "PAUSE", (0, 0, 0))
+        layer.blit(p_label, (self.pause_rect.centerx - p_label.get_width() // 2,
+                             self.pause_rect.centery - p_label.get_height() // 2))
+        self.top_render = to_render(layer)
 
     def draw_bottom_controls(self, screen, p1_keys_text, p2_keys_text):
         """画面下部に操作説明を表示"""
-        rect = pg.Rect(0, HEIGHT - 40, WIDTH, 40)
-        pg.draw.rect(screen, (40, 40, 40), rect)
-        left = FONT_SMALL.render(p1_keys_text, True, (220, 220, 220))
-        right = FONT_SMALL.render(p2_keys_text, True, (220, 220, 220))
-        screen.blit(left, (10, HEIGHT - 32))
-        screen.blit(right, (WIDTH - 10 - right.get_width(), HEIGHT - 32))
+        state = (p1_keys_text, p2_keys_text)
+        if state != self.bottom_state:
+            self.bottom_state = state
+            layer = pg.Surface((WIDTH, 40))
+            layer.fill((40, 40, 40))
+            left = TEXT.render(FONT_SMALL, p1_keys_text, (220, 220, 220))
+            right = TEXT.render(FONT_SMALL, p2_keys_text, (220, 220, 220))
+            layer.blit(left, (10, 8))
+            layer.blit(right, (WIDTH - 10 - right.get_width(), 8))
+            self.bottom_layer = to_render(layer)
+        screen.blit(self.bottom_layer, render_pos((0, HEIGHT - 40)))
+
+    def redraw_over(self, screen, rects):
+        """rects（内部の解像度）と重なる部分だけ HUD を描き直す（差分描画用）"""
+        top = self.top_render.get_rect()
+        bottom = self.bottom_layer.get_rect(topleft=render_pos((0, HEIGHT - 40)))
+        for rect in rects:
+            clip = rect.clip(top)
+            if clip:
+                screen.blit(self.top_render, clip, clip)
+            clip = rect.clip(bottom)
+            if clip:
+                screen.blit(self.bottom_layer, clip, clip.move(0, -bottom.y))
 
 
 # =====================
 # ポーズメニュー
 # =====================
+# メニュー画面は表示内容が変わったときだけ作り直し、普段は1回貼るだけにする
+def new_screen_surface(background=None) -> pg.Surface:
+    """画面と同じ大きさ（論理座標）の画像を作る（background があれば写しておく）"""
+    surf = pg.Surface((WIDTH, HEIGHT))
+    if background is not None:
+        surf.blit(background, (0, 0))
+    return surf
+
+
+def compose_over(background, layer: pg.Surface) -> pg.Surface:
+    """論理座標で描いた layer を内部の解像度にして、background（screen の写し）に重ねる"""
+    surf = pg.Surface(screen.get_size())
+    if background is not None:
+        surf.blit(background, (0, 0))
+    surf.blit(to_render(layer), (0, 0))
+    return surf
+
+
 class PauseMenu:
     """ポーズ画面。続行・設定・終了メニュー"""
 
@@ -609,23 +3175,42 @@ class PauseMenu:
         self.options = ["Continue", "Settings", "Quit"]
         self.selected = 0
         self.hud = hud
+        self.background = None
+        self.cache: dict[int, pg.Surface] = {}
 
-    def draw(self, screen):
-        overlay = pg.Surface((WIDTH, HEIGHT), pg.SRCALPHA)
-        overlay.fill((0, 0, 0, 160))
-        screen.blit(overlay, (0, 0))
+        # クリック判定用の矩形（文字の大きさは色によらない）
+        self.option_rects = [
+            TEXT.render(FONT_MED, opt, (220, 220, 220)).get_rect(center=(WIDTH // 2, 220 + i * 70))
+            for i, opt in enumerate(self.options)
+        ]
+
+    def set_background(self, background):
+        """ポーズした時点のバトル画面を設定する"""
+        self.background = background
+        self.cache.clear()
+
+    def compose(self) -> pg.Surface:
+        """選択中の項目に応じたポーズ画面を作る"""
+        surf = pg.Surface((WIDTH, HEIGHT), pg.SRCALPHA)
+        surf.fill((0, 0, 0, 160))
 
-        title = FONT_BIG.render("Paused", True, (255, 255, 255))
-        screen.blit(title, (WIDTH // 2 - title.get_width() // 2, 100))
+        title = TEXT.render(FONT_BIG, "Paused", (255, 255, 255))
+        surf.blit(title, (WIDTH // 2 - title.get_width() // 2, 100))
 
         for i, opt in enumerate(self.options):
             color = (255, 255, 0) if i == self.selected else (220, 220, 220)
-            label = FONT_MED.render(opt, True, color)
-            rect = label.get_rect(center=(WIDTH // 2, 220 + i * 70))
-            screen.blit(label, rect)
+            label = TEXT.render(FONT_MED, opt, color)
+            surf.blit(label, self.option_rects[i])
 
-        guide = FONT_SMALL.render("↑↓ Select  ENTER Confirm  SPACE Continue", True, (200, 200, 200))
-        screen.blit(guide, (WIDTH // 2 - guide.get_width() // 2, 500))
+        guide = TEXT.render(FONT_SMALL, "↑↓ Select  ENTER Confirm  SPACE Continue", (200, 200, 200))
+        surf.blit(guide, (WIDTH // 2 - guide.get_width() // 2, 500))
+        return compose_over(self.background, surf)
+
+    def draw(self, screen):
+        surf = self.cache.get(self.selected)
+        if surf is None:
+            surf = self.cache[self.selected] = self.compose()
+        screen.blit(surf, (0, 0))
 
     def handle_event(self, event):
         if event.type == pg.KEYDOWN:
@@ -639,9 +3224,7 @@ class PauseMenu:
                 return "Continue"
         elif event.type == pg.MOUSEBUTTONDOWN and event.button == 1:
             mx, my = event.pos
-            for i, opt in enumerate(self.options):
-                label = FONT_MED.render(opt, True, (0, 0, 0))
-                rect = label.get_rect(center=(WIDTH // 2, 220 + i * 70))
+            for opt, rect in zip(self.options, self.option_rects):
                 if rect.collidepoint(mx, my):
                     return opt
         return None
@@ -651,116 +3234,822 @@ class PauseMenu:
 # 設定メニュー
 # =====================
 class SettingsMenu:
-    """設定画面(音量調整)"""
+    """設定画面(音量調整、描画の解像度と全画面の切り替え)"""
 
     def __init__(self, hud):
         self.hud = hud
+        self.background = None
+        self.cache: dict[tuple, pg.Surface] = {}
+        self.bar_rect = pg.Rect(WIDTH // 2 - 150, 320, 300, 20)
+        self.back_rect = pg.Rect(WIDTH // 2 - 75, 480, 150, 50)
 
-    def draw(self, screen):
-        overlay = pg.Surface((WIDTH, HEIGHT), pg.SRCALPHA)
-        overlay.fill((0, 0, 0, 180))
-        screen.blit(overlay, (0, 0))
+    def set_background(self, background):
+        """ポーズした時点のバトル画面を設定する"""
+        self.background = background
+        self.cache.clear()
+
+    def compose(self) -> pg.Surface:
+        """今の設定に応じた設定画面を作る"""
+        surf = pg.Surface((WIDTH, HEIGHT), pg.SRCALPHA)
+        surf.fill((0, 0, 0, 180))
 
-        title = FONT_BIG.render("Settings", True, (255, 255, 255))
-        screen.blit(title, (WIDTH // 2 - title.get_width() // 2, 100))
+        title = TEXT.render(FONT_BIG, "Settings", (255, 255, 255))
+        surf.blit(title, (WIDTH // 2 - title.get_width() // 2, 100))
 
-        vol_text = FONT_MED.render(f"Music Volume: {int(self.hud.volume * 100)}%", True, (255, 255, 255))
-        screen.blit(vol_text, (WIDTH // 2 - vol_text.get_width() // 2, 250))
+        vol_text = TEXT.render(FONT_MED, f"Music Volume: {int(self.hud.volume * 100)}%", (255, 255, 255))
+        surf.blit(vol_text, (WIDTH // 2 - vol_text.get_width() // 2, 250))
 
-        bar_back = pg.Rect(WIDTH // 2 - 150, 320, 300, 20)
-        pg.draw.rect(screen, (80, 80, 80), bar_back)
+        bar_back = self.bar_rect
+        pg.draw.rect(surf, (80, 80, 80), bar_back)
         fill = pg.Rect(bar_back.x, bar_back.y, int(300 * self.hud.volume), 20)
-        pg.draw.rect(screen, (0, 200, 100), fill)
+        pg.draw.rect(surf, (0, 200, 100), fill)
 
-        guide1 = FONT_SMALL.render("←/→ to change volume", True, (200, 200, 200))
-        guide2 = FONT_SMALL.render("ESC or ENTER to return to pause menu", True, (200, 200, 200))
-        screen.blit(guide1, (WIDTH // 2 - guide1.get_width() // 2, 400))
-        screen.blit(guide2, (WIDTH // 2 - guide2.get_width() // 2, 430))
+        display = TEXT.render(FONT_SMALL, f"Render Scale: {int(RENDER_SCALE * 100)}%    "
+                                          f"Fullscreen: {'ON' if FULLSCREEN else 'OFF'}", (255, 255, 255))
+        surf.blit(display, (WIDTH // 2 - display.get_width() // 2, 365))
 
-        back_rect = pg.Rect(WIDTH // 2 - 75, 480, 150, 50)
-        pg.draw.rect(screen, (100, 100, 100), back_rect)
-        pg.draw.rect(screen, (200, 200, 200), back_rect, 2)
-        back_label = FONT_MED.render("Back", True, (255, 255, 255))
-        screen.blit(back_label, (back_rect.centerx - back_label.get_width() // 2,
-                                 back_rect.centery - back_label.get_height() // 2))
+        guide1 = TEXT.render(FONT_SMALL, "←/→ to change volume  R render scale  F fullscreen", (200, 200, 200))
+        guide2 = TEXT.render(FONT_SMALL, "ESC or ENTER to return to pause menu", (200, 200, 200))
+        surf.blit(guide1, (WIDTH // 2 - guide1.get_width() // 2, 400))
+        surf.blit(guide2, (WIDTH // 2 - guide2.get_width() // 2, 430))
 
-        self.back_rect = back_rect
+        back_rect = self.back_rect
+        pg.draw.rect(surf, (100, 100, 100), back_rect)
+        pg.draw.rect(surf, (200, 200, 200), back_rect, 2)
+        back_label = TEXT.render(FONT_MED, "Back", (255, 255, 255))
+        surf.blit(back_label, (back_rect.centerx - back_label.get_width() // 2,
+                               back_rect.centery - back_label.get_height() // 2))
+        return compose_over(self.background, surf)
+
+    def draw(self, screen):
+        key = (int(self.hud.volume * 100), int(300 * self.hud.volume), RENDER_SCALE, FULLSCREEN)
+        surf = self.cache.get(key)
+        if surf is None:
+            surf = self.cache[key] = self.compose()
+        screen.blit(surf, (0, 0))
 
     def handle_event(self, event):
         if event.type == pg.KEYDOWN:
             if event.key == pg.K_LEFT:
                 self.hud.volume = max(0.0, self.hud.volume - 0.05)
-                pg.mixer.music.set_volume(self.hud.volume)
+                AUDIO.set_volume(self.hud.volume)
             if event.key == pg.K_RIGHT:
                 self.hud.volume = min(1.0, self.hud.volume + 0.05)
-                pg.mixer.music.set_volume(self.hud.volume)
+                AUDIO.set_volume(self.hud.volume)
+            if event.key == pg.K_r:
+                return "RenderScale"
+            if event.key == pg.K_f:
+                return "Fullscreen"
             if event.key == pg.K_ESCAPE or event.key == pg.K_RETURN:
                 return "Back"
         elif event.type == pg.MOUSEBUTTONDOWN and event.button == 1:
             mx, my = event.pos
-            bar = pg.Rect(WIDTH // 2 - 150, 320, 300, 20)
+            bar = self.bar_rect
             if bar.collidepoint(mx, my):
                 rel = (mx - bar.x) / bar.width
                 self.hud.volume = min(1.0, max(0.0, rel))
-                pg.mixer.music.set_volume(self.hud.volume)
+                AUDIO.set_volume(self.hud.volume)
             if self.back_rect.collidepoint(mx, my):
                 return "Back"
         return None
 
 
+# =====================
+# CPU
+# =====================
+# 行動: 名前: (前後(1 なら相手の方へ), そのほかの押しっぱなし, 最初のフレームだけ押す入力)
+CPU_ACTIONS = {
+    "wait": (0, 0, 0),
+    "forward": (1, 0, 0),
+    "guard": (-1, 0, 0),
+    "crouch": (0, IN_DOWN, 0),
+    "jump": (0, IN_JUMP, 0),
+    "punch": (0, 0, IN_PUNCH),
+    "kick": (0, 0, IN_KICK),
+    "beam": (0, 0, IN_BEAM),
+    "bomb": (0, 0, IN_BOMB),
+    "throw": (1, 0, IN_THROW),
+}
+CPU_ACTION_NAMES = tuple(CPU_ACTIONS)
+CPU_DECISION_FRAMES = 8  # 1つの行動を続けるフレーム数（この間に次の行動を考える）
+CPU_HORIZON = 48  # 先読みするフレーム数
+CPU_FRAME_BUDGET_MS = 3.0  # 別プロセスを使わないとき、1フレームで先読みに使う時間
+CPU_CALIBRATE_ROLLOUTS = 8  # 先読みの速さを測るときの回数
+# 強さ: 1回の判断に使える先読みの回数のうち、実際に使う割合
+CPU_LEVELS = {"EASY": 0.05, "NORMAL": 0.3, "HARD": 1.0}
+# 先読みに使うプロセスの数（0 ならこのプロセスで先読みする）
+CPU_WORKERS = int(os.environ.get("KOUKATON_CPU_WORKERS", max(1, (os.cpu_count() or 1) - 1)))
+
+
+def cpu_action_bits(name: str, side: int, first: bool) -> int:
+    """
+    行動を入力ビットにする。
+
+    Args:
+        name: CPU_ACTIONS の行動名
+        side: 相手のいる向き（1 なら右）
+        first: 行動の最初のフレームかどうか（押す入力はこのときだけ立てる）
+    """
+    direction, hold, press = CPU_ACTIONS[name]
+    bits = hold
+    if direction:
+        bits |= IN_RIGHT if direction * side > 0 else IN_LEFT
+    if first:
+        bits |= press
+    return bits
+
+
+def cpu_rollouts(battle, state, index: int, current: str, action: str,
+                 seeds, horizon: int = CPU_HORIZON) -> float:
+    """
+    state から先読みして、HP の差（Battle.advantage()）がどれだけ良くなったかの合計を返す。
+    CPU は今の行動 current を続けたあと action をとり、その後はランダムに動く。
+    ほかのファイターは最初からランダムに動く。
+
+    Args:
+        battle: 先読みに使う Battle（中身は書き換わる）
+        state: Battle.save_state() の結果
+        index: CPU のファイターの添字
+        current: 今の行動
+        action: 調べる行動
+        seeds: 乱数の種（1つにつき1回先読みする）
+        horizon: 先読みするフレーム数
+    """
+    total = 0.0
+    n = len(battle.fighters)
+    bits = [0] * n
+    for seed in seeds:
+        battle.load_state(state)
+        rng = random.Random(seed)
+        before = battle.advantage(index)
+        plan = [current, action]
+        actions = [None] * n
+        for t in range(horizon):
+            if battle.result is not None:
+                break
+            phase = t % CPU_DECISION_FRAMES
+            if phase == 0:
+                step = t // CPU_DECISION_FRAMES
+                actions[index] = plan[step] if step < len(plan) else rng.choice(CPU_ACTION_NAMES)
+                for i in range(n):
+                    if i != index:
+                        actions[i] = rng.choice(CPU_ACTION_NAMES)
+            for i in range(n):
+                bits[i] = cpu_action_bits(actions[i], battle.side(i), phase == 0)
+            battle.step(tuple(bits))
+        total += battle.advantage(index) - before
+    return total
+
+
+# 別プロセスで先読みに使う Battle（(弾幕モード, 精密な当たり判定, 対戦形式) ごとに1つ）
+_cpu_battles: dict[tuple[bool, bool, str], "Battle"] = {}
+
+
+def cpu_worker_rollouts(config: tuple[bool, bool, str], state, index: int, current: str,
+                        action: str, seeds) -> tuple[str, int, float]:
+    """プロセスプールで動かす先読み。(行動, 回数, 合計) を返す"""
+    battle = _cpu_battles.get(config)
+    if battle is None:
+        battle = _cpu_battles[config] = create_battle(*config)
+    return action, len(seeds), cpu_rollouts(battle, state, index, current, action, seeds)
+
+
+class CpuController:
+    """
+    CPU のプレイヤー。read() が read_input() と同じ入力ビットを返すので、
+    人の操作と同じように Battle.step() に渡せる。
+
+    行動を CPU_DECISION_FRAMES フレーム続けるあいだに、次の行動を行動ごとに何回も
+    先読み（ロールアウト）し、HP の差の平均がいちばん良いものを選ぶ。
+    先読みはプロセスプールに配り、プールを使わないときはこのプロセスで
+    1フレームあたり CPU_FRAME_BUDGET_MS まで行う。
+    1回の判断で行う先読みの回数は、このマシンで1秒に何回先読みできるかを測って決める。
+    """
+
+    def __init__(self, index: int, level: str = "NORMAL", workers: int = CPU_WORKERS) -> None:
+        self.index = index
+        self.level = level
+        self.workers = workers
+        self.pool = None
+        self.sim = None  # このプロセスで先読みするときの Battle
+        self.config = (False, False, "1v1")
+        self.rate = 0.0  # 1プロセスで1秒に先読みできる回数
+        self.per_action = 1  # 1回の判断で行動ごとに先読みする回数
+        self.action = "wait"
+        self.frame = 0  # 今の行動を始めてからのフレーム数
+        self.seed = 0
+        self.pending = []  # プールに出した先読み（Future）
+        self.jobs = []  # このプロセスで先読みする (行動, 種) の残り
+        self.state = None  # 先読みの元の状態
+        self.totals: dict[str, float] = {}
+        self.counts: dict[str, int] = {}
+
+    def start(self, battle, per_action: int | None = None) -> None:
+        """
+        対戦を始めるときに呼ぶ。
+
+        Args:
+            battle: CPU が操作する対戦
+            per_action: 行動ごとの先読みの回数。省略すると先読みの速さを測って決める
+        """
+        self.config = (battle.field is not None, battle.precise, battle.mode)
+        self.sim = create_battle(*self.config)
+        self.action = "wait"
+        self.frame = 0
+        self.cancel()
+        if per_action is not None:
+            self.per_action = per_action
+            return
+        self.rate = self.calibrate(battle)
+        if self.workers > 0 and self.pool is None:
+            # 読み込みや音のスレッドが動いているので fork ではなく spawn で作る
+            # （import しても副作用がないので、子プロセスでそのまま読み込める）
+            self.pool = concurrent.futures.ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context("spawn"))
+        self.per_action = self.rollouts_per_action()
+        print(f"[cpu] {self.level}: 1秒に {self.rate:.0f} 回先読みできる（{max(self.workers, 1)} プロセス）"
+              f" -> 行動ごとに {self.per_action} 回")
+
+    def rollouts_per_action(self) -> int:
+        """1回の判断で行動ごとに先読みする回数（先読みの速さと強さから決める）"""
+        if self.pool is not None:
+            # 行動を続けているあいだ、すべてのプロセスで先読みできる
+            affordable = self.rate * CPU_DECISION_FRAMES * TICK_MS / 1000 * self.workers
+        else:
+            affordable = self.rate * CPU_DECISION_FRAMES * CPU_FRAME_BUDGET_MS / 1000
+        return max(1, int(affordable * CPU_LEVELS[self.level] / len(CPU_ACTIONS)))
+
+    def calibrate(self, battle) -> float:
+        """このプロセスで1秒に何回先読みできるか測る"""
+        state = battle.save_state()
+        start = time.perf_counter()
+        cpu_rollouts(self.sim, state, self.index, "wait", "wait", range(CPU_CALIBRATE_ROLLOUTS))
+        return CPU_CALIBRATE_ROLLOUTS / max(time.perf_counter() - start, 1e-6)
+
+    def close(self) -> None:
+        """プロセスプールを止める"""
+        self.cancel()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    def cancel(self) -> None:
+        """考えている途中の先読みを捨てる"""
+        for future in self.pending:
+            future.cancel()
+        self.pending = []
+        self.jobs = []
+        self.totals = {}
+        self.counts = {}
+
+    def read(self, battle) -> int:
+        """次のフレームの入力ビット（Battle.step() の直前に呼ぶ）"""
+        if self.frame == 0:
+            self.decide()
+            self.search(battle)
+        bits = cpu_action_bits(self.action, battle.side(self.index), self.frame == 0)
+        self.frame = (self.frame + 1) % CPU_DECISION_FRAMES
+        return bits
+
+    def search(self, battle) -> None:
+        """今の状態から、今の行動のあとにとる行動を先読みし始める"""
+        self.cancel()
+        self.state = battle.save_state()
+        jobs = []
+        for action in CPU_ACTION_NAMES:
+            seeds = range(self.seed, self.seed + self.per_action)
+            self.seed += self.per_action
+            jobs.append((action, seeds))
+        if self.pool is not None:
+            # 行動ごとにまとめて1つの仕事にする
+            try:
+                self.pending = [self.pool.submit(cpu_worker_rollouts, self.config, self.state,
+                                                 self.index, self.action, action, seeds)
+                                for action, seeds in jobs]
+                return
+            except (concurrent.futures.BrokenExecutor, RuntimeError) as e:
+                # プロセスが使えなくなったら、このプロセスで先読みする
+                print(f"[cpu] process pool error : {e}")
+                self.close()
+                self.workers = 0
+                self.per_action = self.rollouts_per_action()
+        if self.pool is None:
+            # 行動を順番に1回ずつ回す（時間切れでも全部の行動に結果が残るように）
+            self.jobs = [(action, seed) for i in range(self.per_action)
+                         for action, seeds in jobs for seed in seeds[i:i + 1]]
+            self.jobs.reverse()
+
+    def work(self, budget_ms: float = CPU_FRAME_BUDGET_MS) -> None:
+        """このプロセスでの先読みを budget_ms まで進める（描画1回に1度呼ぶ）"""
+        if not self.jobs:
+            return
+        profiling = PROFILER.enabled
+        if profiling:
+            PROFILER.lap(P_OTHER)
+            PROFILER.enabled = False  # 先読みの Battle.step() は計らない
+        deadline = time.perf_counter() + budget_ms / 1000
+        while self.jobs and time.perf_counter() < deadline:
+            action, seed = self.jobs.pop()
+            score = cpu_rollouts(self.sim, self.state, self.index, self.action, action, (seed,))
+            self.totals[action] = self.totals.get(action, 0.0) + score
+            self.counts[action] = self.counts.get(action, 0) + 1
+        if profiling:
+            PROFILER.enabled = True
+            PROFILER.lap(P_CPU)
+
+    def decide(self) -> None:
+        """集まった先読みの結果から次の行動を決める（間に合わなかった分は使わない）"""
+        for future in self.pending:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                action, count, total = future.result()
+                self.totals[action] = self.totals.get(action, 0.0) + total
+                self.counts[action] = self.counts.get(action, 0) + count
+        if self.counts:
+            self.action = max(self.counts, key=lambda a: self.totals[a] / self.counts[a])
+        else:
+            self.action = "wait"
+
+
+# 先読みしない CPU の行動の重み: (狙う相手との横の距離がこれより近いとき, {行動: 重み})
+BOT_WEIGHTS = (
+    (80, {"throw": 3, "punch": 3, "kick": 3, "guard": 2, "jump": 1}),
+    (220, {"forward": 3, "punch": 2, "kick": 2, "guard": 2, "jump": 1, "wait": 1}),
+    (float("inf"), {"forward": 4, "beam": 2, "bomb": 1, "jump": 1, "wait": 1}),
+)
+
+
+class BotController:
+    """
+    3人目からのファイターを動かす CPU。先読みはせず、狙う相手との距離で決めた重みで
+    CPU_ACTIONS から行動を選ぶ（8人の対戦でも1フレームの処理時間をほとんど使わない）。
+    read() は CpuController と同じように Battle.step() の直前に呼ぶ。
+    """
+
+    def __init__(self, index: int, seed: int = 0) -> None:
+        self.index = index
+        self.rng = random.Random(seed * len(BATTLE_MODES["FFA8"]) + index)
+        self.action = "wait"
+        self.frame = 0
+
+    def read(self, battle) -> int:
+        """次のフレームの入力ビット"""
+        enemy = battle.target(self.index)
+        if enemy is None:
+            return 0
+        if self.frame == 0:
+            distance = abs(enemy.rect.centerx - battle.fighters[self.index].rect.centerx)
+            weights = next(w for limit, w in BOT_WEIGHTS if distance < limit)
+            self.action = self.rng.choices(tuple(weights), tuple(weights.values()))[0]
+        bits = cpu_action_bits(self.action, battle.side(self.index), self.frame == 0)
+        self.frame = (self.frame + 1) % CPU_DECISION_FRAMES
+        return bits
+
+
+# =====================
+# トレーニングモード
+# =====================
+TRAINING_SLOT_KEYS = (pg.K_1, pg.K_2, pg.K_3, pg.K_4)  # 押すと読み込み、Shift と一緒なら保存
+TRAINING_FREEZE_KEY = pg.K_F9  # コマ送りの開始・終了
+TRAINING_STEP_KEY = pg.K_F10  # コマ送り中に1フレーム進める
+TRAINING_RESET_KEY = pg.K_BACKSPACE  # ラウンドを最初からやり直す
+TRAINING_KEYS_TEXT = "1-4=読込 Shift+1-4=保存 F9=コマ送り F10=1F進む BS=やり直し"
+
+
+class Training:
+    """
+    トレーニングモード。時間切れがなく、K.O. するとラウンドの最初に戻る。
+    対戦の状態をスロットに保存・読み込みでき、コマ送りで1フレームずつ進められる。
+    """
+
+    def __init__(self) -> None:
+        self.slots: list = [None] * len(TRAINING_SLOT_KEYS)
+        self.frozen = False  # コマ送り中
+        self.steps = 0  # コマ送り中に進めるフレーム数
+        self.message = ""
+
+    def start(self) -> None:
+        """対戦を始めるときに呼ぶ（スロットは残す）"""
+        self.frozen = False
+        self.steps = 0
+        self.message = ""
+
+    @property
+    def keys_text(self) -> str:
+        """操作説明（最後の操作の結果も出す）"""
+        return f"{self.message}  {TRAINING_KEYS_TEXT}" if self.message else TRAINING_KEYS_TEXT
+
+    def handle_key(self, event, battle) -> bool:
+        """
+        トレーニング用のキーを処理する。
+
+        Returns:
+            トレーニング用のキーだったかどうか（操作説明を描き直す）
+        """
+        if event.key in TRAINING_SLOT_KEYS:
+            slot = TRAINING_SLOT_KEYS.index(event.key)
+            if event.mod & pg.KMOD_SHIFT:
+                self.slots[slot] = battle.save_state()
+                self.message = f"スロット{slot + 1}に保存"
+            elif self.slots[slot] is not None:
+                try:
+                    battle.load_state(self.slots[slot])
+                    self.message = f"スロット{slot + 1}を読込"
+                except ValueError:
+                    # スロットは対戦をまたいで残るので、形式の違う対戦のものは戻せない
+                    self.message = f"スロット{slot + 1}は別の形式の対戦"
+            else:
+                self.message = f"スロット{slot + 1}は空"
+        elif event.key == TRAINING_FREEZE_KEY:
+            self.frozen = not self.frozen
+            self.steps = 0
+            self.message = "コマ送り" if self.frozen else ""
+        elif event.key == TRAINING_STEP_KEY:
+            if self.frozen:
+                self.steps += 1
+        elif event.key == TRAINING_RESET_KEY:
+            battle.reset()
+            self.message = "やり直し"
+        else:
+            return False
+        return True
+
+    def take_steps(self) -> int:
+        """コマ送り中に進めるフレーム数を取り出す"""
+        steps, self.steps = self.steps, 0
+        return steps
+
+    def after_step(self, battle) -> None:
+        """Battle.step() の後に呼ぶ（時間を戻し、K.O. ならラウンドの最初に戻る）"""
+        battle.time_left = MATCH_TIME
+        if battle.result is not None:
+            battle.reset()
+
+
+# =====================
+# 決着画面
+# =====================
+RESULT_MS = 2000  # 表示する時間
+RESULT_SKIP_MS = 300  # これより早いキー入力では飛ばさない（攻撃キーの押しっぱなし対策）
+RESULT_ZOOM_MS = 250  # 文字が縮みながら出てくる時間
+RESULT_ZOOM_STEPS = 12
+
+
+class ResultScreen:
+    """
+    決着（K.O. / Time Up）の表示。フレームのたびに少しずつ進む。
+    決着した瞬間の対戦画面を1枚写しておき、その上に結果の文字を重ねる。
+    文字のアニメーションの画像は文字列ごとに最初に作っておき、
+    動いている間は文字の周りだけを描き直す。
+    """
+
+    _frames: dict[tuple[str, float], list[pg.Surface]] = {}
+
+    def __init__(self) -> None:
+        self.background = None
+        self.frames = []
+        self.elapsed = 0.0
+        self.shown = None  # 表示中のアニメーションの番号
+        self.prev_rect = None
+
+    @classmethod
+    def zoom_frames(cls, text: str) -> list[pg.Surface]:
+        """大きく薄い文字から、元の大きさの文字まで縮んでいく画像（内部の解像度の大きさ）"""
+        key = (text, RENDER_SCALE)
+        frames = cls._frames.get(key)
+        if frames is None:
+            base = TEXT.render(FONT_BIG, text, (255, 255, 0))
+            frames = []
+            for i in range(RESULT_ZOOM_STEPS):
+                t = i / (RESULT_ZOOM_STEPS - 1)
+                if i < RESULT_ZOOM_STEPS - 1:
+                    img = pg.transform.rotozoom(base, 0, (2.5 - 1.5 * t) * RENDER_SCALE)
+                else:
+                    img = to_render(base).copy()
+                img.set_alpha(int(80 + 175 * t))
+                frames.append(img)
+            cls._frames[key] = frames
+        return frames
+
+    def start(self, screen, text: str) -> None:
+        """決着した瞬間の画面 screen の上に text を出し始める"""
+        self.background = screen.copy()
+        self.frames = self.zoom_frames(text)
+        self.elapsed = 0.0
+        self.shown = None
+        self.prev_rect = None
+
+    def update(self, dt_ms: float) -> bool:
+        """時間を進める。表示が終わったら True"""
+        self.elapsed += dt_ms
+        return self.elapsed >= RESULT_MS
+
+    def can_skip(self) -> bool:
+        return self.elapsed >= RESULT_SKIP_MS
+
+    def invalidate(self) -> None:
+        """次に描くときは画面全体を描き直す（ウィンドウの大きさを変えたときなど）"""
+        self.shown = None
+        self.prev_rect = None
+
+    def draw(self, screen):
+        """
+        描画する。
+
+        Returns:
+            pg.display.update() に渡す矩形のリスト（None なら画面全体）
+        """
+        index = min(len(self.frames) - 1, int(self.elapsed * len(self.frames) / RESULT_ZOOM_MS))
+        if index == self.shown:
+            return []
+        img = self.frames[index]
+        # 最後の画像が、これまでの「K.O.」表示と同じ位置に来るようにする
+        final = self.frames[-1]
+        cx, top = render_pos((WIDTH // 2, HEIGHT // 2 - 40))
+        rect = img.get_rect(center=(cx, top + final.get_height() // 2))
+        if self.prev_rect is None:
+            screen.blit(self.background, (0, 0))
+            update_rects = None
+        else:
+            dirty = rect.union(self.prev_rect)
+            screen.blit(self.background, dirty, dirty)
+            update_rects = [dirty]
+        screen.blit(img, rect)
+        self.shown = index
+        self.prev_rect = rect
+        return update_rects
+
+
 # =====================
 # タイトル画面
 # =====================
-def draw_title():
-    screen.blit(TITLE_BG, (0, 0))
+# 作っておいたタイトル・ステージ選択画面（キーは画面名と選択中の項目）
+_menu_screens: dict[tuple, pg.Surface] = {}
+MAX_MENU_SCREENS = 8
+
+
+def cached_menu_screen(key: tuple, compose) -> pg.Surface:
+    """key ごとに compose() で作った画面を使い回す"""
+    surf = _menu_screens.get(key)
+    if surf is None:
+        if len(_menu_screens) >= MAX_MENU_SCREENS:
+            del _menu_screens[next(iter(_menu_screens))]
+        surf = _menu_screens[key] = to_render(compose())
+    return surf
+
+
+def compose_title() -> pg.Surface:
+    """タイトル画面を作る"""
+    surf = new_screen_surface(TITLE_BG)
 
     overlay = pg.Surface((WIDTH, HEIGHT))
     overlay.set_alpha(120)
     overlay.fill((0, 0, 0))
-    screen.blit(overlay, (0, 0))
+    surf.blit(overlay, (0, 0))
+
+    title = TEXT.render(FONT_BIG, "こうかとん ファイター", (255, 255, 255))
+    guide = TEXT.render(FONT_MED, "ENTERキーでスタート", (230, 230, 230))
 
-    title = FONT_BIG.render("こうかとん ファイター", True, (255, 255, 255))
-    guide = FONT_MED.render("ENTERキーでスタート", True, (230, 230, 230))
+    surf.blit(title, (WIDTH // 2 - title.get_width() // 2, 220))
+    surf.blit(guide, (WIDTH // 2 - guide.get_width() // 2, 330))
+    return surf
 
-    screen.blit(title, (WIDTH // 2 - title.get_width() // 2, 220))
-    screen.blit(guide, (WIDTH // 2 - guide.get_width() // 2, 330))
+
+def draw_title():
+    screen.blit(cached_menu_screen(("title",), compose_title), (0, 0))
 
 
 # =====================
 # バトル選択画面
 # =====================
-def draw_select(selected):
-    if selected < len(STAGES):
-        screen.blit(STAGES[selected]["bg"], (0, 0))
-    else:
-        screen.blit(STAGES[0]["bg"], (0, 0))
+def compose_select(selected, barrage=False, training=False, cpu_level=None,
+                   battle_mode="1v1") -> pg.Surface:
+    """ステージ選択画面を作る"""
+    # 先読みが終わっていない背景は、読み込めてから描き直す（draw_select() を参照）
+    surf = new_screen_surface(select_background(selected))
 
     overlay = pg.Surface((WIDTH, HEIGHT))
     overlay.set_alpha(150)
     overlay.fill((0, 0, 0))
-    screen.blit(overlay, (0, 0))
+    surf.blit(overlay, (0, 0))
 
-    title = FONT_BIG.render("バトルステージ選択", True, (255, 255, 255))
-    screen.blit(title, (WIDTH // 2 - title.get_width() // 2, 60))
+    title = TEXT.render(FONT_BIG, "バトルステージ選択", (255, 255, 255))
+    surf.blit(title, (WIDTH // 2 - title.get_width() // 2, 60))
 
     for i, stage in enumerate(STAGES):
         color = (255, 255, 0) if i == selected else (200, 200, 200)
-        label = FONT_MED.render(stage["name"], True, color)
+        label = TEXT.render(FONT_MED, stage.name, color)
         rect = pg.Rect(350, 180 + i * 80, 300, 50)
-        pg.draw.rect(screen, color, rect, 2)
-        screen.blit(label, (rect.centerx - label.get_width() // 2,
-                            rect.centery - label.get_height() // 2))
+        pg.draw.rect(surf, color, rect, 2)
+        surf.blit(label, (rect.centerx - label.get_width() // 2,
+                          rect.centery - label.get_height() // 2))
 
     quit_index = len(STAGES)
     color = (255, 255, 0) if quit_index == selected else (200, 200, 200)
-    label = FONT_MED.render("ゲーム終了", True, color)
+    label = TEXT.render(FONT_MED, "ゲーム終了", color)
     rect = pg.Rect(350, 180 + quit_index * 80, 300, 50)
-    pg.draw.rect(screen, color, rect, 2)
-    screen.blit(label, (rect.centerx - label.get_width() // 2,
-                        rect.centery - label.get_height() // 2))
+    pg.draw.rect(surf, color, rect, 2)
+    surf.blit(label, (rect.centerx - label.get_width() // 2,
+                      rect.centery - label.get_height() // 2))
+
+    guide = TEXT.render(FONT_MED, "↑↓で選択  ENTERで決定", (220, 220, 220))
+    surf.blit(guide, (WIDTH // 2 - guide.get_width() // 2, 500))
+
+    # 弾幕モードは numpy があるときだけ選べる
+    if np is not None:
+        mode = "ON" if barrage else "OFF"
+        color = (255, 120, 0) if barrage else (200, 200, 200)
+        label = TEXT.render(FONT_SMALL, f"Mキー: 弾幕モード {mode}", color)
+        surf.blit(label, (WIDTH // 2 - 150 - label.get_width() // 2, 550))
+
+    color = (255, 120, 200) if battle_mode != "1v1" else (200, 200, 200)
+    label = TEXT.render(FONT_SMALL, f"Bキー: 対戦形式 {battle_mode}", color)
+    surf.blit(label, (WIDTH // 2 + 150 - label.get_width() // 2, 550))
+
+    mode = "ON" if training else "OFF"
+    color = (0, 200, 255) if training else (200, 200, 200)
+    label = TEXT.render(FONT_SMALL, f"Tキー: トレーニング {mode}", color)
+    surf.blit(label, (WIDTH // 2 - 150 - label.get_width() // 2, 575))
+
+    color = (0, 255, 120) if cpu_level else (200, 200, 200)
+    label = TEXT.render(FONT_SMALL, f"Pキー: 2P を CPU に {cpu_level or 'OFF'}", color)
+    surf.blit(label, (WIDTH // 2 + 150 - label.get_width() // 2, 575))
+    return surf
+
+
+def select_background(selected) -> pg.Surface | None:
+    """選択画面の背景（カーソルのステージ。「ゲーム終了」では最初のステージ）"""
+    if not STAGES:
+        return None
+    return STAGES[selected if selected < len(STAGES) else 0].peek()
+
+
+def draw_select(selected, barrage=False, training=False, cpu_level=None, battle_mode="1v1"):
+    pinned = STAGES[selected] if selected < len(STAGES) else None
+    STAGE_LOADER.prefetch(stage_priority(selected), pinned)
+    ready = select_background(selected) is not None
+    surf = cached_menu_screen(("select", selected, barrage, training, cpu_level, battle_mode, ready),
+                              lambda: compose_select(selected, barrage, training, cpu_level, battle_mode))
+    screen.blit(surf, (0, 0))
+
+
+# =====================
+# バトル画面の描画
+# =====================
+# True のときは変わった場所だけ描き直す（False で毎フレーム画面全体を描き直す）
+DIRTY_RENDERING = True
+
+
+def battle_sprites(battle):
+    """描画順（ファイター・攻撃・飛び道具）にスプライトを返す（試合から外れたファイターは描かない）"""
+    if battle.result is None:
+        yield from (f for f in battle.fighters if f.hp > 0)
+    else:
+        yield from battle.fighters
+    yield from battle.attacks
+    yield from battle.projectiles
+
+
+def draw_battle(screen, battle, background):
+    """対戦の状態を内部の解像度で描画する（状態は変更しない）"""
+    # ステージ背景（床込み）描画
+    screen.blit(background, (0, 0))
+    if PROFILER.enabled:
+        PROFILER.lap(P_BACKGROUND)
+
+    # ファイター・攻撃・飛び道具描画
+    for spr in battle_sprites(battle):
+        screen.blit(spr.image, render_pos(spr.rect.topleft))
+    if battle.field is not None:
+        battle.field.draw(screen)
+    if PROFILER.enabled:
+        PROFILER.lap(P_DRAW)
+
+
+class BattleRenderer:
+    """
+    バトル画面を描画する。
+    dirty が True のときは、前のフレームと今のフレームでスプライトがあった場所だけ
+    背景を塗り直し、変わった矩形だけを pg.display.update() に渡す。
+    """
+
+    # 描き直す面積が画面のこの割合を超えたら全体を描き直す
+    FULL_REDRAW_RATIO = 0.5
+
+    def __init__(self, dirty: bool = DIRTY_RENDERING) -> None:
+        self.dirty = dirty
+        self.background = None  # ステージ背景に床を描き込んだもの
+        self.prev_rects: dict[pg.sprite.Sprite, pg.Rect] = {}
+        self.need_full = True
+
+    def set_stage(self, stage_bg: pg.Surface) -> None:
+        """ステージを切り替える（背景は内部の解像度にしておく）"""
+        background = stage_bg.copy()
+        pg.draw.rect(background, (80, 160, 80), (0, FLOOR, WIDTH, HEIGHT))
+        self.background = to_render(background)
+        self.need_full = True
+
+    def invalidate(self) -> None:
+        """次のフレームは画面全体を描き直す（メニューから戻ったときなど）"""
+        self.need_full = True
+
+    def draw(self, screen, battle, hud, p1_keys_text, p2_keys_text):
+        """
+        対戦画面を描画する。
+
+        Returns:
+            pg.display.update() に渡す矩形のリスト（None なら画面全体）
+        """
+        profiling = PROFILER.enabled
+        if profiling:
+            PROFILER.lap(P_OTHER)
+        hud_changed = hud.update_top(battle)
+        if profiling:
+            PROFILER.lap(P_HUD)
+        # 矩形はすべて内部の解像度で扱う
+        current = {spr: pg.Rect(render_pos(spr.rect.topleft), spr.image.get_size())
+                   for spr in battle_sprites(battle)}
+        if profiling:
+            PROFILER.lap(P_DRAW)
+        # 弾幕があるとき（と消えた直後）は画面全体を描き直す
+        field_active = battle.field is not None and battle.field.count > 0
+        if field_active:
+            self.need_full = True
+
+        if self.dirty and not self.need_full:
+            dirty_rects = []
+            for spr, rect in current.items():
+                old = self.prev_rects.pop(spr, None)
+                dirty_rects.append(rect.union(old) if old else rect)
+            # 消えたスプライトの跡
+            dirty_rects.extend(self.prev_rects.values())
+            if hud_changed:
+                dirty_rects.append(render_rect((0, 0, WIDTH, hud.TOP_HEIGHT)))
+
+            area = sum(r.width * r.height for r in dirty_rects)
+            if area < self.FULL_REDRAW_RATIO * screen.get_width() * screen.get_height():
+                for rect in dirty_rects:
+                    screen.blit(self.background, rect, rect)
+                if profiling:
+                    PROFILER.lap(P_BACKGROUND)
+                for spr, rect in current.items():
+                    screen.blit(spr.image, rect)
+                if profiling:
+                    PROFILER.lap(P_DRAW)
+                hud.redraw_over(screen, dirty_rects)
+                if profiling:
+                    PROFILER.lap(P_HUD)
+                self.prev_rects = current
+                return dirty_rects
+
+        draw_battle(screen, battle, self.background)
+        hud.draw_top(screen, battle)
+        hud.draw_bottom_controls(screen, p1_keys_text, p2_keys_text)
+        if profiling:
+            PROFILER.lap(P_HUD)
+        self.prev_rects = current
+        self.need_full = field_active
+        return None
+
+
+def asset_manifest() -> list[tuple[tuple, bool]]:
+    """
+    画像パックに入れる画像を返す。タイトル・ステージ背景と、内部の解像度ごとの
+    ファイター（左右反転）・飛び道具（左右反転・角度ごとに回転）。
 
-    guide = FONT_MED.render("↑↓で選択  ENTERで決定", True, (220, 220, 220))
-    screen.blit(guide, (WIDTH // 2 - guide.get_width() // 2, 500))
+    Returns:
+        (AssetRegistry のキー, 透過の有無) のリスト
+    """
+    manifest = [((TITLE_IMAGE, (WIDTH, HEIGHT), False, 0), False)]
+    manifest += [((filename, (WIDTH, HEIGHT), False, 0), False) for _, filename in stage_files]
+    for scale in dict.fromkeys(RENDER_SCALES + (RENDER_SCALE,)):
+        for char_name in FIGHTER_CHARS:
+            for suffix, size in FIGHTER_POSES.values():
+                for flip in (False, True):
+                    manifest.append(((f"fig/{char_name}{suffix}.png", scale_size(size, scale), flip, 0), True))
+        for kind, data in Projectile.DATA.items():
+            size = scale_size(data["size"], scale)
+            for facing in (1, -1):
+                for angle in range(0, 360, Projectile.angle_step(kind)):
+                    manifest.append(((data["file"], size, facing == -1, angle), True))
+    return manifest
+
+
+def preload_battle_assets(battle) -> None:
+    """
+    対戦で使う画像を先に読み込む（対戦中にファイルを読まないようにする）。
+    内部の解像度を変えたときも呼び直して、その大きさの画像にする。
+    """
+    for f in battle.fighters:
+        f.sprites = load_fighter_sprites(f.char_name)
+    for kind in Projectile.DATA:
+        for facing in (1, -1):
+            Projectile.rotation_frames(kind, facing, RENDER_SCALE)
+            if battle.precise:
+                Projectile.rotation_masks(kind, facing)
+    if battle.precise:
+        for f in battle.fighters:
+            if f.masks is None:
+                f.masks = load_fighter_masks(f.char_name)
 
 
 # =====================
@@ -768,60 +4057,70 @@ def draw_select(selected):
 # =====================
 def main() -> None:
     """ゲームのメインループ"""
+    trace = StartupTrace() if TRACE_STARTUP else None
+    if trace:
+        trace.step("import")
+    init_display(trace)
+
     game_state = TITLE
     selected_stage = 0
     current_stage = 0
-
-    # スプライトグループ
-    attacks = pg.sprite.Group()
-    projectiles = pg.sprite.Group()
+    barrage_mode = False
+    training_mode = False
+    training = Training()
+    cpu_level = None  # None なら 2P も人が操作する
+    cpu = CpuController(1)
+    battle_mode = "1v1"
+    bots = []  # 3人目からのファイターの CPU
 
     # プレイヤー作成
-    p1 = Fighter(200, {
-        "left": pg.K_a,
-        "right": pg.K_d,
-        "jump": pg.K_w,
-        "down": pg.K_s,
-        "punch": pg.K_c,
-        "kick": pg.K_v,
-        "beam": pg.K_g,
-        "bomb": pg.K_h,
-        "throw": pg.K_t,
-    }, "man")
-
-    p2 = Fighter(700, {
-        "left": pg.K_LEFT,
-        "right": pg.K_RIGHT,
-        "jump": pg.K_UP,
-        "down": pg.K_DOWN,
-        "punch": pg.K_PERIOD,
-        "kick": pg.K_SLASH,
-        "beam": pg.K_COLON,
-        "bomb": pg.K_SEMICOLON,
-        "throw": pg.K_RIGHTBRACKET,
-    }, "woman")
-
-    fighters = [p1, p2]
+    battle = create_battle()
+    p1, p2 = battle.fighters[:2]
+    renderer = BattleRenderer()
+    recorder = None  # 対戦中のリプレイ
 
     # HUD とメニュー
     hud = HUD()
     pause_menu = PauseMenu(hud)
     settings_menu = SettingsMenu(hud)
+    result_screen = ResultScreen()
+
+    if trace:
+        trace.step("objects")
 
     # 初期BGM
-    safe_load_and_play_bgm(MENU_BGM, hud.volume)
+    AUDIO.play(MENU_BGM, hud.volume)
+    if trace:
+        trace.step("bgm")
 
     running = True
 
     # 操作説明
-    p1_keys_text = "P1: A/D=移動 W=ジャンプ S=しゃがみ C=パンチ V=キック G=手裏剣 H=螺旋丸 T=投げ"
-    p2_keys_text = "P2: ←/→=移動 ↑=ジャンプ ↓=しゃがみ .=パンチ /=キック :=手裏剣 ;=螺旋丸 ]=投げ"
+    p1_keys_text = P1_KEYS_TEXT
+    p2_keys_text = P2_KEYS_TEXT
 
     battle_surface = None
+    loads_at_start = ASSETS.loads
+
+    # 前回の描画から経過した、まだシミュレーションしていない時間(ms)
+    accumulator = 0.0
+    # まだ Battle.step() に渡していない KEYDOWN
+    pressed_keys = set()
+
+    # フレームプロファイラ（F3 で表示）
+    overlay = ProfilerOverlay(PROFILER)
+    show_profiler = False
+    PROFILER.enabled = PROFILE_CSV is not None
 
     while running:
-        dt_ms = clock.tick(60)
-        dt = dt_ms / 1000.0
+        dt_ms = clock.tick(RENDER_FPS)
+        if PROFILER.enabled:
+            PROFILER.begin_frame()
+        AUDIO.update()
+        prev_state = game_state
+        # None のときは画面全体を更新する
+        update_rects = None
+        skip_result = False
 
         key_lst = pg.key.get_pressed()
 
@@ -829,6 +4128,24 @@ def main() -> None:
             if event.type == pg.QUIT:
                 running = False
 
+            # マウスの位置はウィンドウ上の座標なので論理座標にする
+            if event.type in (pg.MOUSEBUTTONDOWN, pg.MOUSEBUTTONUP, pg.MOUSEMOTION):
+                event = pg.event.Event(event.type, {**event.dict, "pos": window_to_logical(event.pos)})
+
+            # ウィンドウの大きさ・全画面が変わったら描く先を決め直し、全体を描き直す
+            if handle_display_event(event):
+                renderer.invalidate()
+                result_screen.invalidate()
+                continue
+
+            if event.type == pg.KEYDOWN and event.key == PROFILE_KEY:
+                show_profiler = not show_profiler
+                if not PROFILER.enabled:
+                    PROFILER.begin_frame()
+                PROFILER.enabled = show_profiler or PROFILE_CSV is not None
+                renderer.invalidate()
+                continue
+
             # ===== タイトル =====
             if game_state == TITLE:
                 if event.type == pg.KEYDOWN and event.key == pg.K_RETURN:
@@ -841,61 +4158,66 @@ def main() -> None:
                         selected_stage = (selected_stage - 1) % (len(STAGES) + 1)
                     elif event.key == pg.K_DOWN:
                         selected_stage = (selected_stage + 1) % (len(STAGES) + 1)
+                    elif event.key == pg.K_m and np is not None:
+                        barrage_mode = not barrage_mode
+                    elif event.key == pg.K_t:
+                        training_mode = not training_mode
+                    elif event.key == pg.K_p:
+                        levels = (None,) + tuple(CPU_LEVELS)
+                        cpu_level = levels[(levels.index(cpu_level) + 1) % len(levels)]
+                    elif event.key == pg.K_b:
+                        i = BATTLE_MODE_NAMES.index(battle_mode)
+                        battle_mode = BATTLE_MODE_NAMES[(i + 1) % len(BATTLE_MODE_NAMES)]
                     elif event.key == pg.K_RETURN:
                         if selected_stage < len(STAGES):
                             game_state = BATTLE
                             current_stage = selected_stage
-                            hud.match_time = MATCH_TIME
-                            hud.last_time_check = pg.time.get_ticks()
-                            p1.hp = 100
-                            p2.hp = 100
-                            p1.energy = 100
-                            p2.energy = 100
-                            p1.rect.bottomleft = (200, FLOOR)
-                            p2.rect.bottomleft = (700, FLOOR)
-                            p1.facing = 1
-                            p2.facing = -1
-                            attacks.empty()
-                            projectiles.empty()
-                            safe_load_and_play_bgm(BATTLE_BGM, hud.volume)
+                            if battle.mode != battle_mode:
+                                battle = create_battle(mode=battle_mode)
+                                p1, p2 = battle.fighters[:2]
+                            bots = [BotController(i, random.randrange(1 << 16))
+                                    for i in range(2, len(battle.fighters))]
+                            battle.set_barrage(barrage_mode)
+                            battle.reset()
+                            # トレーニングはリプレイに残さない
+                            recorder = None
+                            p2_keys_text = P2_KEYS_TEXT
+                            if cpu_level:
+                                cpu.level = cpu_level
+                                cpu.start(battle)
+                                p2_keys_text = f"P2: CPU ({cpu_level})"
+                            if training_mode:
+                                training.start()
+                                p2_keys_text = training.keys_text
+                            else:
+                                recorder = ReplayRecorder(current_stage, barrage_mode, battle.precise,
+                                                          battle.mode)
+                            hud.update_time(battle)
+                            preload_battle_assets(battle)
+                            renderer.set_stage(STAGES[current_stage].bg)
+                            loads_at_start = ASSETS.loads
+                            AUDIO.play(BATTLE_BGM, hud.volume)
                         else:
                             running = False
 
             # ===== バトル中の入力 =====
             elif game_state == BATTLE:
                 if event.type == pg.KEYDOWN:
-                    # パンチ・キック
-                    for f in fighters:
-                        if event.key == f.keys["punch"]:
-                            f.do_attack("punch", attacks)
-                        if event.key == f.keys["kick"]:
-                            f.do_attack("kick", attacks)
-
-                    # 飛び道具
-                    if event.key == p1.keys["beam"] and p1.energy >= 20:
-                        projectiles.add(Projectile(p1, "beam"))
-                        p1.energy -= 20
-                    if event.key == p1.keys["bomb"] and p1.energy >= 30:
-                        projectiles.add(Projectile(p1, "bomb"))
-                        p1.energy -= 30
-
-                    if event.key == p2.keys["beam"] and p2.energy >= 20:
-                        projectiles.add(Projectile(p2, "beam"))
-                        p2.energy -= 20
-                    if event.key == p2.keys["bomb"] and p2.energy >= 30:
-                        projectiles.add(Projectile(p2, "bomb"))
-                        p2.energy -= 30
-
-                    # 投げ技
-                    if event.key == p1.keys["throw"]:
-                        try_throw(p1, p2)
-                    if event.key == p2.keys["throw"]:
-                        try_throw(p2, p1)
+                    # 攻撃系のキーは Battle.step() でまとめて処理する
+                    pressed_keys.add(event.key)
+
+                    # トレーニング用のキー（状態の保存・読み込み、コマ送り、やり直し）
+                    if training_mode and training.handle_key(event, battle):
+                        p2_keys_text = training.keys_text
+                        hud.update_time(battle)
+                        renderer.invalidate()
 
                     # ESCキーでポーズ
                     if event.key == pg.K_ESCAPE:
                         game_state = PAUSED
                         battle_surface = screen.copy()
+                        pause_menu.set_background(battle_surface)
+                        settings_menu.set_background(battle_surface)
 
                 # ポーズボタンクリック
                 elif event.type == pg.MOUSEBUTTONDOWN and event.button == 1:
@@ -903,6 +4225,8 @@ def main() -> None:
                     if hud.pause_rect.collidepoint(mx, my):
                         game_state = PAUSED
                         battle_surface = screen.copy()
+                        pause_menu.set_background(battle_surface)
+                        settings_menu.set_background(battle_surface)
 
             # ===== ポーズ中の入力 =====
             elif game_state == PAUSED:
@@ -913,174 +4237,142 @@ def main() -> None:
                     game_state = SETTINGS
                 elif result == "Quit":
                     game_state = SELECT
-                    safe_load_and_play_bgm(MENU_BGM, hud.volume)
+                    if recorder is not None:
+                        recorder.save()
+                    AUDIO.play(MENU_BGM, hud.volume)
 
             # ===== 設定画面の入力 =====
             elif game_state == SETTINGS:
                 result = settings_menu.handle_event(event)
                 if result == "Back":
                     game_state = PAUSED
+                elif result == "Fullscreen":
+                    set_display_mode(not FULLSCREEN)
+                    renderer.invalidate()
+                elif result == "RenderScale":
+                    i = RENDER_SCALES.index(RENDER_SCALE) if RENDER_SCALE in RENDER_SCALES else -1
+                    set_render_scale(RENDER_SCALES[(i + 1) % len(RENDER_SCALES)])
+                    # 画像を新しい解像度で用意し直す
+                    preload_battle_assets(battle)
+                    renderer.set_stage(STAGES[current_stage].bg)
+                    hud.invalidate()
+                    battle_surface = pg.transform.smoothscale(battle_surface, screen.get_size())
+                    pause_menu.set_background(battle_surface)
+                    settings_menu.set_background(battle_surface)
+
+            # ===== 決着画面の入力（キーで飛ばせる） =====
+            elif game_state == RESULT:
+                if event.type == pg.KEYDOWN and result_screen.can_skip():
+                    skip_result = True
+
+        if PROFILER.enabled:
+            PROFILER.lap(P_EVENT)
+
+        # バトル以外では時間を溜めない（ポーズ明けに早送りしない）
+        if game_state != BATTLE:
+            accumulator = 0.0
+            pressed_keys.clear()
 
         # ===== 描画・更新 =====
         if game_state == TITLE:
             draw_title()
 
         elif game_state == SELECT:
-            draw_select(selected_stage)
+            draw_select(selected_stage, barrage_mode, training_mode, cpu_level, battle_mode)
 
         elif game_state == BATTLE:
-            # ステージ背景描画
-            screen.blit(STAGES[current_stage]["bg"], (0, 0))
-
-            # 床描画
-            pg.draw.rect(screen, (80, 160, 80), (0, FLOOR, WIDTH, HEIGHT))
+            # 経過時間ぶんだけ一定間隔で対戦を進める（描画の速さに左右されない）
+            accumulator += dt_ms
+            ticks = 0
+            if training_mode and training.frozen:
+                # コマ送り中は F10 を押した回数だけ進める
+                accumulator = TICK_MS * training.take_steps()
+            while accumulator >= TICK_MS and battle.result is None:
+                if ticks == MAX_TICKS_PER_FRAME:
+                    accumulator = 0.0
+                    break
+                inputs = (read_input(p1.keys, key_lst, pressed_keys),
+                          cpu.read(battle) if cpu_level else read_input(p2.keys, key_lst, pressed_keys),
+                          *(bot.read(battle) for bot in bots))
+                if recorder is not None:
+                    recorder.record(battle, inputs)
+                battle.step(inputs)
+                if training_mode:
+                    training.after_step(battle)
+                pressed_keys.clear()
+                accumulator -= TICK_MS
+                ticks += 1
+
+            # CPU の先読み（プロセスプールがないときはここで少しずつ進める）
+            if cpu_level:
+                cpu.work()
 
             # 時間更新
-            hud.update_time()
-
-            # ファイター更新
-            p1.update(key_lst, p2)
-            p2.update(key_lst, p1)
-
-            attacks.update()
-            projectiles.update()
-
-            # 飛び道具融合判定
-            proj_list = list(projectiles)
-            for i in range(len(proj_list)):
-                for j in range(i + 1, len(proj_list)):
-                    p1_proj = proj_list[i]
-                    p2_proj = proj_list[j]
+            hud.update_time(battle)
 
-                    if (p1_proj.owner == p2_proj.owner and
-                        {p1_proj.kind, p2_proj.kind} == {"beam", "bomb"} and
-                        pg.sprite.collide_rect(p1_proj, p2_proj)):
-
-                        x = (p1_proj.rect.centerx + p2_proj.rect.centerx) // 2
-                        y = (p1_proj.rect.centery + p2_proj.rect.centery) // 2
-
-                        p1_proj.kill()
-                        p2_proj.kill()
-
-                        new_proj = Projectile(p1_proj.owner, "rasensyuriken")
-                        new_proj.rect.center = (x, y)
-                        new_proj.hitbox.center = (x, y)
-                        projectiles.add(new_proj)
-                        break
-
-            # 攻撃判定
-            for atk in attacks:
-                for f in fighters:
-                    if f == atk.owner:
-                        continue
-
-                    hit = False
-                    damage = atk.damage
-
-                    # 防御中は軽減
-                    if f.is_guarding:
-                        damage = damage // 3
-
-                    if atk.rect.colliderect(f.hurtbox):
-                        hit = True
-                    elif f.attack_hurtbox and atk.rect.colliderect(f.attack_hurtbox):
-                        hit = True
-
-                    if hit:
-                        f.hp -= damage
-                        apply_knockback(f, atk.owner, damage)
-                        atk.kill()
-                        break
-
-            # 飛び道具とファイターの衝突判定
-            for proj in projectiles:
-                for f in fighters:
-                    if f != proj.owner and proj.hitbox.colliderect(f.hurtbox):
-                        damage = proj.damage
-                        if f.is_guarding:
-                            damage = damage // 3
-                        f.hp -= damage
-                        apply_knockback(f, proj.owner, damage)
-                        proj.kill()
-                        break
-
-            # HPバーの描画
-            draw_hp(screen, p1, 50)
-            draw_hp(screen, p2, WIDTH - 350)
-            
-            # エネルギーバーの描画
-            pg.draw.rect(screen, (100, 100, 100), (50, 45, 300, 12))
-            energy_width1 = 3 * max(0, p1.energy)
-            pg.draw.rect(screen, (0, 150, 255), (50, 45, energy_width1, 12))
-            pg.draw.rect(screen, (255, 255, 255), (50, 45, 300, 12), 1)
-            
-            pg.draw.rect(screen, (100, 100, 100), (WIDTH - 350, 45, 300, 12))
-            energy_width2 = 3 * max(0, p2.energy)
-            pg.draw.rect(screen, (0, 150, 255), (WIDTH - 350, 45, energy_width2, 12))
-            pg.draw.rect(screen, (255, 255, 255), (WIDTH - 350, 45, 300, 12), 1)
-
-            # エネルギーバーの描画
-            pg.draw.rect(screen, (100, 100, 100), (50, 45, 300, 12))
-            energy_width1 = 3 * max(0, p1.energy)
-            pg.draw.rect(screen, (0, 150, 255), (50, 45, energy_width1, 12))
-            pg.draw.rect(screen, (255, 255, 255), (50, 45, 300, 12), 1)
-
-            pg.draw.rect(screen, (100, 100, 100), (WIDTH - 350, 45, 300, 12))
-            energy_width2 = 3 * max(0, p2.energy)
-            pg.draw.rect(screen, (0, 150, 255), (WIDTH - 350, 45, energy_width2, 12))
-            pg.draw.rect(screen, (255, 255, 255), (WIDTH - 350, 45, 300, 12), 1)
-
-            # ファイター描画
-            for f in fighters:
-                screen.blit(f.image, f.rect)
-
-            # 攻撃描画
-            attacks.draw(screen)
-
-            # 飛び道具描画
-            for proj in projectiles:
-                screen.blit(proj.image, proj.rect)
-
-            # HUD描画
-            hud.draw_top(screen)
-            hud.draw_bottom_controls(screen, p1_keys_text, p2_keys_text)
+            # バトル画面・HUD描画
+            if prev_state != BATTLE:
+                renderer.invalidate()
+            update_rects = renderer.draw(screen, battle, hud, p1_keys_text, p2_keys_text)
 
             # 勝利判定
-            if hud.match_time <= 0 or p1.hp <= 0 or p2.hp <= 0:
-                if p1.hp > p2.hp:
+            if battle.result is not None:
+                # チーム戦では味方が残って勝っても勝ち数に入れる
+                if battle.winner_team == battle.teams[0]:
                     hud.p1_wins += 1
-                elif p2.hp > p1.hp:
+                elif battle.winner_team == battle.teams[1]:
                     hud.p2_wins += 1
 
-                result_text = (FONT_BIG.render("K.O.", True, (255, 255, 0))
-                               if (p1.hp <= 0 or p2.hp <= 0)
-                               else FONT_BIG.render("Time Up", True, (255, 255, 0)))
-                screen.blit(result_text, (WIDTH // 2 - result_text.get_width() // 2, HEIGHT // 2 - 40))
-                pg.display.update()
-                pg.time.delay(2000)
+                if recorder is not None:
+                    recorder.save()
+                if ASSETS.loads != loads_at_start:
+                    print(f"[asset] 対戦中に画像ファイルを {ASSETS.loads - loads_at_start} 回読み込みました")
+
+                # 最後の画面の上に結果を出す（次のフレームから）
+                result_screen.start(screen, battle.result)
+                game_state = RESULT
 
-                attacks.empty()
-                projectiles.empty()
+        elif game_state == RESULT:
+            if result_screen.update(dt_ms) or skip_result:
+                battle.attacks.empty()
+                battle.projectiles.empty()
+                if battle.field is not None:
+                    battle.field.clear()
 
                 game_state = SELECT
-                safe_load_and_play_bgm(MENU_BGM, hud.volume)
+                AUDIO.play(MENU_BGM, hud.volume)
+                draw_select(selected_stage, barrage_mode, training_mode, cpu_level, battle_mode)
+            else:
+                update_rects = result_screen.draw(screen)
 
         elif game_state == PAUSED:
-            if battle_surface:
-                screen.blit(battle_surface, (0, 0))
             pause_menu.draw(screen)
 
         elif game_state == SETTINGS:
-            if battle_surface:
-                screen.blit(battle_surface, (0, 0))
             settings_menu.draw(screen)
 
-        pg.display.update()
-
+        if show_profiler and game_state == BATTLE:
+            rect = overlay.draw(screen)
+            if update_rects is not None:
+                update_rects.append(rect)
+
+        if PROFILER.enabled:
+            PROFILER.lap(P_OTHER)
+        present(update_rects)
+        if PROFILER.enabled:
+            PROFILER.lap(P_DISPLAY)
+            PROFILER.end_frame()
+        if trace:
+            trace.step("first frame")
+            trace.report()
+            trace = None
+
+    cpu.close()
+    if PROFILE_CSV is not None and PROFILER.count:
+        PROFILER.dump_csv(PROFILE_CSV)
     pg.quit()
     sys.exit()
 
 if __name__ == "__main__":
     main()
     pg.quit()
-    sys.exit()
\ No newline at end of file
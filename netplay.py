@@ -0,0 +1,484 @@
+"""
+こうかとん ファイターのオンライン対戦（ロールバック方式）
+
+相手の入力が届くまで待たずに「前のフレームと同じ入力」と予測して対戦を進め、
+あとから届いた入力が予測と違っていたら、そのフレームまで状態を巻き戻して
+確定した入力で計算し直す。入力は UDP で毎フレーム送り、届かなかったときに
+備えて相手がまだ受け取っていない入力もまとめて送り直す。
+
+使い方:
+    python netplay.py --host 7000                  # 1P として待ち受ける
+    python netplay.py --join 192.168.0.10:7000     # 2P として接続する
+    python netplay.py --selftest --latency 60 --loss 0.1   # ループバックで動作確認
+
+どちらの側も自分のキャラクターは 1P の操作キー（A/D/W/S/C/V/G/H/T）で動かす。
+"""
+import argparse
+import asyncio
+import random
+import struct
+import sys
+import time
+
+import pygame as pg
+
+import kakutou_koukaton as game
+
+
+# =====================
+# 定数
+# =====================
+MAX_ROLLBACK = 8       # 予測で先に進めてよいフレーム数（これ以上は相手を待つ）
+INPUT_REDUNDANCY = 16  # 1 パケットに入れる入力の最大フレーム数
+FINISH_SECONDS = 1.0   # 決着後も入力を送り続ける時間（相手が決着を確定できるように）
+
+# パケット: 種類, 送信側の現在フレーム, 受け取り済みの相手の最終フレーム, 先頭フレーム, 入力数
+HEADER = struct.Struct("!cIiIB")
+PACKET_INPUT = b"I"
+
+
+# =====================
+# ロールバック
+# =====================
+class RollbackSession:
+    """
+    1 つの Battle を、手元の入力と相手の入力（確定または予測）で進める。
+    フレームを進める前に Battle.save_state() を取っておき、予測が外れていたら
+    そのフレームの状態に戻して計算し直す。
+    """
+
+    def __init__(self, battle, local: int, max_rollback: int = MAX_ROLLBACK) -> None:
+        """
+        Args:
+            battle: 進める Battle
+            local: 手元のプレイヤーの番号（0 = 1P, 1 = 2P）
+            max_rollback: 予測で先に進めてよいフレーム数
+        """
+        self.battle = battle
+        self.local = local
+        self.remote = 1 - local
+        self.max_rollback = max_rollback
+
+        self.frame = 0  # 次に計算するフレーム
+        self.local_inputs: dict[int, int] = {}
+        self.remote_inputs: dict[int, int] = {}  # 届いた相手の入力
+        self.used_remote: dict[int, int] = {}    # 計算に使った相手の入力
+        self.states: dict[int, tuple] = {}       # 各フレームを計算する前の状態
+        self.confirmed = -1      # 相手の入力がここまで途切れずにそろっている
+        self.rollback_from = None
+
+        # 相手から届いた情報（時刻合わせと再送の範囲に使う）
+        self.remote_frame = 0
+        self.remote_ack = -1
+
+        # 統計
+        self.rollbacks = 0
+        self.resimulated = 0
+        self.max_rollback_ms = 0.0
+
+    def can_advance(self) -> bool:
+        """予測のフレーム数が上限に達していなければ True"""
+        return self.frame - self.confirmed <= self.max_rollback
+
+    def frame_advantage(self) -> float:
+        """
+        手元が相手よりどれだけ先に進んでいるか（フレーム）。
+        相手側から見た差との平均なので、通信の遅れは打ち消し合う。
+        """
+        local_adv = self.frame - self.remote_frame
+        remote_adv = self.remote_frame - (self.remote_ack + 1)
+        return (local_adv - remote_adv) / 2
+
+    def should_wait(self) -> bool:
+        """相手より 1 フレーム以上先に進んでいたら True（1 フレーム待って差を縮める）"""
+        return self.frame_advantage() >= 1
+
+    def add_local_input(self, bits: int) -> None:
+        """次に計算するフレームの手元の入力を登録する"""
+        self.local_inputs[self.frame] = bits
+
+    def add_remote_input(self, frame: int, bits: int) -> None:
+        """相手の入力を登録する。計算済みのフレームで予測と違っていたら巻き戻す"""
+        if frame <= self.confirmed or frame in self.remote_inputs:
+            return
+        self.remote_inputs[frame] = bits
+        while self.confirmed + 1 in self.remote_inputs:
+            self.confirmed += 1
+        if frame < self.frame and self.used_remote.get(frame) != bits:
+            if self.rollback_from is None or frame < self.rollback_from:
+                self.rollback_from = frame
+
+    def predict(self) -> int:
+        """相手の入力の予測（押しっぱなしのキーは続け、押した瞬間の技は出さない）"""
+        return self.remote_inputs.get(self.confirmed, 0) & game.HOLD_MASK
+
+    def simulate(self, frame: int) -> None:
+        """1 フレーム計算する"""
+        self.states[frame] = self.battle.save_state()
+        remote = self.remote_inputs.get(frame)
+        if remote is None:
+            remote = self.predict()
+        self.used_remote[frame] = remote
+        inputs = [0, 0]
+        inputs[self.local] = self.local_inputs[frame]
+        inputs[self.remote] = remote
+        self.battle.step(tuple(inputs))
+
+    def sync(self) -> None:
+        """予測が外れていたフレームから今のフレームまで計算し直す"""
+        if self.rollback_from is None:
+            return
+        start = time.perf_counter()
+        first = self.rollback_from
+        self.rollback_from = None
+        self.battle.load_state(self.states[first])
+        for frame in range(first, self.frame):
+            self.simulate(frame)
+        self.rollbacks += 1
+        self.resimulated += self.frame - first
+        self.max_rollback_ms = max(self.max_rollback_ms, (time.perf_counter() - start) * 1000)
+
+    def advance(self) -> None:
+        """巻き戻しを済ませてから 1 フレーム進める"""
+        self.sync()
+        self.simulate(self.frame)
+        self.frame += 1
+        self.discard_old()
+
+    def discard_old(self) -> None:
+        """もう巻き戻さないフレームの記録を捨てる"""
+        for table in (self.states, self.used_remote):
+            for frame in [f for f in table if f <= self.confirmed]:
+                del table[frame]
+        for frame in [f for f in self.remote_inputs if f < self.confirmed]:
+            del self.remote_inputs[frame]
+        for frame in [f for f in self.local_inputs if f <= self.remote_ack]:
+            del self.local_inputs[frame]
+
+    def is_final(self) -> bool:
+        """決着していて、それが確定した入力だけで計算されたものなら True"""
+        return self.battle.result is not None and self.confirmed >= self.frame - 1
+
+    # ----- パケット -----
+    def encode(self) -> bytes:
+        """相手がまだ受け取っていない手元の入力をパケットにする"""
+        start = max(self.remote_ack + 1, self.frame - INPUT_REDUNDANCY, 0)
+        bits = [self.local_inputs[f] for f in range(start, self.frame)]
+        return (HEADER.pack(PACKET_INPUT, self.frame, self.confirmed, start, len(bits))
+                + struct.pack(f"!{len(bits)}H", *bits))
+
+    def decode(self, data: bytes) -> bool:
+        """
+        相手から届いたパケットを読む。
+
+        Returns:
+            読めたら True（壊れたパケットや知らない種類なら False）
+        """
+        if len(data) < HEADER.size:
+            return False
+        kind, frame, ack, start, count = HEADER.unpack_from(data)
+        if kind != PACKET_INPUT or len(data) != HEADER.size + 2 * count:
+            return False
+        self.remote_frame = max(self.remote_frame, frame)
+        self.remote_ack = max(self.remote_ack, ack)
+        for i, bits in enumerate(struct.unpack_from(f"!{count}H", data, HEADER.size)):
+            self.add_remote_input(start + i, bits)
+        return True
+
+
+# =====================
+# 通信
+# =====================
+class NetPeer(asyncio.DatagramProtocol):
+    """
+    UDP で RollbackSession のパケットをやりとりする。
+    latency / jitter / loss を指定すると、送るときに遅らせたり捨てたりして
+    回線の悪い環境を再現する。
+    """
+
+    def __init__(self, session: RollbackSession, peer_addr=None,
+                 latency_ms: float = 0.0, jitter_ms: float = 0.0,
+                 loss: float = 0.0, seed: int = 0) -> None:
+        """
+        Args:
+            session: 入力を受け渡しする RollbackSession
+            peer_addr: 相手のアドレス（None なら最初に届いたパケットの送り主）
+            latency_ms: 送信を遅らせる時間(ms)
+            jitter_ms: 遅らせる時間のばらつき(ms)
+            loss: パケットを捨てる割合
+            seed: 遅れと損失を決める乱数の種
+        """
+        self.session = session
+        self.peer_addr = peer_addr
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.loss = loss
+        self.rng = random.Random(seed)
+        self.transport = None
+        self.sent = 0
+        self.dropped = 0
+        self.received = 0
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        if self.peer_addr is None:
+            self.peer_addr = addr
+        elif addr != self.peer_addr:
+            return
+        if self.session.decode(data):
+            self.received += 1
+
+    def error_received(self, exc) -> None:
+        # 相手がまだ起動していないときなど。UDP なので次の送信で取り戻せる
+        pass
+
+    def send_inputs(self) -> None:
+        """手元の入力を相手に送る"""
+        if self.peer_addr is None or self.transport is None:
+            return
+        data = self.session.encode()
+        self.sent += 1
+        if self.loss and self.rng.random() < self.loss:
+            self.dropped += 1
+            return
+        delay = self.latency_ms + self.rng.uniform(0, self.jitter_ms)
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay / 1000, self._send, data)
+        else:
+            self._send(data)
+
+    def _send(self, data: bytes) -> None:
+        if not self.transport.is_closing():
+            self.transport.sendto(data, self.peer_addr)
+
+
+def parse_address(text: str) -> tuple[str, int]:
+    """ "host:port" をアドレスにする"""
+    host, _, port = text.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def new_battle():
+    """ネット対戦用の Battle を作る（1P はホスト、2P は参加した側）"""
+    battle = game.create_battle()
+    battle.reset()
+    return battle
+
+
+# =====================
+# 対戦画面
+# =====================
+async def play(args) -> None:
+    """ネット対戦の画面を動かす"""
+    game.init_display()
+    loop = asyncio.get_running_loop()
+
+    local = 0 if args.host is not None else 1
+    battle = new_battle()
+    session = RollbackSession(battle, local)
+    if args.host is not None:
+        local_addr, peer_addr = ("0.0.0.0", args.host), None
+    else:
+        local_addr, peer_addr = ("0.0.0.0", 0), parse_address(args.join)
+    transport, peer = await loop.create_datagram_endpoint(
+        lambda: NetPeer(session, peer_addr, args.latency, args.jitter, args.loss),
+        local_addr=local_addr)
+
+    hud = game.HUD()
+    renderer = game.BattleRenderer()
+    game.preload_battle_assets(battle)
+    renderer.set_stage(game.STAGES[args.stage % len(game.STAGES)].bg)
+    game.AUDIO.play(game.BATTLE_BGM, hud.volume)
+    if local == 0:
+        keys_text = (game.P1_KEYS_TEXT, "2P: ネット対戦の相手")
+    else:
+        keys_text = ("1P: ネット対戦の相手", game.P1_KEYS_TEXT.replace("P1", "P2", 1))
+
+    pressed_keys = set()
+    accumulator = 0.0
+    last = time.perf_counter()
+    finished_at = None
+    running = True
+
+    while running:
+        now = time.perf_counter()
+        accumulator += (now - last) * 1000
+        last = now
+
+        for event in pg.event.get():
+            if game.handle_display_event(event):
+                renderer.invalidate()
+            elif event.type == pg.QUIT:
+                running = False
+            elif event.type == pg.KEYDOWN:
+                if event.key == pg.K_ESCAPE:
+                    running = False
+                pressed_keys.add(event.key)
+        key_lst = pg.key.get_pressed()
+
+        game.AUDIO.update()
+        ticks = 0
+        while accumulator >= game.TICK_MS and ticks < game.MAX_TICKS_PER_FRAME:
+            # 相手を待つときは時間を溜めない（あとで早送りしない）
+            if not session.can_advance() or session.should_wait():
+                accumulator = 0.0
+                break
+            session.add_local_input(game.read_input(game.P1_KEYS, key_lst, pressed_keys))
+            pressed_keys.clear()
+            session.advance()
+            peer.send_inputs()
+            accumulator -= game.TICK_MS
+            ticks += 1
+        if ticks == game.MAX_TICKS_PER_FRAME:
+            accumulator = 0.0
+        if ticks == 0:
+            # 進めなかったフレームも送り直す（相手が待っているかもしれない）
+            session.sync()
+            peer.send_inputs()
+
+        hud.update_time(battle)
+        rects = renderer.draw(game.screen, battle, hud, *keys_text)
+        if session.is_final():
+            text = game.TEXT.render(game.FONT_BIG, battle.result, (255, 255, 0))
+            pos = (game.WIDTH // 2 - text.get_width() // 2, game.HEIGHT // 2 - 40)
+            game.screen.blit(game.to_render(text), game.render_pos(pos))
+            rects = None
+            if finished_at is None:
+                finished_at = now
+            elif now - finished_at > FINISH_SECONDS + 1.0:
+                running = False
+        game.present(rects)
+
+        await asyncio.sleep(0.001)
+
+    transport.close()
+    print(f"ロールバック {session.rollbacks} 回 / 再計算 {session.resimulated} フレーム "
+          f"/ 最大 {session.max_rollback_ms:.2f} ms")
+    pg.quit()
+
+
+# =====================
+# 動作確認
+# =====================
+def random_inputs(frames: int, seed: int) -> list[int]:
+    """それらしい入力列を作る（押しっぱなしは数フレーム続け、技はときどき出す）"""
+    rng = random.Random(seed)
+    held = 0
+    result = []
+    for _ in range(frames):
+        if rng.random() < 0.1:
+            held = rng.choice((0, game.IN_LEFT, game.IN_RIGHT, game.IN_JUMP,
+                               game.IN_DOWN, game.IN_LEFT | game.IN_JUMP))
+        press = 0
+        if rng.random() < 0.08:
+            press = rng.choice((game.IN_PUNCH, game.IN_KICK, game.IN_BEAM,
+                                game.IN_BOMB, game.IN_THROW))
+        result.append(held | press)
+    return result
+
+
+async def run_peer(session: RollbackSession, peer: NetPeer, inputs: list[int]) -> None:
+    """入力列を 1 フレームずつ実時間で流し、相手の入力がすべて確定するまで続ける"""
+    frames = len(inputs)
+    start = time.perf_counter()
+    while session.frame < frames or session.confirmed < frames - 1:
+        if session.frame < frames and session.can_advance() and not session.should_wait():
+            session.add_local_input(inputs[session.frame])
+            session.advance()
+        else:
+            session.sync()
+        peer.send_inputs()
+        target = start + session.frame * game.TICK_MS / 1000
+        await asyncio.sleep(max(0.001, target - time.perf_counter()))
+    session.sync()
+    # 相手が最後の入力を受け取れるように少し送り続ける
+    for _ in range(int(FINISH_SECONDS * game.TICK_RATE)):
+        peer.send_inputs()
+        await asyncio.sleep(game.TICK_MS / 1000)
+
+
+def measure_resimulation(frames: int = MAX_ROLLBACK, repeat: int = 200) -> float:
+    """対戦の途中から frames フレーム巻き戻して計算し直すのにかかる時間(ms)"""
+    battle = new_battle()
+    game.preload_battle_assets(battle)
+    inputs = list(zip(random_inputs(300, 1), random_inputs(300, 2)))
+    for pair in inputs[:240]:
+        battle.step(pair)
+    state = battle.save_state()
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        battle.load_state(state)
+        for pair in inputs[240:240 + frames]:
+            battle.save_state()
+            battle.step(pair)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+async def selftest(args) -> bool:
+    """
+    2 つのセッションをループバックでつなぎ、遅れと損失がある回線で対戦させる。
+    最後の状態が、同じ入力をそのまま流した Battle と一致するかを確かめる。
+    """
+    loop = asyncio.get_running_loop()
+    frames = args.frames
+    inputs = (random_inputs(frames, args.seed), random_inputs(frames, args.seed + 1))
+
+    sessions = [RollbackSession(new_battle(), i) for i in range(2)]
+    endpoints = []
+    for i, session in enumerate(sessions):
+        endpoints.append(await loop.create_datagram_endpoint(
+            lambda s=session, i=i: NetPeer(s, None, args.latency, args.jitter,
+                                           args.loss, args.seed + 10 + i),
+            local_addr=("127.0.0.1", 0)))
+    addrs = [t.get_extra_info("sockname") for t, _ in endpoints]
+    endpoints[0][1].peer_addr = addrs[1]
+    endpoints[1][1].peer_addr = addrs[0]
+
+    await asyncio.gather(*(run_peer(s, p, inputs[i])
+                           for i, (s, (_, p)) in enumerate(zip(sessions, endpoints))))
+    for transport, _ in endpoints:
+        transport.close()
+
+    reference = new_battle()
+    for pair in zip(*inputs):
+        reference.step(pair)
+    expected = reference.save_state()
+
+    ok = True
+    for i, (session, (_, peer)) in enumerate(zip(sessions, endpoints)):
+        same = session.battle.save_state() == expected
+        ok &= same
+        print(f"{i + 1}P: {'一致' if same else '不一致'}  ロールバック {session.rollbacks} 回 "
+              f"/ 再計算 {session.resimulated} フレーム / 最大 {session.max_rollback_ms:.2f} ms "
+              f"/ 送信 {peer.sent} (損失 {peer.dropped}) 受信 {peer.received}")
+    print(f"{MAX_ROLLBACK} フレームの再計算: {measure_resimulation():.3f} ms "
+          f"(1 フレーム {game.TICK_MS:.1f} ms)")
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="こうかとん ファイター ネット対戦")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--host", type=int, metavar="PORT", help="1P として待ち受ける")
+    group.add_argument("--join", metavar="HOST:PORT", help="2P として接続する")
+    group.add_argument("--selftest", action="store_true", help="ループバックで動作確認する")
+    parser.add_argument("--stage", type=int, default=0, help="ステージ番号")
+    parser.add_argument("--latency", type=float, default=0.0, help="送信を遅らせる時間(ms)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="遅れのばらつき(ms)")
+    parser.add_argument("--loss", type=float, default=0.0, help="パケットを捨てる割合")
+    parser.add_argument("--frames", type=int, default=600, help="動作確認で流すフレーム数")
+    parser.add_argument("--seed", type=int, default=1, help="動作確認の乱数の種")
+    args = parser.parse_args()
+
+    if args.selftest:
+        ok = asyncio.run(selftest(args))
+        sys.exit(0 if ok else 1)
+    asyncio.run(play(args))
+
+
+if __name__ == "__main__":
+    main()
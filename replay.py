@@ -0,0 +1,135 @@
+"""
+こうかとん ファイターのリプレイ再生
+
+対戦が終わるたびに replays/ に保存されるリプレイファイルを再生する。
+
+使い方:
+    python replay.py replays/replay_20240101_120000.kkr
+    python replay.py replays/replay_20240101_120000.kkr --bench   # シークの速さを測る
+
+操作:
+    Space=一時停止  ←/→=1秒戻る/進む（Shift で10秒）  ,/.=1フレーム戻る/進む
+    Home/End=最初/最後  ESC=終了
+"""
+import argparse
+import random
+import sys
+import time
+
+import pygame as pg
+
+import kakutou_koukaton as game
+
+
+def bench(replay: game.Replay, path: str, count: int = 200) -> None:
+    """ランダムなフレームへのシークにかかる時間を測る"""
+    battle = replay.new_battle()
+    rng = random.Random(0)
+    targets = [rng.randrange(replay.frames + 1) for _ in range(count)]
+    times = []
+    for frame in targets:
+        start = time.perf_counter()
+        replay.seek(battle, frame)
+        times.append((time.perf_counter() - start) * 1000)
+    size = len(replay.data)
+    print(f"{path}: {replay.frames} フレーム ({replay.frames / game.TICK_RATE:.1f} 秒), "
+          f"{size / 1024:.1f} KB, キーフレーム {len(replay.keyframe_frames)} 個")
+    print(f"シーク {count} 回: 平均 {sum(times) / count:.2f} ms / 最大 {max(times):.2f} ms")
+
+
+def play(replay: game.Replay) -> None:
+    """リプレイを画面に再生する"""
+    game.init_display()
+    battle = replay.new_battle()
+    hud = game.HUD()
+    # 上に再生位置を書き足すので、毎フレーム画面全体を描き直す
+    renderer = game.BattleRenderer(dirty=False)
+    game.preload_battle_assets(battle)
+    renderer.set_stage(game.STAGES[replay.stage % len(game.STAGES)].bg)
+
+    frame = 0
+    replay.seek(battle, frame)
+    paused = False
+    accumulator = 0.0
+    running = True
+
+    while running:
+        dt_ms = game.clock.tick(game.RENDER_FPS)
+        target = frame
+
+        for event in pg.event.get():
+            if game.handle_display_event(event):
+                renderer.invalidate()
+            elif event.type == pg.QUIT:
+                running = False
+            elif event.type == pg.KEYDOWN:
+                step = 10 * game.TICK_RATE if event.mod & pg.KMOD_SHIFT else game.TICK_RATE
+                if event.key == pg.K_ESCAPE:
+                    running = False
+                elif event.key == pg.K_SPACE:
+                    paused = not paused
+                elif event.key == pg.K_LEFT:
+                    target -= step
+                elif event.key == pg.K_RIGHT:
+                    target += step
+                elif event.key == pg.K_COMMA:
+                    paused = True
+                    target -= 1
+                elif event.key == pg.K_PERIOD:
+                    paused = True
+                    target += 1
+                elif event.key == pg.K_HOME:
+                    target = 0
+                elif event.key == pg.K_END:
+                    target = replay.frames
+
+        if not paused:
+            accumulator += dt_ms
+            while accumulator >= game.TICK_MS:
+                target += 1
+                accumulator -= game.TICK_MS
+        else:
+            accumulator = 0.0
+
+        target = max(0, min(target, replay.frames))
+        if target != frame:
+            replay.seek(battle, target)
+            frame = target
+
+        hud.update_time(battle)
+        renderer.draw(game.screen, battle, hud,
+                      "Space=一時停止 ←/→=1秒 Shift+←/→=10秒 ,/.=1フレーム Home/End=最初/最後",
+                      "ESC=終了")
+        label = f"REPLAY {frame / game.TICK_RATE:5.1f} / {replay.frames / game.TICK_RATE:.1f} 秒"
+        text = game.TEXT.render(game.FONT_SMALL, label, (255, 255, 0))
+        pos = (game.WIDTH // 2 - text.get_width() // 2, game.HUD.TOP_HEIGHT + 4)
+        game.screen.blit(game.to_render(text), game.render_pos(pos))
+        if battle.result is not None and frame == replay.frames:
+            result = game.TEXT.render(game.FONT_BIG, battle.result, (255, 255, 0))
+            pos = (game.WIDTH // 2 - result.get_width() // 2, game.HEIGHT // 2 - 40)
+            game.screen.blit(game.to_render(result), game.render_pos(pos))
+        game.present()
+
+    pg.quit()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="こうかとん ファイター リプレイ再生")
+    parser.add_argument("path", help="リプレイファイル")
+    parser.add_argument("--bench", action="store_true", help="シークの速さを測る")
+    args = parser.parse_args()
+
+    try:
+        replay = game.Replay.load(args.path)
+    except (OSError, ValueError) as e:
+        print(f"[replay load error] {args.path} : {e}")
+        sys.exit(1)
+
+    if args.bench:
+        bench(replay, args.path)
+    else:
+        play(replay)
+
+
+if __name__ == "__main__":
+    main()
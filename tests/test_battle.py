@@ -0,0 +1,161 @@
+"""
+対戦の決定性のテスト。ロールバック（netplay.py）とリプレイは、
+同じ状態から同じ入力で進めれば同じ状態になることに頼っている。
+"""
+import random
+
+import pytest
+
+import kakutou_koukaton as game
+
+FRAMES = 600
+
+
+def random_inputs(frames: int, players: int, seed: int) -> list[tuple[int, ...]]:
+    """押しっぱなしの方向をときどき変え、技もときどき出す入力列"""
+    rng = random.Random(seed)
+    held = [0] * players
+    presses = (game.IN_PUNCH, game.IN_KICK, game.IN_BEAM, game.IN_BOMB, game.IN_THROW)
+    result = []
+    for _ in range(frames):
+        frame = []
+        for i in range(players):
+            if rng.random() < 0.1:
+                held[i] = rng.choice((0, game.IN_LEFT, game.IN_RIGHT, game.IN_JUMP, game.IN_DOWN,
+                                      game.IN_RIGHT | game.IN_JUMP, game.IN_LEFT | game.IN_DOWN))
+            press = rng.choice(presses) if rng.random() < 0.08 else 0
+            frame.append(held[i] | press)
+        result.append(tuple(frame))
+    return result
+
+
+def plain(value):
+    """比べるための値にする（弾幕モードの numpy の配列はリストにする）"""
+    if isinstance(value, tuple):
+        return tuple(plain(v) for v in value)
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    return value
+
+
+def snapshot(battle) -> tuple:
+    return plain(battle.save_state())
+
+
+def new_battle(mode: str = "1v1", barrage: bool = False):
+    battle = game.create_battle(barrage, mode=mode)
+    battle.reset()
+    return battle
+
+
+BATTLES = [
+    ("1v1", False),
+    ("FFA4", False),
+    pytest.param("1v1", True, marks=pytest.mark.skipif(game.np is None, reason="numpy がない")),
+]
+
+
+@pytest.mark.parametrize("mode, barrage", BATTLES)
+def test_save_step_load_step_is_identical(mode, barrage):
+    battle = new_battle(mode, barrage)
+    inputs = random_inputs(FRAMES, len(battle.fighters), seed=1)
+    for bits in inputs[:200]:
+        battle.step(bits)
+    saved = battle.save_state()
+
+    first = []
+    for bits in inputs[200:]:
+        battle.step(bits)
+        first.append(snapshot(battle))
+
+    battle.load_state(saved)
+    second = []
+    for bits in inputs[200:]:
+        battle.step(bits)
+        second.append(snapshot(battle))
+    assert first == second
+
+
+def test_load_state_into_fresh_battle():
+    battle = new_battle()
+    for bits in random_inputs(300, 2, seed=2):
+        battle.step(bits)
+    other = new_battle()
+    other.load_state(battle.save_state())
+    assert snapshot(other) == snapshot(battle)
+
+
+@pytest.mark.skipif(game.np is None, reason="numpy がない")
+def test_load_state_matches_barrage_field():
+    plain_battle = new_battle()
+    barrage = new_battle(barrage=True)
+    for bits in random_inputs(200, 2, seed=6):
+        barrage.step(bits)
+    assert barrage.field.count > 0
+    # 弾幕モードでない状態を戻すと、残っていた弾は消える
+    barrage.load_state(plain_battle.save_state())
+    assert barrage.field.count == 0
+    with pytest.raises(ValueError):
+        plain_battle.load_state(new_battle(barrage=True).save_state())
+
+
+def record(mode: str = "1v1", seed: int = 3):
+    """対戦を記録し、(リプレイ, フレームごとの状態, 最後の状態) を返す"""
+    battle = new_battle(mode)
+    recorder = game.ReplayRecorder(1, mode=mode)
+    states = []
+    for bits in random_inputs(FRAMES, len(battle.fighters), seed):
+        if battle.result is not None:
+            break
+        states.append(snapshot(battle))
+        recorder.record(battle, bits)
+        battle.step(bits)
+    return game.Replay(recorder.to_bytes()), states, snapshot(battle)
+
+
+@pytest.mark.parametrize("mode", ["1v1", "2v2"])
+def test_replay_seeks_to_recorded_states(mode):
+    replay, states, final = record(mode)
+    battle = replay.new_battle()
+    replay.seek(battle, replay.frames)
+    assert snapshot(battle) == final
+
+    # 後ろへ戻るシークと、キーフレームをまたぐシーク
+    rng = random.Random(4)
+    for frame in [rng.randrange(replay.frames) for _ in range(20)] + [0, replay.frames - 1]:
+        replay.seek(battle, frame)
+        assert snapshot(battle) == states[frame]
+
+
+def test_keyframe_round_trip():
+    battle = new_battle()
+    for bits in random_inputs(200, 2, seed=5):
+        battle.step(bits)
+    state = battle.save_state()
+    assert plain(game.decode_keyframe(game.encode_keyframe(state))) == plain(state)
+
+
+@pytest.mark.parametrize("cut", [0, 10, 40, -1, -13])
+def test_truncated_replay_raises_value_error(cut):
+    replay = record()[0]
+    with pytest.raises(ValueError):
+        game.Replay(replay.data[:cut])
+
+
+def test_corrupt_keyframe_raises_value_error():
+    replay = record()[0]
+    data = bytearray(replay.data)
+    # 最初のキーフレームの中身を壊す
+    index_start = len(data) - game.REPLAY_INDEX.size * len(replay.keyframe_frames)
+    _, offset, _ = game.REPLAY_INDEX.unpack_from(data, index_start)
+    data[offset + 5] ^= 0xFF
+    with pytest.raises(ValueError):
+        game.Replay(bytes(data))
+
+
+def test_command_236_punch_fires_projectile():
+    battle = new_battle()
+    motion = [game.IN_DOWN, game.IN_DOWN | game.IN_RIGHT, game.IN_RIGHT, game.IN_PUNCH]
+    for bits in motion:
+        battle.step((bits, 0))
+    assert [p.kind for p in battle.projectiles] == ["beam"]
@@ -0,0 +1,391 @@
+"""
+こうかとん ファイターのバランス調整用トーナメント
+
+画面を出さずに決まった作戦どうし（または CPU どうし）の対戦を大量に流し、
+勝率・決着までの時間・時間切れの割合・技ごとのダメージを集計する。
+対戦は multiprocessing ですべての CPU コアに配り、終わった順に JSON Lines で書き出す。
+フレームデータなどの値を --sweep で変えながら、組み合わせごとにまとめて流せる。
+
+使い方:
+    python tournament.py --p1 rush --p2 zoner --matches 2000
+    python tournament.py --matches 500 --sweep Attack.DATA.punch.damage=3,5,7 \\
+        --sweep THROW_DAMAGE=10,20 --out sweep.jsonl --summary sweep_summary.json
+    python tournament.py --p1 cpu --p2 rush --matches 20 --cpu-rollouts 2
+
+値の指定（--set / --sweep）:
+    kakutou_koukaton の中の名前を . でつなぐ。辞書はキーで、それ以外は属性でたどる。
+    Attack.DATA.kick.life  Projectile.DATA.beam.speed  Battle.PROJECTILE_COST.bomb
+    THROW_DAMAGE  THROW_COOLDOWN  ENERGY_REGEN
+
+作戦:
+    random  それらしいランダムな入力
+    rush    近づいてパンチ・キック、密着したら投げる
+    zoner   距離をとって手裏剣と螺旋丸を撃つ
+    cpu     先読みする CPU（CpuController。遅いので数を少なめに）
+"""
+import argparse
+import ast
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import kakutou_koukaton as game
+
+
+DEFAULT_MATCHES = 1000
+# 1つの仕事にまとめる対戦の数（プロセス間のやり取りを減らす）
+CHUNK_MATCHES = 20
+
+
+# =====================
+# 作戦
+# =====================
+class RandomPolicy:
+    """押しっぱなしの方向をときどき変え、技もときどき出す"""
+
+    def __init__(self, index: int, rng: random.Random) -> None:
+        self.rng = rng
+        self.held = 0
+
+    def read(self, battle) -> int:
+        rng = self.rng
+        if rng.random() < 0.1:
+            self.held = rng.choice((0, game.IN_LEFT, game.IN_RIGHT, game.IN_JUMP,
+                                    game.IN_DOWN, game.IN_LEFT | game.IN_JUMP))
+        press = 0
+        if rng.random() < 0.08:
+            press = rng.choice((game.IN_PUNCH, game.IN_KICK, game.IN_BEAM,
+                                game.IN_BOMB, game.IN_THROW))
+        return self.held | press
+
+
+class RushPolicy:
+    """相手に近づいてパンチとキックを出し、密着したら投げる"""
+
+    ATTACKS = (("punch", game.IN_PUNCH), ("kick", game.IN_KICK))
+    # 届く距離より少し手前で止まる（止まるまでに滑る分と、相手が下がる分）
+    MARGIN = 8
+
+    def __init__(self, index: int, rng: random.Random) -> None:
+        self.index = index
+        self.rng = rng
+
+    @staticmethod
+    def reach(atk_type: str, enemy) -> int:
+        """技が相手のくらい判定に届く、中心どうしの距離（Attack.DATA の位置と大きさから求める）"""
+        data = game.Attack.DATA[atk_type]
+        return data["offset"][0] + data["size"][0] // 2 + enemy.hurtbox.width // 2
+
+    def read(self, battle) -> int:
+        me, enemy = battle.fighters[self.index], battle.fighters[1 - self.index]
+        dx = enemy.rect.centerx - me.rect.centerx
+        toward = game.IN_RIGHT if dx > 0 else game.IN_LEFT
+        distance = abs(dx)
+        if distance < 70 and self.rng.random() < 0.3:
+            return game.IN_THROW
+        # 届く技があればときどき出し、いちばん短い技が届くまでは近づき続ける
+        reaches = [(self.reach(atk_type, enemy) - self.MARGIN, bit) for atk_type, bit in self.ATTACKS]
+        usable = [bit for reach, bit in reaches if distance < reach]
+        if usable and self.rng.random() < 0.25:
+            return self.rng.choice(usable)
+        if distance < min(reach for reach, _ in reaches):
+            return 0
+        return toward
+
+
+class ZonerPolicy:
+    """距離をとりながら手裏剣と螺旋丸を撃つ"""
+
+    KEEP_DISTANCE = 350
+
+    def __init__(self, index: int, rng: random.Random) -> None:
+        self.index = index
+        self.rng = rng
+
+    def read(self, battle) -> int:
+        me, enemy = battle.fighters[self.index], battle.fighters[1 - self.index]
+        dx = enemy.rect.centerx - me.rect.centerx
+        toward = game.IN_RIGHT if dx > 0 else game.IN_LEFT
+        away = game.IN_LEFT if dx > 0 else game.IN_RIGHT
+        # 撃つ前に相手の方を向く
+        if me.facing != (1 if dx > 0 else -1):
+            return toward
+        if me.energy >= game.Battle.PROJECTILE_COST["bomb"] and self.rng.random() < 0.05:
+            return game.IN_BOMB
+        if me.energy >= game.Battle.PROJECTILE_COST["beam"] and self.rng.random() < 0.1:
+            return game.IN_BEAM
+        if abs(dx) < self.KEEP_DISTANCE:
+            return away
+        return 0
+
+
+class CpuPolicy:
+    """先読みする CPU（このプロセスで、決めた回数だけ必ず先読みする）"""
+
+    def __init__(self, index: int, rng: random.Random, rollouts: int = 1) -> None:
+        self.cpu = game.CpuController(index, workers=0)
+        self.cpu.seed = rng.randrange(1 << 30)
+        self.rollouts = rollouts
+        self.started = False
+
+    def read(self, battle) -> int:
+        if not self.started:
+            self.cpu.start(battle, self.rollouts)
+            self.started = True
+        bits = self.cpu.read(battle)
+        # 時間で区切らず、決めた回数を全部先読みする（結果が毎回同じになる）
+        self.cpu.work(math.inf)
+        return bits
+
+
+POLICIES = {
+    "random": RandomPolicy,
+    "rush": RushPolicy,
+    "zoner": ZonerPolicy,
+    "cpu": CpuPolicy,
+}
+
+
+# =====================
+# 値の上書き
+# =====================
+def parse_assignment(text: str) -> tuple[str, list]:
+    """"名前=値,値,..." を (名前, [値, ...]) にする（値は Python の書き方）"""
+    path, _, values = text.partition("=")
+    if not values:
+        raise argparse.ArgumentTypeError(f"名前=値 の形で指定してください: {text}")
+    return path, [ast.literal_eval(v) for v in values.split(",")]
+
+
+def resolve(path: str):
+    """名前をたどって (入れ物, 最後のキー) を返す"""
+    *parents, last = path.split(".")
+    obj = game
+    for key in parents:
+        obj = obj[key] if isinstance(obj, dict) else getattr(obj, key)
+    if isinstance(obj, dict):
+        if last not in obj:
+            raise KeyError(path)
+    elif not hasattr(obj, last):
+        raise AttributeError(path)
+    return obj, last
+
+
+def get_value(path: str):
+    obj, key = resolve(path)
+    return obj[key] if isinstance(obj, dict) else getattr(obj, key)
+
+
+def set_value(path: str, value) -> None:
+    obj, key = resolve(path)
+    if isinstance(obj, dict):
+        obj[key] = value
+    else:
+        setattr(obj, key, value)
+
+
+# 仕事を受け取ったプロセスで上書きしている値の元の値 {名前: 値}
+_originals: dict[str, object] = {}
+
+
+def apply_overrides(overrides: dict[str, object]) -> None:
+    """前の上書きを元に戻してから overrides を当てる"""
+    for path, value in _originals.items():
+        set_value(path, value)
+    _originals.clear()
+    for path, value in overrides.items():
+        _originals[path] = get_value(path)
+        set_value(path, value)
+
+
+# =====================
+# 対戦
+# =====================
+def run_match(p1: str, p2: str, seed: int, seconds: float, cpu_rollouts: int) -> dict:
+    """
+    1試合流して結果を返す。
+
+    Returns:
+        winner（0/1、引き分けは -1）, result, frames, hp, damage {"0:punch": ダメージ, ...}
+    """
+    battle = game.create_battle()
+    battle.reset()
+    battle.time_left = int(seconds * game.TICK_RATE)
+    battle.damage_log = {}
+    rng = random.Random(seed)
+    policies = []
+    for index, name in enumerate((p1, p2)):
+        policy_rng = random.Random(rng.randrange(1 << 30))
+        if name == "cpu":
+            policies.append(CpuPolicy(index, policy_rng, cpu_rollouts))
+        else:
+            policies.append(POLICIES[name](index, policy_rng))
+
+    while battle.result is None:
+        battle.step((policies[0].read(battle), policies[1].read(battle)))
+
+    winner = battle.fighters.index(battle.winner) if battle.winner is not None else -1
+    return {
+        "winner": winner,
+        "result": battle.result,
+        "frames": battle.frame,
+        "hp": [f.hp for f in battle.fighters],
+        "damage": {f"{i}:{source}": d for (i, source), d in battle.damage_log.items()},
+    }
+
+
+def run_chunk(task: tuple) -> tuple[int, list[dict]]:
+    """仕事1つ分（同じ設定の対戦をいくつか）を流す。プロセスプールで動かす"""
+    config_id, overrides, p1, p2, seeds, seconds, cpu_rollouts = task
+    apply_overrides(overrides)
+    results = []
+    for seed in seeds:
+        result = run_match(p1, p2, seed, seconds, cpu_rollouts)
+        result["config"] = config_id
+        result["seed"] = seed
+        results.append(result)
+    return config_id, results
+
+
+# =====================
+# 集計
+# =====================
+class Summary:
+    """設定ごとの集計"""
+
+    def __init__(self, overrides: dict) -> None:
+        self.overrides = overrides
+        self.matches = 0
+        self.wins = [0, 0]
+        self.draws = 0
+        self.timeouts = 0
+        self.frames = 0
+        self.damage: dict[str, int] = {}
+
+    def add(self, result: dict) -> None:
+        self.matches += 1
+        if result["winner"] >= 0:
+            self.wins[result["winner"]] += 1
+        else:
+            self.draws += 1
+        if result["result"] == "Time Up":
+            self.timeouts += 1
+        self.frames += result["frames"]
+        for key, d in result["damage"].items():
+            self.damage[key] = self.damage.get(key, 0) + d
+
+    def to_dict(self) -> dict:
+        n = max(self.matches, 1)
+        return {
+            "overrides": self.overrides,
+            "matches": self.matches,
+            "p1_win_rate": self.wins[0] / n,
+            "p2_win_rate": self.wins[1] / n,
+            "draw_rate": self.draws / n,
+            "timeout_rate": self.timeouts / n,
+            "avg_seconds": self.frames / n / game.TICK_RATE,
+            # 1試合あたりの与えたダメージ（"0:punch" は 1P のパンチ）
+            "damage_per_match": {k: round(d / n, 2) for k, d in sorted(self.damage.items())},
+        }
+
+
+def print_summary(summaries: list[Summary], p1: str, p2: str) -> None:
+    print(f"\n1P={p1} / 2P={p2}")
+    print(f"{'設定':<40}{'試合':>7}{'1P勝率':>8}{'2P勝率':>8}{'時間切れ':>8}{'平均秒':>8}")
+    for summary in summaries:
+        s = summary.to_dict()
+        label = ", ".join(f"{k}={v}" for k, v in summary.overrides.items()) or "(そのまま)"
+        print(f"{label:<40}{s['matches']:>7}{s['p1_win_rate']:>8.1%}{s['p2_win_rate']:>8.1%}"
+              f"{s['timeout_rate']:>8.1%}{s['avg_seconds']:>8.1f}")
+        for side in (0, 1):
+            parts = [f"{k.split(':')[1]}={d:.1f}" for k, d in s["damage_per_match"].items()
+                     if k.startswith(f"{side}:")]
+            print(f"    {side + 1}P のダメージ/試合: {' '.join(parts) or '-'}")
+
+
+# =====================
+# 実行
+# =====================
+def make_configs(fixed: list, sweeps: list) -> list[dict]:
+    """--set と --sweep から、設定（上書きする値の辞書）の一覧を作る"""
+    base = {path: values[-1] for path, values in fixed}
+    paths = [path for path, _ in sweeps]
+    configs = []
+    for combo in itertools.product(*(values for _, values in sweeps)):
+        overrides = dict(base)
+        overrides.update(zip(paths, combo))
+        configs.append(overrides)
+    return configs
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="こうかとん ファイター バランス調整トーナメント")
+    parser.add_argument("--p1", choices=POLICIES, default="random", help="1P の作戦")
+    parser.add_argument("--p2", choices=POLICIES, default="random", help="2P の作戦")
+    parser.add_argument("--matches", type=int, default=DEFAULT_MATCHES, help="設定ごとの試合数")
+    parser.add_argument("--seconds", type=float, default=game.MATCH_TIME / game.TICK_RATE,
+                        help="1試合の制限時間（秒）")
+    parser.add_argument("--set", dest="fixed", type=parse_assignment, action="append", default=[],
+                        metavar="名前=値", help="すべての設定で変える値")
+    parser.add_argument("--sweep", type=parse_assignment, action="append", default=[],
+                        metavar="名前=値,値,...", help="振る値（複数指定するとすべての組み合わせ）")
+    parser.add_argument("--cpu-rollouts", type=int, default=1, help="cpu の行動ごとの先読み回数")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="プロセス数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="1試合ごとの結果を書き出す JSON Lines（終わった順）")
+    parser.add_argument("--summary", help="設定ごとの集計を書き出す JSON")
+    args = parser.parse_args()
+
+    configs = make_configs(args.fixed, args.sweep)
+    for path in {p for overrides in configs for p in overrides}:
+        try:
+            get_value(path)
+        except (KeyError, AttributeError):
+            parser.error(f"値が見つかりません: {path}")
+
+    # 設定ごとに同じ種の並びを使う（設定の違いだけを比べられる）
+    seeds = [args.seed * 1_000_003 + i for i in range(args.matches)]
+    tasks = [(config_id, overrides, args.p1, args.p2, seeds[i:i + CHUNK_MATCHES],
+              args.seconds, args.cpu_rollouts)
+             for config_id, overrides in enumerate(configs)
+             for i in range(0, args.matches, CHUNK_MATCHES)]
+    summaries = [Summary(overrides) for overrides in configs]
+    total = len(configs) * args.matches
+
+    out = open(args.out, "w", encoding="utf-8") if args.out else None
+    done = 0
+    start = time.perf_counter()
+    with multiprocessing.get_context("spawn").Pool(args.workers) as pool:
+        for config_id, results in pool.imap_unordered(run_chunk, tasks):
+            for result in results:
+                summaries[config_id].add(result)
+                if out is not None:
+                    out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            if out is not None:
+                out.flush()
+            done += len(results)
+            elapsed = time.perf_counter() - start
+            print(f"\r{done}/{total} 試合 {elapsed:.0f} 秒 ({done / elapsed:.0f} 試合/秒)",
+                  end="", file=sys.stderr, flush=True)
+    print(file=sys.stderr)
+    if out is not None:
+        out.close()
+
+    print_summary(summaries, args.p1, args.p2)
+    if args.summary:
+        with open(args.summary, "w", encoding="utf-8") as fp:
+            json.dump({"p1": args.p1, "p2": args.p2, "seconds": args.seconds,
+                       "configs": [s.to_dict() for s in summaries]},
+                      fp, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()